@@ -0,0 +1,92 @@
+""" bench_ann_index.py : QPS and recall@k of the IVF index against brute-force search
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+For each corpus size, synthetic clustered embeddings are indexed by IVFIndex
+(codes memory-mapped in a temporary file, as next to a Deeplake dataset).
+Queries (noisy copies of corpus vectors, then random directions as a worst
+case) are searched by brute force (exact cosine similarity over every vector,
+the reference) and through the index with several ANN_NPROBE values. Candidates of float16 / int8 codes are rescored with
+the float32 vectors, as StoreManager does with Deeplake. Reports build time,
+QPS and recall@k.
+
+Usage : python bench_ann_index.py [sizes] [num_queries] [dim] [dtype]
+        e.g. python bench_ann_index.py 10000,100000,1000000 100 384 float32
+"""
+import os
+import sys
+import time
+import tempfile
+
+import numpy as np
+
+from common import clustered_vectors, timed, report
+from ann import IVFIndex
+
+def brute_force(corpus, query, k):
+    scores = corpus @ query
+    best = np.argpartition(-scores, k)[:k]
+    return best[np.argsort(-scores[best])]
+
+def main():
+    sizes = [int(size) for size in sys.argv[1].split(",")] if len(sys.argv) > 1 else [10000, 100000, 1000000]
+    num_queries = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    dim = int(sys.argv[3]) if len(sys.argv) > 3 else 384
+    dtype = sys.argv[4] if len(sys.argv) > 4 else "float32"
+    k, overfetch = 20, 4
+    for count in sizes:
+        corpus = np.concatenate(list(clustered_vectors(count, dim)))
+        rng = np.random.default_rng(1)
+        query_sets = {
+            # Noise of norm 0.5 around corpus vectors, about the spread of a topic
+            "near_topic": corpus[rng.integers(count, size=num_queries)] + 0.5*rng.standard_normal((num_queries, dim)).astype(np.float32)/np.sqrt(dim),
+            # Random directions : the worst case, neighbours are spread over many lists
+            "random": rng.standard_normal((num_queries, dim)).astype(np.float32),
+        }
+        with tempfile.TemporaryDirectory() as tmp:
+            build_seconds, index = timed(IVFIndex.build, lambda start, stop: corpus[start:stop], count, dtype, path=os.path.join(tmp, f"ivf.{dtype}.npy"))
+            for name, queries in query_sets.items():
+                queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+                start = time.perf_counter()
+                reference = [set(brute_force(corpus, query, k).tolist()) for query in queries]
+                report("ann_index", {"vectors": count, "queries": name, "search": "brute_force", "qps": num_queries / (time.perf_counter() - start), "recall_at_k": 1.0})
+                for nprobe in [1, 4, 8, 16, 32, 64]:
+                    if nprobe > len(index.centroids):
+                        break
+                    start = time.perf_counter()
+                    recall = 0.0
+                    for query, expected in zip(queries, reference):
+                        if dtype == "float32":
+                            rows, scores = index.candidates(query, k, nprobe)
+                        else:
+                            rows, scores = index.candidates(query, k*overfetch, nprobe)
+                            rows = rows[np.argsort(-(corpus[rows] @ query))[:k]]
+                        recall += len(expected & set(rows.tolist())) / k
+                    report("ann_index", {
+                        "vectors": count,
+                        "queries": name,
+                        "search": f"ivf_{dtype}",
+                        "lists": len(index.centroids),
+                        "nprobe": nprobe,
+                        "qps": num_queries / (time.perf_counter() - start),
+                        "recall_at_k": recall / num_queries,
+                        "build_seconds": build_seconds,
+                    })
+            del index
+        del corpus
+
+if __name__ == "__main__":
+    main()
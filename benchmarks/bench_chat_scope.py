@@ -0,0 +1,134 @@
+""" bench_chat_scope.py : time to first token of chat turns, over the whole NEWS index or scoped to selected articles
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Synthetic articles are indexed in a NEWS partition (deterministic embeddings)
+and their metadata written as Toolkit.reindex() does. Conversations of several
+turns go through Toolkit.patchat(), with a streaming fake Ollama server as LLM :
+  - "all_news" : no selection, every turn searches the NEWS index
+  - "scoped_N" : N articles selected, their spans are the context of the whole
+    conversation (ranked against the first question when there are more than
+    CHAT_SCOPE_TOPK of them)
+Reports the time to first token of each turn, and the share of context spans
+coming from the selected articles. Fails if a scoped context holds another article.
+
+Usage : python bench_chat_scope.py [articles] [conversations] [turns] [delay]
+"""
+import os
+import sys
+import time
+import tempfile
+
+import lxml.etree as ET
+from llama_index.llms.ollama import Ollama
+from llama_index.core.memory import ChatMemoryBuffer
+from llama_index.core.schema import MetadataMode
+from llama_index.vector_stores.deeplake import DeepLakeVectorStore
+
+from common import hash_embedding, write_articles, percentile, report
+from fakes import ollama_server, HashEmbedding
+from stores import StoreManager, mark_updated
+from cache import TTLCache
+from metadata import MetadataStore
+from batching import EmbeddingBatcher
+from components import Components
+from partitions import partition_name
+from sessions import SessionPool
+from toolkit import Toolkit, article_document, article_id, xml_fields, xml_extraction_data, ai_generated_prompts
+
+dim = 384
+answer = "D'après les articles, les acteurs se sont réunis à Avignon pour en discuter."
+
+def index_articles(paths, vector_dir, metadata_path):
+    """
+    Store the articles in their NEWS partition and their metadata in the metadata store
+    """
+    metadata = MetadataStore(metadata_path, [field["name"] for field in xml_extraction_data]+list(ai_generated_prompts.keys()))
+    nodes = []
+    for file_path in paths:
+        root = ET.parse(file_path).getroot()
+        doc = article_document(file_path, root)
+        doc.embedding = hash_embedding(doc.get_content(metadata_mode=MetadataMode.EMBED), dim)
+        nodes.append(doc)
+        metadata.put(file_path, xml_fields(root))
+    metadata.save()
+    for start in range(0, len(nodes), 5000):
+        DeepLakeVectorStore(dataset_path=os.path.join(vector_dir, partition_name(nodes[0].metadata)), verbose=False).add(nodes[start:start+5000])
+    mark_updated(vector_dir)
+    return metadata
+
+def chat_toolkit(url, vector_dir, metadata):
+    """
+    Toolkit with only what patchat() needs, searching the NEWS index with deterministic embeddings
+    """
+    toolkit = Toolkit.__new__(Toolkit)
+    toolkit.llm_settings = Ollama(model="fake", base_url=url, request_timeout=60.0)
+    toolkit.chat_top_k, toolkit.chat_scope_top_k, toolkit.span_top_k = 2, 4, 20
+    toolkit.vector_dir = vector_dir
+    toolkit.stores = StoreManager({})
+    toolkit.caches = {"embeddings": TTLCache(1024, 600.0), "hits": TTLCache(1024, 600.0)}
+    toolkit.components = Components()
+    toolkit.components.add("metadata", lambda: metadata)
+    toolkit.components.add("embed_model", lambda: HashEmbedding(dim=dim))
+    toolkit.text_batcher = EmbeddingBatcher(lambda texts: [hash_embedding(text, dim) for text in texts])
+    toolkit.query_batcher = toolkit.text_batcher
+    toolkit.chat_sessions = SessionPool(lambda: ChatMemoryBuffer.from_defaults(token_limit=3000))
+    return toolkit
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    conversations = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    turns = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    delay = float(sys.argv[4]) if len(sys.argv) > 4 else 0.1
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp, ollama_server(delay=delay, content=answer) as server:
+        paths = write_articles(os.path.join(tmp, "news"), count)
+        metadata = index_articles(paths, os.path.join(tmp, "vectors"), os.path.join(tmp, "metadata.json"))
+        toolkit = chat_toolkit(server.url, os.path.join(tmp, "vectors"), metadata)
+        # First search opens the partition handle
+        toolkit.search_store("NEWS", "ouverture")
+        for mode, selected in [("all_news", 0), ("scoped_3", 3), ("scoped_8", 8)]:
+            ttft = {turn: [] for turn in range(turns)}
+            in_selection = []
+            for conversation in range(conversations):
+                doc_ids = [article_id(paths[(conversation*97 + offset*13) % count]) for offset in range(selected)]
+                session_id = f"{mode}-{conversation}"
+                for turn in range(turns):
+                    start = time.perf_counter()
+                    response = toolkit.patchat(f"Que s'est-il passé à Avignon ? (conversation {conversation}, question {turn})", session_id=session_id, doc_ids=doc_ids)
+                    tokens = iter(response.response_gen)
+                    next(tokens)
+                    ttft[turn].append(time.perf_counter() - start)
+                    "".join(str(token) for token in tokens)
+                    sources = [article_id(node.node.metadata["file_path"]) for node in response.source_nodes]
+                    in_selection.append(sum(1 for source in sources if source in doc_ids) / max(1, len(sources)))
+                    if selected > 0 and in_selection[-1] < 1.0:
+                        failed = True
+            for turn in range(turns):
+                report("chat_scope", {
+                    "articles": count,
+                    "mode": mode,
+                    "turn": turn + 1,
+                    "ttft_p50_ms": 1000*percentile(ttft[turn], 50),
+                    "ttft_p95_ms": 1000*percentile(ttft[turn], 95),
+                    "llm_delay_ms": 1000*delay,
+                    "context_in_selection": sum(in_selection) / len(in_selection),
+                })
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
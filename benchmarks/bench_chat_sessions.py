@@ -0,0 +1,162 @@
+""" bench_chat_sessions.py : isolation, bounds and latency of per-session chat engines under concurrent users
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Simulated users chat through Toolkit.patchat() from concurrent threads, each
+user having its own session ID, with a streaming fake Ollama server as LLM
+and a NEWS retrieval returning one fixed passage. Three runs :
+  - "shared" : every user sends the same session ID, as when one memory was
+    shared by all users ; reports how many foreign messages a history holds
+  - "per_session" : one session per user, all kept ; fails if a history holds
+    a message of another user or misses one of its own
+  - "bounded" : many more users than CHAT_SESSIONS_MAX, with a small
+    CHAT_SESSIONS_MAX_BYTES ; fails if the pool goes over its limits
+Reports turns per second and the latency of a whole streamed answer.
+
+Usage : python bench_chat_sessions.py [users] [turns] [threads] [delay]
+"""
+import sys
+import time
+import threading
+
+from llama_index.llms.ollama import Ollama
+from llama_index.core.memory import ChatMemoryBuffer
+from llama_index.core.llms import MessageRole
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores.utils import node_to_metadata_dict
+
+from common import percentile, report
+from fakes import ollama_server
+from sessions import SessionPool
+from toolkit import Toolkit
+
+answer = "Voici les dernières nouvelles : rien de nouveau sous le soleil aujourd'hui."
+passage = "Avignon, le 9 novembre 2024. Le festival annonce sa programmation."
+
+def search_store(index_name, query, date_from=None, date_to=None, k=None, prompt="text"):
+    """
+    Search results of Deeplake format, with one passage (the chat engine does not call the LLM without context)
+    """
+    node = TextNode(text=passage, id_="node-0")
+    return {"score": [0.5], "text": [passage], "metadata": [node_to_metadata_dict(node)], "id": [node.id_]}
+
+def chat_toolkit(url, max_sessions, max_bytes, idle_timeout=1800.0):
+    """
+    Toolkit with only what patchat() needs : the LLM client, the retrieval and a session pool
+    """
+    toolkit = Toolkit.__new__(Toolkit)
+    toolkit.llm_settings = Ollama(model="fake", base_url=url, request_timeout=60.0)
+    toolkit.chat_top_k = 2
+    toolkit.search_store = search_store
+    toolkit.chat_sessions = SessionPool(lambda: ChatMemoryBuffer.from_defaults(token_limit=3000), max_sessions, idle_timeout, max_bytes)
+    return toolkit
+
+def run(toolkit, users, turns, threads, shared=False):
+    """
+    Each thread plays its share of users, one whole conversation after the other
+    """
+    latencies = []
+    lock = threading.Lock()
+
+    def play(first):
+        for user in range(first, users, threads):
+            for turn in range(turns):
+                session_id = "default" if shared else f"user{user}"
+                start = time.perf_counter()
+                response = toolkit.patchat(f"question u{user} t{turn}", session_id=session_id)
+                "".join(str(token) for token in response.response_gen)
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=play, args=(first,)) for first in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start, latencies
+
+def histories(toolkit):
+    """
+    Questions kept in each session (memories are written once answers are streamed)
+    """
+    time.sleep(0.5)
+    with toolkit.chat_sessions.lock:
+        sessions = dict(toolkit.chat_sessions.sessions)
+    return {session_id: [message.content for message in session.memory.get_all() if message.role == MessageRole.USER]
+            for session_id, session in sessions.items()}
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    turns = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    threads = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+    delay = float(sys.argv[4]) if len(sys.argv) > 4 else 0.05
+    failed = False
+    with ollama_server(delay=delay, slots=threads, content=answer) as server:
+        for mode in ["shared", "per_session", "bounded"]:
+            max_sessions, max_bytes = (users // 4, 2*1024) if mode == "bounded" else (users, 64*1024*1024)
+            toolkit = chat_toolkit(server.url, max_sessions, max_bytes)
+            # Pool limits are checked while users chat
+            peaks = {"sessions": 0, "bytes": 0}
+            stop = threading.Event()
+
+            def watch():
+                while not stop.is_set():
+                    stats = toolkit.chat_sessions.stats()
+                    peaks["sessions"] = max(peaks["sessions"], stats["sessions"])
+                    peaks["bytes"] = max(peaks["bytes"], stats["bytes"])
+                    time.sleep(0.01)
+
+            watcher = threading.Thread(target=watch)
+            watcher.start()
+            seconds, latencies = run(toolkit, users, turns, threads, shared=mode == "shared")
+            stop.set()
+            watcher.join()
+            foreign = missing = 0
+            for session_id, questions in histories(toolkit).items():
+                owners = [question.split()[1] for question in questions]
+                if session_id == "default":
+                    foreign += sum(1 for owner in owners if owner != owners[0])
+                    continue
+                foreign += sum(1 for owner in owners if owner != "u" + session_id[4:])
+                if mode == "per_session":
+                    missing += turns - len(questions)
+            stats = toolkit.chat_sessions.stats()
+            if mode != "shared" and (foreign > 0 or missing > 0):
+                failed = True
+            if peaks["sessions"] > max_sessions or peaks["bytes"] > max_bytes:
+                failed = True
+            report("chat_sessions", {
+                "mode": mode,
+                "users": users,
+                "turns": turns,
+                "threads": threads,
+                "turns_per_second": users*turns / seconds,
+                "p50_ms": 1000*percentile(latencies, 50),
+                "p95_ms": 1000*percentile(latencies, 95),
+                "foreign_messages": foreign,
+                "missing_messages": missing,
+                "max_sessions": max_sessions,
+                "peak_sessions": peaks["sessions"],
+                "max_bytes": max_bytes,
+                "peak_bytes": peaks["bytes"],
+                "evicted": stats["evicted"],
+            })
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+""" bench_document_text.py : tokens and index size per article, raw XML vs compact text
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Fixture feeds are parsed by feedparser and written as XML articles exactly as
+Toolkit.write_article() does. The articles are then indexed in a temporary
+Deeplake store twice : as raw XML read by SimpleDirectoryReader (the former
+ingest) and as the compact documents of toolkit.article_document(). Reports
+chunks, embedded tokens and bytes on disk per article.
+
+Usage : python bench_document_text.py [num_feeds] [items_per_feed]
+"""
+import os
+import sys
+import base64
+import tempfile
+
+import feedparser
+import xmltodict
+import lxml.etree as ET
+from llama_index.core import Settings, SimpleDirectoryReader
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import MetadataMode
+from llama_index.vector_stores.deeplake import DeepLakeVectorStore
+
+from common import hash_embedding, report
+from fakes import rss_feed
+from manifest import list_articles
+from toolkit import article_document
+
+def write_feed_articles(document_dir, num_feeds, num_items):
+    """
+    Write the entries of fixture feeds like Toolkit.write_article()
+    """
+    os.makedirs(document_dir, exist_ok=True)
+    for feed_id in range(num_feeds):
+        for post in feedparser.parse(rss_feed(feed_id, num_items)).entries:
+            filename = base64.urlsafe_b64encode(post.id.encode("UTF-8")).decode("UTF-8") + ".xml"
+            with open(os.path.join(document_dir, filename), "w") as file:
+                file.write(xmltodict.unparse({"article": post}, pretty=True))
+
+def index_size(documents, vector_dir, dim):
+    """
+    Chunk, embed and store documents, return (chunks, tokens, bytes on disk)
+    """
+    nodes = SentenceSplitter().get_nodes_from_documents(documents)
+    tokens = 0
+    for node in nodes:
+        text = node.get_content(metadata_mode=MetadataMode.EMBED)
+        tokens += len(Settings.tokenizer(text))
+        node.embedding = hash_embedding(text, dim)
+    DeepLakeVectorStore(dataset_path=vector_dir, overwrite=True, verbose=False).add(nodes)
+    size = sum(os.path.getsize(os.path.join(root, name)) for root, dirs, files in os.walk(vector_dir) for name in files)
+    return len(nodes), tokens, size
+
+def main():
+    num_feeds = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    num_items = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    dim = 384
+    with tempfile.TemporaryDirectory() as tmp:
+        document_dir = os.path.join(tmp, "documents")
+        write_feed_articles(document_dir, num_feeds, num_items)
+        file_paths = list_articles(document_dir)
+        builders = {
+            "raw_xml": lambda: SimpleDirectoryReader(input_files=file_paths, filename_as_id=True).load_data(),
+            "compact": lambda: [article_document(file_path, ET.parse(file_path).getroot()) for file_path in file_paths],
+        }
+        for name, build in builders.items():
+            chunks, tokens, size = index_size(build(), os.path.join(tmp, name), dim)
+            report("document_text", {
+                "documents": name,
+                "articles": len(file_paths),
+                "chunks_per_article": chunks / len(file_paths),
+                "tokens_per_article": tokens / len(file_paths),
+                "index_bytes_per_article": size / len(file_paths),
+            })
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+""" bench_embedding_batching.py : concurrent searches with and without query embedding micro-batching
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Many threads run the search path of Toolkit.search_store() (query embedding
+then k-NN on a shared Deeplake handle), as Flask's threaded server does.
+The embedding model is a local HuggingFace model if a path is given,
+otherwise a small numpy network with the cost profile of a forward pass
+(fixed overhead, then a cost per text).
+
+Usage : python bench_embedding_batching.py [num_threads] [requests_per_thread] [model_path]
+"""
+import sys
+import time
+import tempfile
+import threading
+
+import numpy as np
+
+from common import hash_embedding, percentile, report
+from batching import EmbeddingBatcher
+from stores import StoreManager
+from bench_store_handles import build_store
+
+class NumpyEncoder:
+    """
+    Two dense layers over hashed token features, embedding dimension 64
+    """
+    def __init__(self, hidden=2048):
+        rng = np.random.default_rng(0)
+        self.w1 = rng.standard_normal((4096, hidden)).astype(np.float32)
+        self.w2 = rng.standard_normal((hidden, 64)).astype(np.float32)
+
+    def __call__(self, texts):
+        features = np.zeros((len(texts), 4096), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for token in text.split():
+                features[row, hash(token) % 4096] += 1.0
+        vectors = np.maximum(features @ self.w1, 0) @ self.w2
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-9
+        return vectors.tolist()
+
+def load_test(stores, batcher, num_threads, num_requests, search=True):
+    latencies = []
+    lock = threading.Lock()
+
+    def client(thread_id):
+        for i in range(num_requests):
+            start = time.perf_counter()
+            embedding = batcher.embed(f"requête {thread_id} numéro {i} sur l'actualité")
+            if search:
+                stores.search("NEWS", embedding=embedding, k=20)
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client, args=(t,)) for t in range(num_threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, latencies
+
+def main():
+    num_threads = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    num_requests = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    if len(sys.argv) > 3:
+        from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+        encoder = HuggingFaceEmbedding(model_name=sys.argv[3]).get_text_embedding_batch
+    else:
+        encoder = NumpyEncoder()
+    dim = len(encoder(["dimension"])[0])
+    with tempfile.TemporaryDirectory() as path:
+        build_store(path, 5000, lambda text: hash_embedding(text, dim))
+        stores = StoreManager({"NEWS": path})
+        stores.get("NEWS")
+        # Query embedding alone, then the whole search path (k-NN searches are
+        # serialised on the shared handle, so they bound the throughput)
+        for search in [False, True]:
+            for label, max_batch in [("no_batching", 1), ("batching", 32)]:
+                batcher = EmbeddingBatcher(encoder, max_wait=0.005, max_batch=max_batch)
+                elapsed, latencies = load_test(stores, batcher, num_threads, num_requests, search)
+                report("embedding_batching", {
+                    "mode": label,
+                    "path": "embedding+knn" if search else "embedding",
+                    "num_threads": num_threads,
+                    "requests": len(latencies),
+                    "throughput_rps": len(latencies) / elapsed,
+                    "p50_ms": 1000 * percentile(latencies, 50),
+                    "p95_ms": 1000 * percentile(latencies, 95),
+                    "mean_batch": batcher.stats["texts"] / batcher.stats["batches"] if batcher.stats["batches"] else 1.0,
+                })
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+""" bench_embedding_cache.py : cost of rebuilding an index with the persistent embedding cache
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Rebuilds a temporary Deeplake store from synthetic articles three times, as
+"flask reindex NEWS --full" does, through a CachedEmbedding : a cold build, a
+build of the unchanged corpus (must embed nothing) and a build after a few
+articles were modified. The embedding model is deterministic, with a fixed
+cost per text. The cache is then compacted, and a last build checks that it
+still embeds nothing.
+
+Usage : python bench_embedding_cache.py [num_articles] [num_modified] [embed_ms]
+"""
+import os
+import sys
+import time
+import tempfile
+
+from llama_index.core import SimpleDirectoryReader, VectorStoreIndex, StorageContext
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.vector_stores.deeplake import DeepLakeVectorStore
+
+from common import hash_embedding, write_articles, timed, report
+from manifest import list_articles
+from cache import EmbeddingCache, CachedEmbedding
+
+class SlowHashEmbedding(MockEmbedding):
+    """
+    Deterministic embedding with a fixed cost per text, counting the texts it embeds
+    """
+    calls: int = 0
+    cost: float = 0.0
+
+    def _get_text_embedding(self, text):
+        self.calls += 1
+        time.sleep(self.cost)
+        return hash_embedding(text, self.embed_dim)
+
+def build(document_dir, vector_dir, embed_model):
+    documents = SimpleDirectoryReader(input_files=list_articles(document_dir), filename_as_id=True).load_data()
+    vector_store = DeepLakeVectorStore(dataset_path=vector_dir, overwrite=True, verbose=False)
+    storage_context = StorageContext.from_defaults(vector_store=vector_store)
+    VectorStoreIndex.from_documents(documents, storage_context=storage_context, embed_model=embed_model)
+
+def main():
+    num_articles = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    num_modified = int(sys.argv[2]) if len(sys.argv) > 2 else 25
+    embed_ms = float(sys.argv[3]) if len(sys.argv) > 3 else 5.0
+    with tempfile.TemporaryDirectory() as tmp:
+        document_dir = os.path.join(tmp, "documents")
+        paths = write_articles(document_dir, num_articles)
+        model = SlowHashEmbedding(embed_dim=64, cost=embed_ms / 1000)
+        cache = EmbeddingCache(os.path.join(tmp, "embedding_cache"), "bench-model")
+        for run in ["cold", "unchanged", "modified"]:
+            if run == "modified":
+                for path in paths[:num_modified]:
+                    with open(path, "a") as file:
+                        file.write("<!-- mise à jour -->\n")
+            model.calls = 0
+            cache.hits = cache.misses = 0
+            start = time.time()
+            elapsed, _ = timed(build, document_dir, os.path.join(tmp, "vectors"), CachedEmbedding(model, cache))
+            report("embedding_cache", {
+                "run": run,
+                "num_articles": num_articles,
+                "seconds": elapsed,
+                "texts_embedded": model.calls,
+                **cache.stats(),
+            })
+        # the chunks of the modified articles, as they were before, are obsolete
+        elapsed, compacted = timed(cache.compact, start)
+        report("embedding_cache", {"run": "compact", "seconds": elapsed, "dropped": compacted["dropped"], "bytes_reclaimed": compacted["bytes"], **cache.stats()})
+        # rows have moved : a build after compaction must still embed nothing
+        model.calls = 0
+        build(document_dir, os.path.join(tmp, "vectors"), CachedEmbedding(model, cache))
+        if model.calls > 0:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
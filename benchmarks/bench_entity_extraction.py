@@ -0,0 +1,65 @@
+""" bench_entity_extraction.py : entity extraction throughput, 1 vs N requests in flight
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Requests go through the same LlamaIndex Ollama client as Toolkit, to a local
+fake Ollama server answering canned JSON after a fixed delay, from the workers
+of an "extract" stage of pipeline.Pipeline (as in Toolkit.news_pipeline()).
+
+Usage : python bench_entity_extraction.py [num_docs] [delay] [slots] [inflight,...]
+"""
+import sys
+
+from llama_index.llms.ollama import Ollama
+from llama_index.core.llms import ChatMessage
+
+from common import timed, report
+from fakes import ollama_server
+from extraction import FieldExtractor
+from pipeline import Pipeline, Stage
+from toolkit import ai_generated_prompts
+
+def main():
+    num_docs = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0.1
+    slots = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    inflights = [int(n) for n in sys.argv[4].split(",")] if len(sys.argv) > 4 else [1, 4, 8]
+    with ollama_server(delay=delay, slots=slots) as server:
+        llm = Ollama(model="fake", base_url=server.url, request_timeout=30.0)
+
+        def generate(text, field):
+            # same request as Toolkit.get_ai_generated_field
+            messages = [ChatMessage(role="user", content=ai_generated_prompts[field][1]+text)]
+            return llm.chat(messages).message.content
+
+        jobs = [f"Article {i} : les acteurs se sont réunis à Avignon." for i in range(num_docs)]
+        for inflight in inflights:
+            extractor = FieldExtractor(generate)
+            # One worker per request in flight, as LLM_INFLIGHT in Toolkit.news_pipeline()
+            pipeline = Pipeline([Stage("extract", lambda text: [extractor.extract(text, "entities")], inflight)], report_every=0)
+            elapsed, stats = timed(pipeline.run, {"extract": jobs})
+            report("entity_extraction", {
+                "num_docs": num_docs,
+                "llm_delay_s": delay,
+                "llm_slots": slots,
+                "inflight": inflight,
+                "seconds": elapsed,
+                "docs_per_s": num_docs / elapsed,
+                **extractor.stats,
+            })
+
+if __name__ == "__main__":
+    main()
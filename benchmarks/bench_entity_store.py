@@ -0,0 +1,126 @@
+""" bench_entity_store.py : entity lookups and scans, one text file per entity vs packed store
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Synthetic entity descriptions are written both as the former tree of text
+files (one per entity, in str(ent_id)[:6] directories) and as the packed
+entity store. Checks that Toolkit.expand_query() expands every concept to the
+text of its former file, and that importing the former files gives the same
+store. Then measures concept lookups, a full scan (SimpleDirectoryReader over
+the tree vs reading the store) and bytes on disk.
+
+Usage : python bench_entity_store.py [num_entities] [num_lookups]
+"""
+import os
+import sys
+import random
+import tempfile
+
+from html2text import html2text
+from llama_index.core import SimpleDirectoryReader
+
+from common import percentile, timed, report
+from cache import TTLCache
+from stores import StoreManager
+from entities import EntityStore, concept_id, read_legacy_entities
+from toolkit import Toolkit, entity_document
+
+def entity_descriptions(count):
+    """
+    Entity name -> descriptions, as aggregated by a NEWS reindex
+    """
+    rng = random.Random(0)
+    entity_desc = dict()
+    for i in range(count):
+        name = f"Entité {i} {'ABCDEFGH'[i % 8]}/{i % 13}"
+        entity_desc[name] = "".join(f"<b>{name}</b> citée dans la dépêche {rng.randrange(100000)} &amp; décrite ici.\n" for j in range(1 + i % 4))
+    return entity_desc
+
+def write_legacy_entities(directory, entity_desc):
+    """
+    Former layout : one text file per entity, returns entity name -> file path
+    """
+    paths = dict()
+    ent_id = 0
+    for ent in entity_desc:
+        filename = ent.replace(" ", "_").replace("/", " ")+".txt"
+        path = directory + str(ent_id)[:6].replace("", '/')
+        os.makedirs(path, exist_ok=True)
+        with open(path+filename, "a+") as file:
+            file.write(ent+'\n'+entity_desc[ent])
+        paths[ent] = path+filename
+        ent_id += 1
+    return paths
+
+def legacy_expansion(path):
+    with open(path) as f:
+        content = f.readlines()
+    return html2text(" ".join(content)).replace('\n', ' ')
+
+def disk_usage(paths):
+    return sum(os.stat(path).st_blocks*512 for path in paths)
+
+def main():
+    num_entities = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    num_lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    entity_desc = entity_descriptions(num_entities)
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_dir = os.path.join(tmp, "legacy")
+        elapsed, paths = timed(write_legacy_entities, legacy_dir, entity_desc)
+        report("entity_store", {"layout": "files", "step": "write", "entities": num_entities, "seconds": elapsed})
+        store = EntityStore(os.path.join(tmp, "packed"))
+        elapsed, _ = timed(store.merge, entity_desc)
+        report("entity_store", {"layout": "packed", "step": "write", "entities": len(store), "seconds": elapsed})
+        # Query expansion through the toolkit, against the former files
+        toolkit = Toolkit.__new__(Toolkit)
+        toolkit.entities = store
+        toolkit.caches = {"concepts": TTLCache(0, 0)}
+        toolkit.vector_dir = os.path.join(tmp, "vectors")
+        toolkit.stores = StoreManager({})
+        mismatches = 0
+        for ent_id, text in store.items():
+            name = text.partition("\n")[0]
+            if toolkit.expand_query(f"requête {concept_id(ent_id)}") != "requête " + legacy_expansion(paths[name]):
+                mismatches += 1
+        # Entities collected by former versions are imported unchanged
+        imported = EntityStore(os.path.join(tmp, "imported"))
+        imported.merge(read_legacy_entities(legacy_dir))
+        imported_texts = sorted(text for ent_id, text in imported.items())
+        mismatches += sum(1 for a, b in zip(imported_texts, sorted(text for ent_id, text in store.items())) if a != b)
+        mismatches += abs(len(imported) - len(store))
+        report("entity_store", {"check": "expansion", "entities": len(store), "mismatches": mismatches})
+        # Concept lookups, as done by expand_query()
+        rng = random.Random(1)
+        names = list(entity_desc)
+        ids = [rng.randrange(num_entities) for i in range(num_lookups)]
+        lookups = {
+            "files": lambda ent_id: open(paths[names[ent_id]]).read(),
+            "packed": store.get,
+        }
+        for layout, lookup in lookups.items():
+            latencies = [timed(lookup, ent_id)[0] for ent_id in ids]
+            report("entity_store", {"layout": layout, "step": "lookup", "p50_us": 1e6*percentile(latencies, 50), "p95_us": 1e6*percentile(latencies, 95)})
+        # Full scan, as done by the WIKI reindex
+        elapsed, documents = timed(lambda: SimpleDirectoryReader(legacy_dir, recursive=True).load_data())
+        report("entity_store", {"layout": "files", "step": "scan", "documents": len(documents), "seconds": elapsed, "bytes_on_disk": disk_usage(paths.values())})
+        elapsed, documents = timed(lambda: [entity_document(ent_id, text) for ent_id, text in store.items()])
+        packed_files = [os.path.join(store.path, name) for name in os.listdir(store.path)]
+        report("entity_store", {"layout": "packed", "step": "scan", "documents": len(documents), "seconds": elapsed, "bytes_on_disk": disk_usage(packed_files)})
+        if mismatches > 0:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+""" bench_feed_fetch.py : serial feedparser loop vs concurrent FeedFetcher downloads
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Fixture feeds are served by a local HTTP stand-in that delays every answer.
+Concurrent downloads run in a "fetch" stage of pipeline.Pipeline, as in
+Toolkit.news_pipeline() (FEED_WORKERS workers).
+Note that all feeds share one host (127.0.0.1), so FEED_PER_HOST bounds
+the concurrency here : it is raised to the number of workers by default.
+
+Usage : python bench_feed_fetch.py [num_feeds] [delay] [num_workers] [per_host]
+"""
+import os
+import sys
+import tempfile
+
+import feedparser
+
+from common import timed, report
+from fakes import feed_server
+from fetcher import FeedFetcher
+from pipeline import Pipeline, Stage
+
+def serial(urls):
+    # the loop of Toolkit.reindex before concurrent fetching
+    return sum(len(feedparser.parse(url).entries) for url in urls)
+
+def concurrent(fetcher, urls, num_workers):
+    # the "fetch" stage of Toolkit.news_pipeline(), validators saved after the run
+    counts = []
+    Pipeline([Stage("fetch", lambda url: counts.append(len(fetcher.fetch_one(url))), num_workers)], report_every=0).run({"fetch": urls})
+    fetcher.save()
+    return sum(counts)
+
+def main():
+    num_feeds = int(sys.argv[1]) if len(sys.argv) > 1 else 74
+    delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0.2
+    num_workers = int(sys.argv[3]) if len(sys.argv) > 3 else 16
+    per_host = int(sys.argv[4]) if len(sys.argv) > 4 else num_workers
+    with feed_server(num_feeds, delay=delay) as server, tempfile.TemporaryDirectory() as tmp:
+        urls = server.feed_urls
+        serial_time, serial_entries = timed(serial, urls)
+        fetcher = FeedFetcher(os.path.join(tmp, "feed_state.json"), per_host)
+        first_time, first_entries = timed(concurrent, fetcher, urls, num_workers)
+        # Second poll : every feed should answer "304 Not Modified"
+        fetcher = FeedFetcher(os.path.join(tmp, "feed_state.json"), per_host)
+        second_time, second_entries = timed(concurrent, fetcher, urls, num_workers)
+    report("feed_fetch", {
+        "num_feeds": num_feeds,
+        "delay_s": delay,
+        "num_workers": num_workers,
+        "per_host": per_host,
+        "serial_s": serial_time,
+        "serial_entries": serial_entries,
+        "concurrent_s": first_time,
+        "concurrent_entries": first_entries,
+        "conditional_s": second_time,
+        "conditional_entries": second_entries,
+        "not_modified": fetcher.stats["not_modified"],
+    })
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+""" bench_incremental_reindex.py : embedding work done by successive incremental NEWS reindexes
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Runs the real NEWS reindex (Toolkit.reindex(), as in bench_suite.py : fake
+Ollama server, model-free embeddings) over synthetic articles written in
+DOC_DIR, five times :
+  - "initial" : every article is new
+  - "no_new_articles" : nothing changed, must embed nothing
+  - "feed_poll" : a few new articles
+  - "changed" : a few articles rewritten with a new summary
+  - "full" : full rebuild (reindex --full), every article is selected again
+Reports the articles selected by the manifest (Toolkit.select_news_articles()),
+the articles stored and the texts embedded by the model (embedding cache misses)
+of each run. Fails if a run embeds other articles than the new and changed ones,
+if the NEWS store holds another number of vectors than of articles (the
+vectors of changed articles must be replaced), or if the entity store holds
+other descriptions than those of the AI generated fields on disk (those of
+changed articles and of a full rebuild must be replaced, not appended).
+
+Usage : python bench_incremental_reindex.py [num_articles] [num_new_articles]
+"""
+import os
+import sys
+import tempfile
+
+import deeplake
+
+from common import SRC_DIR, write_articles, timed, report
+from fakes import ollama_server, HashEmbedding
+from bench_suite import load_env, llm_answer
+
+class CountingEmbedding(HashEmbedding):
+    """
+    HashEmbedding counting the texts it is asked to embed
+    """
+    calls: int = 0
+
+    @classmethod
+    def class_name(cls):
+        return "CountingEmbedding"
+
+    def _get_text_embeddings(self, texts):
+        self.calls += len(texts)
+        return [self._get_text_embedding(text) for text in texts]
+
+def stored_articles(metrics):
+    """
+    Articles written to the NEWS store by the last reindex
+    """
+    return sum(value for (metric, labels), value in metrics.counters.items()
+               if metric == "newsrag_ingest_items_total" and dict(labels).get("pipeline") == "news" and dict(labels).get("stage") == "store")
+
+def descriptions(indexer):
+    """
+    Entity descriptions in the entity store, and in the AI generated fields of the articles on disk
+    """
+    from toolkit import sidecar_descriptions
+    from manifest import list_articles
+    stored = sum(text.partition("\n")[2].count("\n") for entity_id, text in indexer.entities.items())
+    return stored, sum(len(desc) for desc in sidecar_descriptions(list_articles(indexer.document_dir)).values())
+
+def main():
+    num_articles = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    num_new = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp, ollama_server(delay=0.0, content=llm_answer) as llm:
+        # "../resources" paths of .env resolve to tmp/resources, no feed is polled
+        os.makedirs(os.path.join(tmp, "resources"))
+        os.makedirs(os.path.join(tmp, "src"))
+        os.chdir(os.path.join(tmp, "src"))
+        open("../resources/newslist.tsv", "w").close()
+        load_env(os.path.join(SRC_DIR, ".env"))
+        os.environ.update({"LLM_URL": llm.url, "URL_LIST": "../resources/newslist.tsv", "DOC_LIMIT": "0",
+                           "MODEL_NAME": "counting-384", "PIPELINE_REPORT_EVERY": "0"})
+        import toolkit
+        from metrics import metrics
+        from partitions import list_partitions
+        from manifest import list_articles
+        embed_model = CountingEmbedding()
+        toolkit.load_embedding_model = lambda *args: embed_model
+        document_dir = os.environ["DOC_DIR"]
+        paths = write_articles(document_dir, num_articles)
+        runs = []
+        for label, added, changed, full in [("initial", 0, 0, False), ("no_new_articles", 0, 0, False), ("feed_poll", num_new, 0, False),
+                                            ("changed", 0, num_new, False), ("full", 0, 0, True)]:
+            paths += write_articles(document_dir, added, start=len(paths))
+            for file_path in paths[:changed]:
+                with open(file_path) as file:
+                    text = file.read()
+                with open(file_path, "w") as file:
+                    file.write(text.replace("<summary>", "<summary>Mise à jour. "))
+            # A new Toolkit for each run, as flask reindex
+            indexer = toolkit.Toolkit(read_only=False, index_name="NEWS")
+            new_files, changed_files = indexer.manifest.select(list_articles(document_dir))
+            selected = len(paths) if full else len(new_files)+len(changed_files)
+            embed_model.calls = 0
+            metrics.counters.clear()
+            elapsed, _ = timed(indexer.reindex, "NEWS", full)
+            stored = stored_articles(metrics)
+            vectors = sum(len(deeplake.load(os.path.join(indexer.vector_dir, name), read_only=True, verbose=False)) for name in list_partitions(indexer.vector_dir))
+            entity_descriptions, sidecars = descriptions(indexer)
+            expected = len(paths) if label in ["initial", "full"] else added+changed
+            if selected != expected or stored != expected or (expected == 0 and embed_model.calls > 0) or vectors != len(paths) \
+               or entity_descriptions != sidecars:
+                failed = True
+            runs.append({"run": label, "articles_selected": selected, "articles_stored": stored,
+                         "texts_embedded": embed_model.calls, "vectors": vectors,
+                         "entity_descriptions": entity_descriptions, "sidecar_descriptions": sidecars, "seconds": elapsed})
+            del indexer
+    report("incremental_reindex", {"runs": runs})
+    if failed:
+        print("Error: a reindex embedded other articles than the new and changed ones, or duplicated entity descriptions", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+""" bench_ingest_pipeline.py : stage-after-stage vs pipelined NEWS ingest
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Runs the stages of Toolkit.news_pipeline() (fetch -> write -> load -> extract
+-> chunk -> embed -> store) against fixture feeds and a fake Ollama server,
+with a deterministic embedding (plus a fixed cost per text) and a temporary
+Deeplake store, first one stage after the other (as reindex used to do), then
+through pipeline.Pipeline. Reports wall time, per-stage throughput and the max
+number of items held between stages (the whole corpus when staged, at most
+one queue size per stage when pipelined).
+
+Usage : python bench_ingest_pipeline.py [num_feeds] [items_per_feed] [llm_delay] [embed_ms]
+"""
+import os
+import sys
+import time
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import lxml.etree as ET
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import MetadataMode
+from llama_index.llms.ollama import Ollama
+from llama_index.core.llms import ChatMessage
+from llama_index.vector_stores.deeplake import DeepLakeVectorStore
+
+from common import hash_embedding, timed, report
+from fakes import feed_server, ollama_server
+from fetcher import FeedFetcher
+from extraction import FieldExtractor
+from pipeline import Pipeline, Stage
+from toolkit import ai_generated_prompts, article_document
+
+def stages(tmp, server_url, embed_ms, inflight):
+    """
+    Stage functions, shaped like those of Toolkit.news_pipeline()
+    """
+    fetcher = FeedFetcher(os.path.join(tmp, "feed_state.json"), per_host=16, timeout=30.0)
+    llm = Ollama(model="fake", base_url=server_url, request_timeout=30.0)
+    extractor = FieldExtractor(
+        lambda text, field: llm.chat([ChatMessage(role="user", content=ai_generated_prompts[field][1]+text)]).message.content,
+    )
+    splitter = SentenceSplitter()
+    vector_store = DeepLakeVectorStore(dataset_path=os.path.join(tmp, "vectors"), overwrite=True, verbose=False)
+    document_dir = os.path.join(tmp, "documents")
+    os.makedirs(document_dir, exist_ok=True)
+    written = [0]
+
+    def write(post):
+        written[0] += 1
+        file_path = os.path.join(document_dir, f"article{written[0]:07d}.xml")
+        with open(file_path, "w") as file:
+            file.write(f"<article><title>{post.title}</title><summary>{post.summary}</summary></article>")
+        return [file_path]
+
+    def load(file_path):
+        root = ET.parse(file_path).getroot()
+        return [(article_document(file_path, root), root)]
+
+    def extract(item):
+        doc, root = item
+        text = "\n".join(root.xpath("//text()"))
+        for field in ai_generated_prompts.keys():
+            extractor.extract(text, field)
+        return [doc]
+
+    def embed(batch):
+        nodes = [node for doc, doc_nodes in batch for node in doc_nodes]
+        # fixed cost per text, without holding the GIL (like a forward pass)
+        time.sleep(embed_ms / 1000 * len(nodes))
+        for node in nodes:
+            node.embedding = hash_embedding(node.get_content(metadata_mode=MetadataMode.EMBED))
+        return batch
+
+    def store(batch):
+        nodes = [node for doc, doc_nodes in batch for node in doc_nodes]
+        if len(nodes) > 0:
+            vector_store.add(nodes)
+        return [doc.doc_id for doc, doc_nodes in batch]
+
+    return [
+        Stage("fetch", fetcher.fetch_one, 16),
+        Stage("write", write, 1),
+        Stage("load", load, 4),
+        Stage("extract", extract, inflight),
+        Stage("chunk", lambda doc: [(doc, splitter.get_nodes_from_documents([doc]))], 4),
+        Stage("embed", embed, 1, 64, 32),
+        Stage("store", store, 1, 64, 32),
+    ]
+
+def staged(stage_list, urls):
+    """
+    Run each stage (with its number of workers) over all items before starting the next one
+    """
+    items, held = urls, 0
+    for stage in stage_list:
+        batches = [items[i:i+stage.batch_size] for i in range(0, len(items), stage.batch_size)]
+        with ThreadPoolExecutor(max_workers=stage.workers) as executor:
+            results = executor.map(lambda batch: stage.function(batch if stage.batch_size > 1 else batch[0]) or [], batches)
+            items = [output for outputs in results for output in outputs]
+        held = max(held, len(items))
+    return len(items), held
+
+def main():
+    num_feeds = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    num_items = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    llm_delay = float(sys.argv[3]) if len(sys.argv) > 3 else 0.02
+    embed_ms = float(sys.argv[4]) if len(sys.argv) > 4 else 2.0
+    inflight = 8
+    with feed_server(num_feeds, num_items, delay=0.2) as feeds, ollama_server(delay=llm_delay, slots=inflight) as llm:
+        with tempfile.TemporaryDirectory() as tmp:
+            elapsed, (stored, held) = timed(staged, stages(os.path.join(tmp, "staged"), llm.url, embed_ms, inflight), feeds.feed_urls)
+            report("ingest_pipeline", {
+                "mode": "staged",
+                "articles": stored,
+                "seconds": elapsed,
+                "articles_per_s": stored / elapsed,
+                "max_items_held": held,
+            })
+        with tempfile.TemporaryDirectory() as tmp:
+            pipeline = Pipeline(stages(tmp, llm.url, embed_ms, inflight), report_every=0)
+            elapsed, stats = timed(pipeline.run, {"fetch": feeds.feed_urls})
+            report("ingest_pipeline", {
+                "mode": "pipelined",
+                "articles": stats["store"]["in"],
+                "seconds": elapsed,
+                "articles_per_s": stats["store"]["in"] / elapsed,
+                "max_items_held": sum(stage["max_depth"] for stage in stats.values()),
+                "stages": {name: {"items_per_s": stage["in"] / elapsed, "busy_s": stage["busy"], "max_queue": stage["max_depth"]} for name, stage in stats.items()},
+            })
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+""" bench_metrics.py : overhead of latency instrumentation, and the stage breakdown of a search
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Measures :
+  - the cost of one timed stage (metrics.timer()) with METRICS enabled, disabled,
+    and with a request trace (TIMING_HEADER), against an empty with block
+  - Toolkit.retrieve() over synthetic indexed articles (deterministic embeddings),
+    METRICS enabled and disabled in turn on the same queries
+  - the time to render /metrics, and the stage breakdown (Server-Timing) of a search
+Fails if the rendered histograms are inconsistent.
+
+Usage : python bench_metrics.py [articles] [queries]
+"""
+import os
+import sys
+import time
+import tempfile
+import contextlib
+
+from common import write_articles, percentile, timed, report
+from bench_chat_scope import index_articles, chat_toolkit
+from cache import TTLCache
+from entities import EntityStore
+from metrics import Metrics, metrics, start_trace, server_timing, current_trace
+
+def stage_cost(registry, calls, trace=False):
+    """
+    Nanoseconds per timed stage
+    """
+    if trace:
+        start_trace()
+    start = time.perf_counter()
+    for call in range(calls):
+        with registry.timer("stage"):
+            pass
+    elapsed = time.perf_counter() - start
+    current_trace.set(None)
+    return 1e9 * elapsed / calls
+
+def consistent(text):
+    """
+    The +Inf bucket of every histogram equals its count
+    """
+    samples = dict(line.rsplit(" ", 1) for line in text.splitlines() if not line.startswith("#"))
+    for name, value in samples.items():
+        if name.endswith("_count"):
+            labels = name[name.index("{"):] if "{" in name else "{}"
+            prefix = name[:name.index("_count")]
+            infinite = prefix + "_bucket" + (labels[:-1] + ',le="+Inf"}' if labels != "{}" else '{le="+Inf"}')
+            if samples.get(infinite) != value:
+                return False
+    return True
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    num_queries = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    calls = 200000
+    start = time.perf_counter()
+    for call in range(calls):
+        with contextlib.nullcontext():
+            pass
+    baseline = 1e9 * (time.perf_counter() - start) / calls
+    for label, registry, trace in [("enabled", Metrics(True), False), ("traced", Metrics(True), True), ("disabled", Metrics(False), False)]:
+        report("metrics", {"measure": "timed_stage", "metrics": label, "ns_per_stage": stage_cost(registry, calls, trace), "empty_with_ns": baseline})
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = write_articles(os.path.join(tmp, "news"), count)
+        metadata = index_articles(paths, os.path.join(tmp, "vectors"), os.path.join(tmp, "metadata.json"))
+        # No chat : the LLM is never called
+        toolkit = chat_toolkit("http://127.0.0.1:1", os.path.join(tmp, "vectors"), metadata)
+        toolkit.caches["concepts"] = TTLCache(1024, 600.0)
+        toolkit.entities = EntityStore(os.path.join(tmp, "entities"))
+        toolkit.search_store("NEWS", "ouverture")
+        latencies = {True: [], False: []}
+        for query in range(num_queries):
+            for enabled in [True, False]:
+                metrics.enabled = enabled
+                elapsed, rows = timed(lambda: list(toolkit.retrieve(f"réunion à Avignon {query} {enabled}")))
+                latencies[enabled].append(elapsed)
+        metrics.enabled = True
+        for enabled in [True, False]:
+            report("metrics", {
+                "measure": "retrieve",
+                "articles": count,
+                "metrics": "enabled" if enabled else "disabled",
+                "p50_ms": 1000 * percentile(latencies[enabled], 50),
+                "p95_ms": 1000 * percentile(latencies[enabled], 95),
+            })
+        start_trace()
+        elapsed, rows = timed(lambda: list(toolkit.retrieve("réunion à Avignon : détail des étapes")))
+        breakdown = server_timing(elapsed)
+        current_trace.set(None)
+        render_seconds, text = timed(metrics.render)
+        report("metrics", {"measure": "render", "series": len([line for line in text.splitlines() if not line.startswith("#")]), "render_ms": 1000 * render_seconds, "server_timing": breakdown})
+        if not consistent(text):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
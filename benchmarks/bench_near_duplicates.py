@@ -0,0 +1,108 @@
+""" bench_near_duplicates.py : LLM and embedding work saved by near-duplicate detection at ingest
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Local fixture feeds (see fakes.rss_feed()) each republish the same wire
+stories, with a closing sentence of their own, besides stories of their own.
+Toolkit.reindex() runs as in bench_suite.py (fake Ollama server, embeddings
+where texts sharing words are close), with DEDUP set to 0 then to 1 :
+  - "first_run" : half of the feeds
+  - "next_run" : every feed, the new ones repeating stories indexed by the first run,
+    with a new Toolkit (fingerprints read from disk)
+Reports the duration of each run, the LLM requests, the articles embedded and
+skipped as near-duplicates, and the share of copies detected. Then, for queries
+made of wire story titles, the number of distinct stories among the 10 first
+search results. Fails if more articles are skipped than there are copies.
+
+Usage : python bench_near_duplicates.py [feeds] [items_per_feed] [wire_stories]
+"""
+import os
+import sys
+import tempfile
+
+from common import SRC_DIR, timed, report
+from fakes import feed_server, ollama_server, WordEmbedding, wire_story
+from bench_suite import load_env, llm_answer
+
+def counter(metrics, name, stage=None):
+    """
+    Value of an ingest counter of the news pipeline
+    """
+    return sum(value for (metric, labels), value in metrics.counters.items()
+               if metric == name and dict(labels).get("pipeline") == "news" and dict(labels).get("stage") == stage)
+
+def main():
+    num_feeds = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    num_items = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    num_wire = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    failed = False
+    with feed_server(num_feeds, num_items, delay=0.0, months=2, sentences=4, wire=num_wire) as feeds, \
+         ollama_server(delay=0.005, slots=8, content=llm_answer) as llm:
+        load_env(os.path.join(SRC_DIR, ".env"))
+        import toolkit
+        from metrics import metrics
+        toolkit.load_embedding_model = lambda *args: WordEmbedding()
+        for dedup in [0, 1]:
+            with tempfile.TemporaryDirectory() as tmp:
+                # "../resources" paths of .env resolve to tmp/resources
+                os.makedirs(os.path.join(tmp, "resources"))
+                os.makedirs(os.path.join(tmp, "src"))
+                os.chdir(os.path.join(tmp, "src"))
+                os.environ.update({"LLM_URL": llm.url, "URL_LIST": "../resources/newslist.tsv", "DOC_LIMIT": "0",
+                                   "MODEL_NAME": "words-384", "PIPELINE_REPORT_EVERY": "0", "DEDUP": str(dedup)})
+                for run, run_feeds in [("first_run", num_feeds // 2), ("next_run", num_feeds)]:
+                    # A new Toolkit for each run, as flask reindex : fingerprints are read from disk
+                    indexer = toolkit.Toolkit(read_only=False, index_name="NEWS")
+                    with open("../resources/newslist.tsv", "w") as file:
+                        file.write("\n".join(feeds.feed_urls[:run_feeds]) + "\n")
+                    requests = llm.counter["requests"]
+                    metrics.counters.clear()
+                    seconds, _ = timed(indexer.reindex, "NEWS")
+                    written = counter(metrics, "newsrag_ingest_items_total", "store")
+                    skipped = counter(metrics, "newsrag_ingest_duplicates_total")
+                    # Copies of wire stories written by this run, first copies excepted
+                    new_feeds = run_feeds if run == "first_run" else run_feeds - num_feeds // 2
+                    copies = num_wire * (new_feeds - (1 if run == "first_run" else 0))
+                    if skipped > copies:
+                        failed = True
+                    report("near_duplicates", {
+                        "dedup": dedup,
+                        "run": run,
+                        "feeds": run_feeds,
+                        "articles": new_feeds * num_items,
+                        "seconds": seconds,
+                        "llm_requests": llm.counter["requests"] - requests,
+                        "articles_embedded": written,
+                        "duplicates_skipped": skipped,
+                        "copies_detected": skipped / copies if dedup and copies else None,
+                    })
+                distinct = []
+                for j in range(num_wire):
+                    result = indexer.search_store("NEWS", wire_story(j)[0], k=40)
+                    articles = list(dict.fromkeys(metadata["file_path"] for metadata in result["metadata"]))[:10]
+                    distinct.append(len({indexer.metadata.get(path)["title"] for path in articles}))
+                report("near_duplicates", {
+                    "dedup": dedup,
+                    "run": "search",
+                    "queries": num_wire,
+                    "distinct_stories_in_top10": sum(distinct) / len(distinct),
+                })
+                del indexer
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+""" bench_onnx_embedding.py : throughput and agreement of the int8 ONNX embedding backend vs the PyTorch model
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+The model is exported by onnx_embedding.export_onnx() (as flask export-onnx
+does), with float32 and with int8 weights. Each backend embeds the same
+synthetic passages (batches) and queries (one at a time) :
+  - "torch" : HuggingFaceEmbedding, the reference
+  - "onnx_float32", "onnx_int8" : OnnxEmbedding with ONNX_THREADS threads
+Reports load time, passages per second, query latency, and the agreement with
+the reference : cosine of the vectors of each text, and overlap of the 10 nearest
+passages of each query. Fails if the mean cosine of the int8 model is below 0.95.
+
+The model is a HF model name or a local directory ; without one, a small
+random BERT model is built locally (no download : only speed ratios and the
+quantization error of the runtime are meaningful then).
+
+Usage : python bench_onnx_embedding.py [model] [passages] [threads]
+"""
+import os
+import sys
+import re
+import tempfile
+
+import numpy as np
+
+from common import percentile, timed, report
+from fakes import topics, places
+
+def passages(count):
+    """
+    Synthetic passages of 20 to 200 words, and queries
+    """
+    texts = []
+    for i in range(count):
+        topic, place = topics[i % len(topics)], places[(i // len(topics)) % len(places)]
+        sentence = f"À {place}, les acteurs de {topic} se sont réunis pour la {i % 7 + 1}e fois cette saison, et ont débattu du budget {2020 + i % 5}."
+        texts.append(" ".join([sentence]*(1 + i % 10)))
+    queries = [f"Que s'est-il passé en {topics[q % len(topics)]} à {places[q % len(places)]} ?" for q in range(max(10, count // 10))]
+    return texts, queries
+
+def small_model(path, texts):
+    """
+    Random BERT sentence-transformers model (mean pooling), with a vocabulary of the texts
+    """
+    import torch
+    from transformers import BertConfig, BertModel, BertTokenizerFast
+    from sentence_transformers import SentenceTransformer, models
+    words = sorted(set(re.findall(r"\w+", " ".join(texts).lower())))
+    transformer_path = os.path.join(path, "transformer")
+    os.makedirs(transformer_path)
+    with open(os.path.join(path, "vocab.txt"), "w") as file:
+        file.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]+words+list("?,.'")) + "\n")
+    BertTokenizerFast(os.path.join(path, "vocab.txt"), strip_accents=False).save_pretrained(transformer_path)
+    torch.manual_seed(0)
+    config = BertConfig(vocab_size=len(words)+9, hidden_size=384, num_hidden_layers=6, num_attention_heads=6, intermediate_size=1536)
+    BertModel(config).save_pretrained(transformer_path)
+    transformer = models.Transformer(transformer_path, max_seq_length=256)
+    model_path = os.path.join(path, "model")
+    SentenceTransformer(modules=[transformer, models.Pooling(384, "mean")]).save(model_path)
+    return model_path
+
+def run(embed_model, texts, queries, batch_size=32):
+    """
+    Passages per second (batched) and query latencies (one at a time), with their vectors
+    """
+    seconds, vectors = timed(lambda: [vector for start in range(0, len(texts), batch_size) for vector in embed_model._embed(texts[start:start+batch_size], prompt_name="text")])
+    latencies, query_vectors = [], []
+    for query in queries:
+        elapsed, vector = timed(embed_model._embed, [query], prompt_name="query")
+        latencies.append(elapsed)
+        query_vectors.append(vector[0])
+    return len(texts) / seconds, latencies, np.array(vectors, dtype=np.float32), np.array(query_vectors, dtype=np.float32)
+
+def neighbours(queries, vectors, k=10):
+    """
+    Indexes of the k nearest passages of each query
+    """
+    return [set(row) for row in np.argsort(-(queries @ vectors.T), axis=1)[:, :k]]
+
+def main():
+    model_name = sys.argv[1] if len(sys.argv) > 1 and sys.argv[1] != "-" else None
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    threads = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    texts, queries = passages(count)
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        if model_name is None:
+            model_name = small_model(os.path.join(tmp, "small"), texts+queries)
+        from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+        from onnx_embedding import OnnxEmbedding, export_onnx, model_files
+        for quantize in [False, True]:
+            export_seconds, config = timed(export_onnx, model_name, os.path.join(tmp, "int8" if quantize else "float32"), quantize)
+        reference = None
+        for backend, load in [
+            ("torch", lambda: HuggingFaceEmbedding(model_name=model_name, trust_remote_code=True, device="cpu")),
+            ("onnx_float32", lambda: OnnxEmbedding(os.path.join(tmp, "float32"), model_name, threads)),
+            ("onnx_int8", lambda: OnnxEmbedding(os.path.join(tmp, "int8"), model_name, threads)),
+        ]:
+            load_seconds, embed_model = timed(load)
+            # First call allocates buffers
+            embed_model._embed(texts[:2], prompt_name="text")
+            rate, latencies, vectors, query_vectors = run(embed_model, texts, queries)
+            result = {
+                "backend": backend,
+                "model": os.path.basename(model_name.rstrip("/")),
+                "dim": config["dim"],
+                "threads": threads if backend != "torch" else "default",
+                "load_seconds": load_seconds,
+                "passages_per_second": rate,
+                "query_p50_ms": 1000 * percentile(latencies, 50),
+                "query_p95_ms": 1000 * percentile(latencies, 95),
+            }
+            if reference is None:
+                reference = (rate, vectors, query_vectors, neighbours(query_vectors, vectors))
+            else:
+                cosines = np.concatenate([(vectors * reference[1]).sum(axis=1), (query_vectors * reference[2]).sum(axis=1)])
+                overlap = [len(mine & theirs) / len(mine) for mine, theirs in zip(neighbours(query_vectors, vectors), reference[3])]
+                result.update({
+                    "speedup": rate / reference[0],
+                    "cosine_mean": float(cosines.mean()),
+                    "cosine_min": float(cosines.min()),
+                    "top10_overlap": float(np.mean(overlap)),
+                })
+                if backend == "onnx_int8" and result["cosine_mean"] < 0.95:
+                    failed = True
+            if backend == "onnx_int8":
+                result["model_mb"] = os.path.getsize(os.path.join(tmp, "int8", model_files[True])) / 1e6
+            report("onnx_embedding", result)
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+""" bench_partitions.py : search latency as history grows, with time-partitioned NEWS stores
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Adds one month of synthetic articles at a time to monthly partitions (as
+Toolkit.reindex() writes them, with deterministic embeddings), and measures
+search_partitions() latency over the whole history and over the last 7 days.
+Fails if a date-restricted search returns an article out of its range.
+
+Usage : python bench_partitions.py [articles_per_month] [months] [queries]
+"""
+import os
+import sys
+import tempfile
+
+import lxml.etree as ET
+from llama_index.core.schema import MetadataMode
+from llama_index.vector_stores.deeplake import DeepLakeVectorStore
+
+from common import hash_embedding, article_xml, percentile, timed, report
+from stores import StoreManager, mark_updated
+from partitions import partition_name, search_partitions, in_range
+from toolkit import article_document
+
+def add_month(vector_dir, year, month, count, start, dim):
+    nodes = []
+    for i in range(start, start + count):
+        doc = article_document(f"article{i:07d}.xml", ET.fromstring(article_xml(i, year, month).encode("utf8")))
+        doc.embedding = hash_embedding(doc.get_content(metadata_mode=MetadataMode.EMBED), dim)
+        nodes.append(doc)
+    name = partition_name(nodes[0].metadata)
+    DeepLakeVectorStore(dataset_path=os.path.join(vector_dir, name), verbose=False).add(nodes)
+    mark_updated(vector_dir)
+
+def main():
+    per_month = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    months = int(sys.argv[2]) if len(sys.argv) > 2 else 24
+    num_queries = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    dim, k = 384, 20
+    queries = [hash_embedding(f"requête {q}", dim) for q in range(num_queries)]
+    with tempfile.TemporaryDirectory() as tmp:
+        stores = StoreManager({})
+        for m in range(months):
+            year, month = 2023 + m // 12, 1 + m % 12
+            add_month(tmp, year, month, per_month, m * per_month, dim)
+            # last 7 days of the history (fixture articles are published on days 1 to 28)
+            ranges = {"all": (None, None), "last_7_days": (f"{year:04d}-{month:02d}-22", f"{year:04d}-{month:02d}-28")}
+            if (m + 1) not in [1, 3, 6, 12, 24, 48] and m + 1 != months:
+                continue
+            stores.check("NEWS", tmp)
+            for label, (date_from, date_to) in ranges.items():
+                latencies = []
+                for query in queries:
+                    elapsed, result = timed(search_partitions, stores, "NEWS", tmp, query, k, date_from, date_to)
+                    latencies.append(elapsed)
+                    if not all(in_range(metadata, date_from, date_to) for metadata in result["metadata"]):
+                        sys.exit(1)
+                report("partitions", {
+                    "months": m + 1,
+                    "articles": (m + 1) * per_month,
+                    "range": label,
+                    "p50_ms": 1000 * percentile(latencies[1:], 50),
+                    "p95_ms": 1000 * percentile(latencies[1:], 95),
+                    "results": len(result["score"]),
+                })
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+""" bench_prune.py : space reclaimed by flask prune, and its duration vs a full reindex
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Local fixture feeds (see fakes.rss_feed()) publish articles over 3 months, up
+to November 9th 2024. They are indexed by Toolkit.reindex() as in bench_suite.py
+(fake Ollama server, model-free embeddings), NEWS then WIKI. Toolkit.prune()
+then keeps the articles published since October 1st 2024, i.e. the last two
+months. Reports the duration of the prune, the articles, vectors, entity
+descriptions and bytes (documents, NEWS partitions, WIKI store) reclaimed, then
+the duration of an incremental reindex and of a full NEWS rebuild of the kept
+articles (what a prune avoids ; the LLM answers and embeddings are then cached).
+Fails if an expired article is still searchable or written again by the
+incremental reindex, if the vectors left differ from those of the full
+rebuild, if an entity keeps descriptions of expired articles, if the
+concepts of the WIKI store differ from those of a full WIKI rebuild, or if
+the prune overwrites the stage timings of the last reindex (METRICS_FILE).
+
+Usage : python bench_prune.py [feeds] [items_per_feed]
+"""
+import os
+import sys
+import datetime
+import tempfile
+
+import deeplake
+
+from common import SRC_DIR, timed, report
+from fakes import feed_server, ollama_server, HashEmbedding
+from bench_suite import load_env, llm_answer
+
+# First publication day kept
+cutoff = "2024-10-01"
+
+def store_sizes(indexer):
+    """
+    Bytes of each store, vectors of the NEWS partitions
+    """
+    from partitions import list_partitions, directory_bytes
+    vectors = sum(len(deeplake.load(os.path.join(indexer.vector_dir, name), read_only=True, verbose=False))
+                  for name in list_partitions(indexer.vector_dir))
+    return {
+        "document_bytes": directory_bytes(indexer.document_dir),
+        "vector_bytes": directory_bytes(indexer.vector_dir),
+        "wiki_bytes": directory_bytes(indexer.ent_vector_dir),
+        "vectors": vectors,
+    }
+
+def concepts(indexer):
+    """
+    Texts of the WIKI store, by entity ID
+    """
+    dataset = deeplake.load(indexer.ent_vector_dir, read_only=True, verbose=False)
+    return sorted((metadata["entity_id"], text) for metadata, text in zip(dataset["metadata"].data()["value"], dataset["text"].data()["value"]))
+
+def sidecar_descriptions(indexer):
+    """
+    Number of descriptions of each entity, counted in the AI generated fields of the articles on disk
+    """
+    from manifest import list_articles
+    from toolkit import sidecar_descriptions
+    return {name: len(desc) for name, desc in sidecar_descriptions(list_articles(indexer.document_dir)).items()}
+
+def main():
+    num_feeds = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    num_items = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp, \
+         feed_server(num_feeds, num_items, delay=0.0, months=3, sentences=4) as feeds, \
+         ollama_server(delay=0.005, slots=8, content=llm_answer) as llm:
+        # "../resources" paths of .env resolve to tmp/resources
+        os.makedirs(os.path.join(tmp, "resources"))
+        os.makedirs(os.path.join(tmp, "src"))
+        os.chdir(os.path.join(tmp, "src"))
+        with open("../resources/newslist.tsv", "w") as file:
+            file.write("\n".join(feeds.feed_urls) + "\n")
+        load_env(os.path.join(SRC_DIR, ".env"))
+        # Number of days from the cutoff to today, as flask prune --days
+        days = (datetime.datetime.now(datetime.timezone.utc).date() - datetime.date.fromisoformat(cutoff)).days + 1
+        os.environ.update({"LLM_URL": llm.url, "URL_LIST": "../resources/newslist.tsv", "DOC_LIMIT": "0",
+                           "MODEL_NAME": "hash-384", "PIPELINE_REPORT_EVERY": "0", "RETENTION_DAYS": "0"})
+        import toolkit
+        toolkit.load_embedding_model = lambda *args: HashEmbedding()
+        indexer = toolkit.Toolkit(read_only=False, index_name="BOTH")
+        indexer.reindex("NEWS", full=True)
+        indexer.reindex("WIKI")
+        articles = len(indexer.manifest.entries)
+        before = store_sizes(indexer)
+        with open(indexer.metrics_file) as file:
+            reindex_metrics = file.read()
+        # Expired articles are not written again by the next reindexes either
+        os.environ["RETENTION_DAYS"] = str(days)
+        indexer = toolkit.Toolkit(read_only=False, index_name="BOTH")
+        seconds, stats = timed(indexer.prune)
+        after = store_sizes(indexer)
+        report("prune", {
+            "articles": articles,
+            "run": "prune",
+            "seconds": seconds,
+            "articles_deleted": stats["articles"],
+            "vectors_deleted": stats["vectors"],
+            "entities_updated": stats["entities"],
+            "descriptions_removed": stats["descriptions"],
+            "document_bytes_reclaimed": before["document_bytes"] - after["document_bytes"],
+            "vector_bytes_reclaimed": before["vector_bytes"] - after["vector_bytes"],
+            "wiki_bytes_reclaimed": before["wiki_bytes"] - after["wiki_bytes"],
+            "vectors_left": after["vectors"],
+        })
+        if before["vectors"] - after["vectors"] != stats["vectors"] or stats["articles"] == 0:
+            failed = True
+        with open(indexer.metrics_file) as file:
+            if file.read() != reindex_metrics:
+                failed = True
+        # Only the updated concepts are indexed again, as a full WIKI rebuild would
+        pruned_concepts = concepts(indexer)
+        indexer.reindex("WIKI")
+        if concepts(indexer) != pruned_concepts:
+            failed = True
+        # Entities keep the descriptions of the articles left only
+        counts = sidecar_descriptions(indexer)
+        for entity_id, text in indexer.entities.items():
+            name, _, desc = text.partition("\n")
+            if len(name) <= 46 and desc.count("\n") != counts.get(name, 0):
+                failed = True
+        # No expired article is found, nor written again from the feeds
+        result = indexer.search_store("NEWS", "culture", k=100)
+        dates = [f"{int(metadata['year']):04d}-{int(metadata['month']):02d}-{int(metadata['day']):02d}" for metadata in result["metadata"]]
+        if len(dates) == 0 or min(dates) < cutoff:
+            failed = True
+        seconds, _ = timed(indexer.reindex, "NEWS")
+        if len(indexer.manifest.entries) != articles - stats["articles"]:
+            failed = True
+        report("prune", {"articles": articles, "run": "reindex_incremental", "seconds": seconds,
+                         "articles_indexed": len(indexer.manifest.entries)})
+        # What the prune avoids : rebuilding the store from the articles left
+        seconds, _ = timed(indexer.reindex, "NEWS", full=True)
+        report("prune", {"articles": articles, "run": "reindex_full", "seconds": seconds,
+                         "vectors": store_sizes(indexer)["vectors"]})
+        if store_sizes(indexer)["vectors"] != after["vectors"]:
+            failed = True
+        del indexer
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+""" bench_search_render.py : rendering time of a /search result page, XML parsing vs metadata table
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Only the rendering part of Toolkit.retrieve() is measured (no k-NN search).
+
+Usage : python bench_search_render.py [num_articles] [top_k] [num_pages]
+"""
+import os
+import sys
+import random
+import tempfile
+
+from json2html import json2html
+
+from common import write_articles, percentile, timed, report
+from metadata import MetadataStore
+from toolkit import xml_extraction_data, ai_generated_prompts, article_metadata, result_table_header, result_table_row
+
+def render(docs, lookup):
+    output = result_table_header()
+    for doc in docs:
+        values = lookup(doc)
+        if values is not None:
+            output += result_table_row(doc, values)
+    return output + "</table>\n"
+
+def main():
+    num_articles = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    top_k = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    num_pages = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = write_articles(os.path.join(tmp, "documents"), num_articles)
+        entities = {"entités": [{"Nom": f"Entité {i}", "Description": f"Description de l'entité {i}."} for i in range(8)]}
+        for path in paths:
+            for field in ai_generated_prompts.keys():
+                with open(os.path.splitext(path)[0]+"."+field+".html", "w") as file:
+                    file.write(json2html.convert(json=entities))
+        # Ingest time : build the table
+        store = MetadataStore(os.path.join(tmp, "metadata.json"), [field["name"] for field in xml_extraction_data]+list(ai_generated_prompts.keys()))
+        build_time, _ = timed(lambda: [store.put(path, article_metadata(path)) for path in paths])
+        store.save()
+        # Serve time : a fresh process loads it once
+        load_time, store = timed(MetadataStore, store.path, store.columns)
+        random.seed(0)
+        pages = [random.sample(paths, top_k) for _ in range(num_pages)]
+        xml_times = [timed(render, docs, article_metadata)[0] for docs in pages]
+        table_times = [timed(render, docs, store.get)[0] for docs in pages]
+        assert render(pages[0], article_metadata) == render(pages[0], store.get)
+    report("search_render", {
+        "num_articles": num_articles,
+        "top_k": top_k,
+        "table_build_s": build_time,
+        "table_load_s": load_time,
+        "xml_p50_ms": 1000 * percentile(xml_times, 50),
+        "xml_p95_ms": 1000 * percentile(xml_times, 95),
+        "table_p50_ms": 1000 * percentile(table_times, 50),
+        "table_p95_ms": 1000 * percentile(table_times, 95),
+    })
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+""" bench_store_handles.py : cold-open vs warm-handle Deeplake search latency
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Usage : python bench_store_handles.py [num_spans] [num_queries]
+"""
+import sys
+import tempfile
+
+import deeplake
+
+from common import hash_embedding, percentile, timed, report
+from stores import StoreManager
+
+def build_store(path, num_spans, embedding_function=hash_embedding):
+    store = deeplake.core.vectorstore.deeplake_vectorstore.DeepLakeVectorStore(path=path, overwrite=True, verbose=False)
+    texts = [f"span {i} about topic {i % 97}" for i in range(num_spans)]
+    store.add(
+        text=texts,
+        embedding=[embedding_function(t) for t in texts],
+        metadata=[{"file_path": f"doc{i // 4}.xml"} for i in range(num_spans)],
+    )
+
+def main():
+    num_spans = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    num_queries = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    queries = [f"query number {i}" for i in range(num_queries)]
+    with tempfile.TemporaryDirectory() as path:
+        build_store(path, num_spans)
+        stores = StoreManager({"NEWS": path})
+        cold = []
+        for query in queries:
+            elapsed, _ = timed(lambda: stores.open("NEWS").search(embedding_data=query, embedding_function=hash_embedding, k=20))
+            cold.append(elapsed)
+        # First warm call opens the handle once
+        stores.search("NEWS", embedding_data="warm-up", embedding_function=hash_embedding, k=20)
+        warm = []
+        for query in queries:
+            elapsed, _ = timed(stores.search, "NEWS", embedding_data=query, embedding_function=hash_embedding, k=20)
+            warm.append(elapsed)
+    report("store_handles", {
+        "num_spans": num_spans,
+        "num_queries": num_queries,
+        "cold_p50_ms": 1000 * percentile(cold, 50),
+        "cold_p95_ms": 1000 * percentile(cold, 95),
+        "warm_p50_ms": 1000 * percentile(warm, 50),
+        "warm_p95_ms": 1000 * percentile(warm, 95),
+    })
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+""" bench_suite.py : offline end-to-end benchmark of indexing and of the web server
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Runs the real Toolkit and Flask application with no network access :
+  - the settings of src/.env, with every "../resources" path moved to a
+    temporary directory, LLM_URL pointing to a local fake Ollama server
+    (entities derived from each article, streamed chat answers) and URL_LIST
+    to local fixture RSS feeds
+  - embeddings computed by a deterministic, model-free stand-in of
+    HuggingFaceEmbedding (no download ; the cost of a real model is not measured)
+Measures a full NEWS reindex, the WIKI reindex and an incremental NEWS reindex
+(articles per second), the server startup in a new process (import time, time
+to first request, time until /ready reports every component loaded), then
+/search, /extend, /upload and /answer (time to first token) through the Flask
+test client, and the mean duration of each search stage (see metrics.py).
+
+Results are JSON lines tagged with the current git commit, also appended to
+an output file when given, to compare commits.
+
+Usage : python bench_suite.py [feeds] [items_per_feed] [queries] [output.jsonl]
+"""
+import io
+import os
+import re
+import sys
+import json
+import time
+import tempfile
+import subprocess
+
+from common import SRC_DIR, percentile, timed, report
+from fakes import feed_server, ollama_server, HashEmbedding, topics, places
+
+def load_env(path):
+    """
+    Settings of a .env file ("export NAME = value" lines) into os.environ
+    """
+    with open(path) as file:
+        for line in file:
+            match = re.match(r"^\s*export\s+(\w+)\s*=\s*(.*?)\s*$", line)
+            if match:
+                os.environ[match.group(1)] = match.group(2).strip('"')
+
+def llm_answer(request):
+    """
+    Fake LLM : entities of the extraction prompts (the place and topic of each
+    article), a fixed sentence for chat requests
+    """
+    if request.get("stream", True):
+        return "Selon les articles sélectionnés, les acteurs se sont réunis plusieurs fois cette saison pour en débattre."
+    text = request["messages"][-1]["content"]
+    entities = []
+    for name in sorted(set(re.findall(r"Dépêche ([0-9]+-[0-9]+)", text)))[:1]:
+        entities.append({"Nom": f"Dépêche {name}", "Description": f"Dépêche numéro {name}."})
+    for word in places + topics:
+        if word in text:
+            entities.append({"Nom": word.capitalize(), "Description": f"{word.capitalize()}, cité dans l'actualité."})
+    return "```json\n" + json.dumps({"entités": entities}, ensure_ascii=False) + "\n```"
+
+# Run in a new Python process : times of a server start
+startup_script = """
+import json, time
+start = time.perf_counter()
+import toolkit
+from fakes import HashEmbedding
+toolkit.load_embedding_model = lambda *args: HashEmbedding()
+import app
+imported = time.perf_counter()
+client = app.app.test_client()
+client.get("/").get_data()
+first_request = time.perf_counter()
+while client.get("/ready").status_code != 200:
+    time.sleep(0.01)
+ready = time.perf_counter()
+print(json.dumps({"import_seconds": imported-start, "first_request_seconds": first_request-start, "ready_seconds": ready-start}))
+"""
+
+def startup():
+    """
+    Import time of the web server, time to its first response and until it is
+    ready, in seconds from the start of a new process
+    """
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join([SRC_DIR, os.path.dirname(os.path.abspath(__file__))])}
+    output = subprocess.run([sys.executable, "-c", startup_script], env=env, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def commit():
+    """
+    Current git commit of the repository, "unknown" outside of a git checkout
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SRC_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def timings(client, requests):
+    """
+    Status codes and latencies (whole response) of GET or POST requests
+    """
+    latencies, statuses = [], set()
+    for method, url, data in requests:
+        start = time.perf_counter()
+        if method == "POST":
+            response = client.post(url, data=data(), content_type="multipart/form-data")
+        else:
+            response = client.get(url)
+        response.get_data()
+        latencies.append(time.perf_counter() - start)
+        statuses.add(response.status_code)
+        response.close()
+    return latencies, sorted(statuses)
+
+def first_tokens(client, questions):
+    """
+    Time to first token and whole answer of /answer requests (server-sent events)
+    """
+    ttft, totals = [], []
+    for session, question in enumerate(questions):
+        start = time.perf_counter()
+        response = client.get(f"/answer?query={question}&session=bench{session}", buffered=False)
+        first = None
+        for chunk in response.response:
+            chunk = chunk.decode("utf8") if isinstance(chunk, bytes) else chunk
+            if first is None and chunk.startswith("data: ") and chunk.strip() not in ["data: open", "data: close"]:
+                first = time.perf_counter() - start
+        totals.append(time.perf_counter() - start)
+        ttft.append(first if first is not None else totals[-1])
+        response.close()
+    return ttft, totals
+
+def main():
+    num_feeds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    num_items = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    num_queries = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    output = sys.argv[4] if len(sys.argv) > 4 else None
+    tags = {"commit": commit(), "feeds": num_feeds, "items_per_feed": num_items}
+    results = []
+
+    def record(measure, values):
+        values = {**tags, "measure": measure, **values}
+        report("suite", values)
+        results.append({"benchmark": "suite", **values})
+
+    with tempfile.TemporaryDirectory() as tmp, \
+         feed_server(num_feeds, num_items, delay=0.0, months=3, sentences=4) as feeds, \
+         ollama_server(delay=0.005, slots=8, content=llm_answer) as llm:
+        # "../resources" paths of .env resolve to tmp/resources
+        os.makedirs(os.path.join(tmp, "resources"))
+        os.makedirs(os.path.join(tmp, "src"))
+        os.chdir(os.path.join(tmp, "src"))
+        with open("../resources/newslist.tsv", "w") as file:
+            file.write("\n".join(feeds.feed_urls) + "\n")
+        load_env(os.path.join(SRC_DIR, ".env"))
+        os.environ.update({"LLM_URL": llm.url, "URL_LIST": "../resources/newslist.tsv", "DOC_LIMIT": "0",
+                           "MODEL_NAME": "hash-384", "PIPELINE_REPORT_EVERY": "0"})
+        import toolkit
+        toolkit.load_embedding_model = lambda *args: HashEmbedding()
+        indexer = toolkit.Toolkit(read_only=False, index_name="BOTH")
+        articles = num_feeds * num_items
+        seconds, _ = timed(indexer.reindex, "NEWS", full=True)
+        record("reindex_news_full", {"articles": articles, "seconds": seconds, "articles_per_second": articles / seconds, "llm_requests": llm.counter["requests"]})
+        seconds, _ = timed(indexer.reindex, "WIKI")
+        record("reindex_wiki", {"entities": len(indexer.entities), "seconds": seconds, "entities_per_second": len(indexer.entities) / seconds})
+        seconds, _ = timed(indexer.reindex, "NEWS")
+        record("reindex_news_incremental", {"articles": articles, "seconds": seconds})
+        del indexer
+
+        # The web server, as started by flask run
+        record("server_startup", startup())
+        app = __import__("app")
+        client = app.app.test_client()
+        queries = [f"{topics[q % len(topics)]} à {places[(q // len(topics)) % len(places)]} {q}" for q in range(num_queries)]
+        upload = lambda: {"file": (io.BytesIO("Les acteurs de la culture se sont réunis à Avignon.".encode("utf8")), "article.txt")}
+        requests = {
+            "search": [("GET", f"/search?query={query}", None) for query in queries],
+            "search_cached": [("GET", f"/search?query={queries[0]}", None) for query in queries],
+            "search_last_month": [("GET", f"/search?query={query}&from=2024-10-10&to=2024-11-09", None) for query in queries],
+            "extend": [("GET", f"/extend?query={query}", None) for query in queries],
+            "upload": [("POST", "/upload", upload) for query in queries],
+        }
+        for route, route_requests in requests.items():
+            latencies, statuses = timings(client, route_requests)
+            record(route, {"requests": len(latencies), "status": statuses, "p50_ms": 1000 * percentile(latencies, 50), "p95_ms": 1000 * percentile(latencies, 95)})
+        ttft, totals = first_tokens(client, queries)
+        record("answer", {"requests": len(ttft), "ttft_p50_ms": 1000 * percentile(ttft, 50), "ttft_p95_ms": 1000 * percentile(ttft, 95), "p50_ms": 1000 * percentile(totals, 50)})
+        # Mean duration of search stages, from the metrics of the server
+        stages = {}
+        for (name, labels), histogram in app.metrics.histograms.items():
+            if name == "newsrag_stage_seconds" and histogram.count > 0:
+                stages[dict(labels)["stage"]] = 1000 * histogram.sum / histogram.count
+        record("stages", {"mean_ms": stages})
+    if output is not None:
+        with open(output, "a") as file:
+            for result in results:
+                file.write(json.dumps(result) + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+""" bench_upload_similarity.py : latency of the document similarity search (/upload) as a function of the upload size
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Synthetic articles are indexed in a NEWS partition, with a model-free
+bag-of-words embedding (sum of one random vector per word), so that texts
+sharing words are close. Uploads of growing size are made of the texts of
+indexed articles, and searched by Toolkit.retrieve_similar() :
+  - "whole_text" : the whole upload embedded as one query (the former behaviour)
+  - "max", "mean", "rrf" : the upload split into chunks (at most
+    UPLOAD_MAX_CHUNKS), searched together, span scores aggregated per article
+Reports the latency of the whole response, the number of chunks searched, the
+share of the 10 first articles that are part of the upload, and the k-NN time of
+the chunks searched together vs one at a time. Fails if both searches differ.
+
+Usage : python bench_upload_similarity.py [articles] [sizes_kb] [max_chunks]
+"""
+import os
+import sys
+import time
+import tempfile
+
+import lxml.etree as ET
+from llama_index.core import Settings
+from llama_index.core.schema import MetadataMode
+from llama_index.vector_stores.deeplake import DeepLakeVectorStore
+
+from common import word_embedding, write_articles, percentile, timed, report
+from fakes import WordEmbedding
+from stores import StoreManager, mark_updated
+from metadata import MetadataStore
+from components import Components
+from partitions import partition_name, search_partitions, search_partitions_batch
+from similarity import text_chunks
+from toolkit import Toolkit, article_document, article_id, xml_fields, xml_extraction_data, ai_generated_prompts
+
+dim = 384
+repeats = 3
+
+def index_articles(paths, vector_dir, metadata_path):
+    """
+    Store the articles in their NEWS partition and their metadata in the metadata store,
+    returning the text of each article
+    """
+    metadata = MetadataStore(metadata_path, [field["name"] for field in xml_extraction_data]+list(ai_generated_prompts.keys()))
+    nodes, texts = [], []
+    for file_path in paths:
+        root = ET.parse(file_path).getroot()
+        doc = article_document(file_path, root)
+        texts.append(doc.get_content(metadata_mode=MetadataMode.EMBED))
+        doc.embedding = word_embedding(texts[-1], dim)
+        nodes.append(doc)
+        metadata.put(file_path, xml_fields(root))
+    metadata.save()
+    for start in range(0, len(nodes), 5000):
+        DeepLakeVectorStore(dataset_path=os.path.join(vector_dir, partition_name(nodes[0].metadata)), verbose=False).add(nodes[start:start+5000])
+    mark_updated(vector_dir)
+    return metadata, texts
+
+def upload_toolkit(vector_dir, metadata, max_chunks):
+    """
+    Toolkit with only what retrieve_similar() needs
+    """
+    toolkit = Toolkit.__new__(Toolkit)
+    toolkit.vector_dir = vector_dir
+    toolkit.span_top_k, toolkit.embed_batch_size, toolkit.upload_max_chunks = 20, 32, max_chunks
+    toolkit.stores = StoreManager({})
+    toolkit.components = Components()
+    toolkit.components.add("metadata", lambda: metadata)
+    toolkit.components.add("embed_model", lambda: WordEmbedding(dim=dim))
+    return toolkit
+
+def upload(texts, size):
+    """
+    Texts of consecutive articles, up to size characters, and the articles used
+    """
+    parts, length, i = [], 0, 0
+    while length < size:
+        parts.append(texts[(i*37) % len(texts)])
+        length += len(parts[-1])+2
+        i += 1
+    return "\n\n".join(parts)[:size], set((j*37) % len(texts) for j in range(i))
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    sizes = [int(size) for size in sys.argv[2].split(",")] if len(sys.argv) > 2 else [1, 10, 100, 1000]
+    max_chunks = int(sys.argv[3]) if len(sys.argv) > 3 else 64
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = write_articles(os.path.join(tmp, "news"), count)
+        vector_dir = os.path.join(tmp, "vectors")
+        metadata, texts = index_articles(paths, vector_dir, os.path.join(tmp, "metadata.json"))
+        toolkit = upload_toolkit(vector_dir, metadata, max_chunks)
+        # First search opens the partition handle
+        search_partitions(toolkit.stores, "NEWS", vector_dir, word_embedding("ouverture", dim), 20)
+        for size in sizes:
+            text, used = upload(texts, 1024*size)
+            blocks = [text[start:start+65536] for start in range(0, len(text), 65536)]
+            chunks = list(text_chunks(blocks, Settings.transformations, max_chunks))
+            embeddings = toolkit.embed_model.get_text_embedding_batch(chunks)
+            loop_seconds, loop = timed(lambda: [search_partitions(toolkit.stores, "NEWS", vector_dir, embedding, 20) for embedding in embeddings])
+            batch_seconds, batch = timed(search_partitions_batch, toolkit.stores, "NEWS", vector_dir, embeddings, 20)
+            if [result["id"] for result in loop] != [result["id"] for result in batch]:
+                failed = True
+            for method in ["whole_text", "max", "mean", "rrf"]:
+                latencies = []
+                for repeat in range(repeats):
+                    start = time.perf_counter()
+                    if method == "whole_text":
+                        result = search_partitions(toolkit.stores, "NEWS", vector_dir, toolkit.embed_model.get_text_embedding(text), 20)
+                        output = "".join(toolkit.result_rows(dict.fromkeys(metadata["file_path"] for metadata in result["metadata"])))
+                    else:
+                        toolkit.upload_aggregation = method
+                        output = "".join(toolkit.retrieve_similar(iter(blocks)))
+                    latencies.append(time.perf_counter()-start)
+                ranked = [line.split('id="')[1].split('"')[0] for line in output.splitlines() if 'id="' in line][:10]
+                ids = {article_id(paths[offset]): offset for offset in used}
+                report("upload_similarity", {
+                    "articles": count,
+                    "upload_kb": size,
+                    "method": method,
+                    "chunks": 1 if method == "whole_text" else len(chunks),
+                    "p50_ms": 1000*percentile(latencies, 50),
+                    "top10_in_upload": sum(1 for id in ranked if id in ids) / max(1, len(ranked)),
+                    "knn_one_at_a_time_ms": 1000*loop_seconds if method != "whole_text" else None,
+                    "knn_together_ms": 1000*batch_seconds if method != "whole_text" else None,
+                })
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
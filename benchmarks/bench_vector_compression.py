@@ -0,0 +1,102 @@
+""" bench_vector_compression.py : recall@k, latency and memory of float16 / int8 search with exact rescoring
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+A synthetic corpus of clustered embeddings is stored in a temporary Deeplake
+dataset. Queries (noisy copies of corpus vectors) are searched through
+StoreManager with VECTOR_DTYPE "float32" (the reference : plain Deeplake
+search), "float16" and "int8", with several RESCORE_OVERFETCH values.
+Reports recall@k against the float32 results, search latency, the bytes of
+vectors scanned per query and the peak memory allocated by a query.
+
+Usage : python bench_vector_compression.py [num_vectors] [num_queries] [dim]
+"""
+import os
+import sys
+import tempfile
+import tracemalloc
+
+import numpy as np
+from deeplake.core.vectorstore import VectorStore
+
+from common import clustered_vectors, percentile, timed, report
+from stores import StoreManager
+from compression import CompressedVectors
+
+def write_corpus(path, count, dim, seed=0):
+    """
+    Store clustered unit vectors in a Deeplake dataset, block by block
+    """
+    store = VectorStore(path=path, overwrite=True, verbose=False)
+    vectors = []
+    start = 0
+    for block in clustered_vectors(count, dim, seed):
+        store.add(
+            text=[f"passage {i}" for i in range(start, start + len(block))],
+            metadata=[{"file_path": f"article{i:07d}.xml"} for i in range(start, start + len(block))],
+            embedding=block,
+            id=[f"node-{i}" for i in range(start, start + len(block))],
+        )
+        vectors.append(block)
+        start += len(block)
+    return np.concatenate(vectors)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    num_queries = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    dim = int(sys.argv[3]) if len(sys.argv) > 3 else 384
+    k = 20
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "vectors")
+        corpus = write_corpus(path, count, dim)
+        rng = np.random.default_rng(1)
+        queries = corpus[rng.integers(count, size=num_queries)] + 0.3*rng.standard_normal((num_queries, dim)).astype(np.float32)
+        queries = [query.tolist() for query in queries]
+        reference = None
+        for dtype, overfetch in [("float32", 1), ("float16", 1), ("float16", 4), ("int8", 1), ("int8", 2), ("int8", 4), ("int8", 8)]:
+            stores = StoreManager({"NEWS": path}, dtype, overfetch)
+            build_seconds, _ = timed(stores.get, "NEWS")
+            stores.search("NEWS", embedding=queries[0], k=k)
+            latencies, results = [], []
+            for query in queries:
+                elapsed, result = timed(stores.search, "NEWS", embedding=query, k=k)
+                latencies.append(elapsed)
+                results.append(result["id"])
+            tracemalloc.start()
+            stores.search("NEWS", embedding=queries[0], k=k)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            if reference is None:
+                reference = results
+            recall = np.mean([len(set(ids) & set(expected)) / k for ids, expected in zip(results, reference)])
+            if dtype == "float32":
+                scanned = count*dim*4
+            else:
+                scanned = os.path.getsize(CompressedVectors.paths(path, dtype)[0])
+            report("vector_compression", {
+                "vectors": count,
+                "dtype": dtype,
+                "overfetch": overfetch,
+                "recall_at_k": float(recall),
+                "p50_ms": 1000*percentile(latencies, 50),
+                "p95_ms": 1000*percentile(latencies, 95),
+                "vector_bytes": scanned,
+                "query_peak_bytes": peak,
+                "build_seconds": build_seconds,
+            })
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+""" common.py : shared helpers for NewsRAG benchmarks
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import functools
+
+import numpy as np
+
+# Benchmarks import NewsRAG modules from src/, as app.py does
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_DIR)
+
+def hash_embedding(text, dim=64):
+    """
+    Deterministic, model-free embedding : a random unit vector seeded by the text
+
+    Parameters
+    ----------
+        text : str
+            text to embed
+        dim : int
+            number of dimensions
+    Returns
+    -------
+        list
+            the embedding vector
+    """
+    seed = int.from_bytes(hashlib.sha1(text.encode("utf8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+@functools.lru_cache(maxsize=None)
+def word_vector(word, dim):
+    return np.array(hash_embedding(word, dim), dtype=np.float32)
+
+def word_embedding(text, dim=64):
+    """
+    Deterministic, model-free embedding where texts sharing words are close :
+    normalised sum of one random vector per word (see hash_embedding())
+
+    Parameters
+    ----------
+        text : str
+            text to embed
+        dim : int
+            number of dimensions
+    Returns
+    -------
+        list
+            the embedding vector
+    """
+    vector = np.sum([word_vector(word, dim) for word in text.lower().split()] or [np.zeros(dim, dtype=np.float32)], axis=0)
+    return (vector / (np.linalg.norm(vector) or 1.0)).tolist()
+
+def clustered_vectors(count, dim, seed=0, block=10000):
+    """
+    Synthetic embeddings : unit vectors spread around a few hundred topics
+
+    Parameters
+    ----------
+        count : int
+            number of vectors
+        dim : int
+            number of dimensions
+        seed : int
+            random seed
+        block : int
+            number of vectors generated at once
+    Returns
+    -------
+        generator
+            float32 arrays of up to block unit vectors
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(1, count // 200), dim)).astype(np.float32)
+    for start in range(0, count, block):
+        size = min(block, count - start)
+        vectors = centers[rng.integers(len(centers), size=size)] + 0.6*rng.standard_normal((size, dim)).astype(np.float32)
+        yield vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def article_xml(i, year=2024, month=11):
+    """
+    Synthetic news article, shaped like the XML written by Toolkit.reindex()
+
+    Parameters
+    ----------
+        i : int
+            article number
+        year : int
+            publication year
+        month : int
+            publication month
+    Returns
+    -------
+        str
+            the XML document
+    """
+    day, hour = 1 + i % 28, i % 24
+    topic = ["économie", "politique", "sport", "culture", "science"][i % 5]
+    return f"""<?xml version="1.0" encoding="utf-8"?>
+<article>
+	<title>Article {i} : nouvelles de {topic}</title>
+	<title_detail>
+		<type>text/plain</type>
+		<value>Article {i} : nouvelles de {topic}</value>
+	</title_detail>
+	<link>https://news{i % 7}.example.org/{topic}/{i}</link>
+	<id>https://news{i % 7}.example.org/{topic}/{i}</id>
+	<summary>Résumé de l'article {i}. Les acteurs de {topic} se sont réunis à Avignon le {day}/{month}.</summary>
+	<content>
+		<value>Illustration de l'article {i}</value>
+	</content>
+	<published_parsed>{year}</published_parsed>
+	<published_parsed>{month}</published_parsed>
+	<published_parsed>{day}</published_parsed>
+	<published_parsed>{hour}</published_parsed>
+</article>
+"""
+
+def write_articles(document_dir, count, start=0):
+    """
+    Write synthetic articles in the <year>/<month>/<day>/<hour> layout
+
+    Parameters
+    ----------
+        document_dir : str
+            DOC_DIR
+        count : int
+            number of articles
+        start : int
+            number of the first article
+    Returns
+    -------
+        list
+            paths of the written files
+    """
+    paths = []
+    for i in range(start, start + count):
+        path = os.path.join(document_dir, "2024", "11", str(1 + i % 28), str(i % 24))
+        os.makedirs(path, exist_ok=True)
+        file_path = os.path.join(path, f"article{i:07d}.xml")
+        with open(file_path, "w") as file:
+            file.write(article_xml(i))
+        paths.append(file_path)
+    return paths
+
+def percentile(values, p):
+    """
+    p-th percentile of a list of timings
+    """
+    return float(np.percentile(np.array(values), p)) if values else 0.0
+
+def timed(function, *args, **kwargs):
+    """
+    Call function and return (elapsed seconds, result)
+    """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+def report(name, results):
+    """
+    Print benchmark results as one JSON line on stdout
+
+    Parameters
+    ----------
+        name : str
+            benchmark name
+        results : dict
+            measured values
+    Returns
+    -------
+        None
+            nothing
+    """
+    print(json.dumps({"benchmark": name, **results}), flush=True)
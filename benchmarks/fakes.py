@@ -0,0 +1,291 @@
+""" fakes.py : local HTTP stand-ins used by NewsRAG benchmarks
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+import json
+import time
+import random
+import hashlib
+import datetime
+import threading
+from email.utils import format_datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from llama_index.core.embeddings import BaseEmbedding
+
+from common import hash_embedding, word_embedding
+
+# Words of the synthetic news texts
+topics = ["économie", "politique", "sport", "culture", "science", "santé", "climat", "justice"]
+places = ["Avignon", "Marseille", "Lyon", "Paris", "Nantes", "Lille", "Toulouse", "Strasbourg"]
+
+# Words of the sentences of wire stories
+wire_words = """le la les un une des du de et pour avec sans sur sous dans entre après avant selon contre
+gouvernement ministre maire conseil projet budget réforme loi accord réunion rapport enquête élus
+habitants entreprises syndicats association région ville état pays semaine mois année hier demain
+matin soir nouveau grand premier dernier public national local annonce présente critique soutient
+propose refuse prévoit""".split()
+
+def wire_story(j, sentences=24):
+    """
+    Title and description of a wire agency story (about 300 words), republished by several feeds
+    """
+    rng = random.Random(j)
+    topic, place = topics[j % len(topics)], places[(j // len(topics)) % len(places)]
+    description = "".join(f"À {place}, {topic} : " + " ".join(rng.choice(wire_words) for word in range(10)) + ". " for sentence in range(sentences))
+    return f"Agence {j} : {topic} à {place}", description
+
+def rss_feed(feed_id, num_items, months=1, sentences=1, wire=0):
+    """
+    Fixture RSS 2.0 feed
+
+    Parameters
+    ----------
+        feed_id : int
+            feed number
+        num_items : int
+            number of entries
+        months : int
+            entries are published over that many months, up to November 9th 2024
+        sentences : int
+            number of sentences of each description
+        wire : int
+            the first wire entries republish wire stories 0 to wire-1 (see
+            wire_story()), with a closing sentence of their own
+    Returns
+    -------
+        bytes
+            the feed document
+    """
+    items = ""
+    latest = datetime.datetime(2024, 11, 9, tzinfo=datetime.timezone.utc)
+    for i in range(num_items):
+        published = latest - datetime.timedelta(days=30*(i % months), hours=i % 24)
+        topic, place = topics[(feed_id+i) % len(topics)], places[(feed_id*3+i) % len(places)]
+        description = f"Résumé de la dépêche {i} du flux {feed_id}."
+        for sentence in range(1, sentences):
+            description += f" À {place}, les acteurs de {topic} se sont réunis pour la {sentence}e fois cette saison."
+        title = f"Dépêche {feed_id}-{i} : {topic} à {place}"
+        if i < wire:
+            title, description = wire_story(i)
+            description += f"Publié par le flux {feed_id}."
+        items += f"""<item>
+<title>{title}</title>
+<link>http://feed{feed_id}.example.org/articles/{feed_id}-{i}</link>
+<guid>http://feed{feed_id}.example.org/articles/{feed_id}-{i}</guid>
+<description>{description}</description>
+<pubDate>{format_datetime(published, usegmt=True)}</pubDate>
+</item>
+"""
+    return f"""<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0"><channel>
+<title>Flux {feed_id}</title><link>http://feed{feed_id}.example.org/</link><description>Flux de test</description>
+{items}</channel></rss>""".encode("utf8")
+
+class FakeServer:
+    """
+    Threaded HTTP server running in the background on 127.0.0.1
+    """
+    def __init__(self, handler):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def feed_server(num_feeds, num_items=20, delay=0.2, months=1, sentences=1, wire=0):
+    """
+    Serve fixture feeds at /feed/<n>, each answer being delayed,
+    with ETag and Last-Modified support ("304 Not Modified")
+
+    Parameters
+    ----------
+        num_feeds : int
+            number of feeds
+        num_items : int
+            entries per feed
+        delay : float
+            seconds waited before each answer (a slow publisher)
+        months : int
+            entries are published over that many months (see rss_feed())
+        sentences : int
+            number of sentences of each entry description
+        wire : int
+            number of wire stories republished by every feed (see rss_feed())
+    Returns
+    -------
+        FakeServer
+            the server, to be used as a context manager
+    """
+    feeds = {f"/feed/{n}": rss_feed(n, num_items, months, sentences, wire) for n in range(num_feeds)}
+    last_modified = "Sat, 09 Nov 2024 23:00:00 GMT"
+
+    class FeedHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            time.sleep(delay)
+            if self.path not in feeds:
+                self.send_error(404)
+                return
+            body = feeds[self.path]
+            etag = '"' + hashlib.md5(body).hexdigest() + '"'
+            if self.headers.get("If-None-Match") == etag or self.headers.get("If-Modified-Since") == last_modified:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/rss+xml")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = FakeServer(FeedHandler)
+    server.feed_urls = [f"{server.url}{path}" for path in feeds]
+    return server
+
+# Canned answer of the fake LLM, in the format expected by Toolkit.get_json()
+canned_entities = """Voici les entités :
+```json
+{"entités": [{"Nom": "Avignon", "Description": "Ville du sud de la France."}, {"Nom": "Pierre Jourlin", "Description": "Chercheur au LIA."}]}
+```"""
+
+def ollama_server(delay=0.1, slots=8, content=canned_entities):
+    """
+    Ollama-compatible stand-in : /api/chat and /api/generate return canned
+    content after a delay, processing at most `slots` requests at the same
+    time (as OLLAMA_NUM_PARALLEL does)
+
+    Parameters
+    ----------
+        delay : float
+            seconds spent on each request ("inference time")
+        slots : int
+            number of requests processed in parallel
+        content : str
+            the assistant message returned, or a function content(request) -> message
+            of the decoded request body
+    Returns
+    -------
+        FakeServer
+            the server, to be used as a context manager
+    """
+    semaphore = threading.Semaphore(slots)
+    counter = {"requests": 0}
+    lock = threading.Lock()
+
+    class OllamaHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def answer(self, payload):
+            body = json.dumps(payload).encode("utf8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            with lock:
+                counter["requests"] += 1
+            with semaphore:
+                time.sleep(delay)
+            answer = content(request) if callable(content) else content
+            message = {"role": "assistant", "content": answer}
+            payload = {
+                "model": request.get("model", "fake"),
+                "created_at": "2024-11-09T17:00:00Z",
+                "done": True,
+                "done_reason": "stop",
+                "prompt_eval_count": 10,
+                "eval_count": 10,
+            }
+            if not request.get("stream", True):
+                self.answer({**payload, "message": message, "response": answer})
+                return
+            # Streaming answer : one JSON object per line, one word per token
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            words = answer.split(" ")
+            for i, word in enumerate(words):
+                token = word if i == 0 else " " + word
+                last = i == len(words) - 1
+                chunk = {**payload, "done": last, "message": {"role": "assistant", "content": token}, "response": token}
+                line = (json.dumps(chunk) + "\n").encode("utf8")
+                self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+            self.wfile.write(b"0\r\n\r\n")
+
+        def do_GET(self):
+            self.answer({"models": [{"name": "fake"}]})
+
+    server = FakeServer(OllamaHandler)
+    server.counter = counter
+    return server
+
+class HashEmbedding(BaseEmbedding):
+    """
+    Deterministic, model-free stand-in of HuggingFaceEmbedding : each text is
+    embedded as a random unit vector seeded by the text (see common.hash_embedding())
+    """
+    dim: int = 384
+
+    def __init__(self, model_name="hash", trust_remote_code=False, dim=384, **kwargs):
+        super().__init__(model_name=model_name, dim=dim, **kwargs)
+
+    @classmethod
+    def class_name(cls):
+        return "HashEmbedding"
+
+    def _get_query_embedding(self, query):
+        return hash_embedding(query, self.dim)
+
+    async def _aget_query_embedding(self, query):
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text):
+        return hash_embedding(text, self.dim)
+
+class WordEmbedding(HashEmbedding):
+    """
+    HashEmbedding where texts sharing words are close (see common.word_embedding())
+    """
+    @classmethod
+    def class_name(cls):
+        return "WordEmbedding"
+
+    def _get_query_embedding(self, query):
+        return word_embedding(query, self.dim)
+
+    def _get_text_embedding(self, text):
+        return word_embedding(text, self.dim)
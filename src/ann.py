@@ -0,0 +1,309 @@
+""" ann.py : approximate nearest neighbour indexes of Deeplake datasets
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+import os
+import sys
+import json
+
+import numpy as np
+
+from compression import block_rows, normalise, int8_scales, encode, results, rescore
+
+def train_centroids(sample, num_lists, iterations=10, seed=0):
+    """
+    Spherical k-means : centroids of unit vectors, by cosine similarity
+
+    Parameters
+    ----------
+        sample : numpy.ndarray
+            (rows, dimensions) unit vectors
+        num_lists : int
+            number of centroids
+        iterations : int
+            number of k-means iterations
+        seed : int
+            random seed of the initial centroids
+    Returns
+    -------
+        numpy.ndarray
+            (num_lists, dimensions) unit centroids
+    """
+    rng = np.random.default_rng(seed)
+    centroids = sample[rng.choice(len(sample), num_lists, replace=False)]
+    for iteration in range(iterations):
+        lists = assign(sample, centroids)
+        order = np.argsort(lists, kind="stable")
+        counts = np.bincount(lists, minlength=num_lists)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        sums = np.empty(centroids.shape, dtype=np.float32)
+        filled = counts > 0
+        sums[filled] = np.add.reduceat(sample[order], starts[filled], axis=0)
+        # Empty lists restart from a random sample
+        sums[~filled] = sample[rng.choice(len(sample), int((~filled).sum()))]
+        centroids = normalise(sums)
+    return centroids
+
+def assign(vectors, centroids):
+    """
+    Closest centroid of each vector, block by block
+    """
+    lists = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), block_rows):
+        lists[start:start+block_rows] = np.argmax(vectors[start:start+block_rows] @ centroids.T, axis=1)
+    return lists
+
+class IVFIndex:
+    """
+    Inverted file index : embeddings are clustered around centroids, and their
+    normalised copies (in VECTOR_DTYPE) are stored list after list, next to the
+    dataset. A query only scores the vectors of its nprobe closest lists, then
+    the best candidates are rescored with their float32 embeddings.
+    """
+    def __init__(self, centroids, offsets, rows, codes, scales=None, nprobe=16):
+        """
+        Initialise an IVFIndex object
+
+        Parameters
+        ----------
+            centroids : numpy.ndarray
+                (lists, dimensions) unit centroids
+            offsets : numpy.ndarray
+                first position of each list in codes, then the number of rows
+            rows : numpy.ndarray
+                dataset row of each position in codes
+            codes : numpy.ndarray
+                (rows, dimensions) normalised embeddings, list after list, usually memory-mapped
+            scales : numpy.ndarray
+                int8 codes only : value of one quantization step, per dimension
+            nprobe : int
+                number of lists searched per query (more is slower and more accurate)
+        Returns
+        -------
+            IVFIndex
+                An IVFIndex object
+        """
+        self.centroids = centroids
+        self.offsets = offsets
+        self.rows = rows
+        self.codes = codes
+        self.scales = scales
+        self.nprobe = nprobe
+
+    @staticmethod
+    def paths(dataset_path, dtype):
+        """
+        Codes (.npy), lists (.npz) and description (.json) files of a dataset
+        """
+        prefix = os.path.join(dataset_path, f"ivf.{dtype}")
+        return prefix+".npy", prefix+".npz", prefix+".json"
+
+    @classmethod
+    def open(cls, dataset_path, dataset, dtype, version, nprobe=16):
+        """
+        Open the index of a dataset, (re)building it if it is missing or stale
+
+        Parameters
+        ----------
+            dataset_path : str
+                Deeplake dataset directory
+            dataset : deeplake.core.dataset.Dataset
+                the dataset, opened read-only
+            dtype : str
+                "float32", "float16" or "int8"
+            version : tuple
+                dataset version (see stores.dataset_version())
+            nprobe : int
+                number of lists searched per query
+        Returns
+        -------
+            IVFIndex
+                the index of the dataset
+        """
+        codes_path, lists_path, meta_path = cls.paths(dataset_path, dtype)
+        version = json.loads(json.dumps(version))
+        try:
+            with open(meta_path) as file:
+                meta = json.load(file)
+            if meta["version"] == version and meta["rows"] == len(dataset):
+                with np.load(lists_path) as lists:
+                    scales = lists["scales"] if "scales" in lists.files else None
+                    return cls(lists["centroids"], lists["offsets"], lists["rows"], np.load(codes_path, mmap_mode="r"), scales, nprobe)
+        except (OSError, ValueError, KeyError):
+            pass
+        print(f"Building the ANN index of {dataset_path}...", file=sys.stderr)
+        blocks = lambda start, stop: dataset["embedding"][start:stop].numpy()
+        try:
+            index = cls.build(blocks, len(dataset), dtype, nprobe=nprobe, path=codes_path)
+            index.save(dataset_path, dtype, version)
+        except OSError:
+            print(f"Cannot write the ANN index of {dataset_path}, it is kept in memory", file=sys.stderr)
+            index = cls.build(blocks, len(dataset), dtype, nprobe=nprobe)
+        return index
+
+    @classmethod
+    def build(cls, blocks, rows, dtype, num_lists=None, nprobe=16, path=None, sample_per_list=50, seed=0):
+        """
+        Cluster the embeddings and store them list after list
+
+        Parameters
+        ----------
+            blocks : function
+                blocks(start, stop) -> float32 embeddings of rows start to stop
+            rows : int
+                number of rows
+            dtype : str
+                "float32", "float16" or "int8"
+            num_lists : int
+                number of lists, 2*sqrt(rows) by default
+            nprobe : int
+                number of lists searched per query
+            path : str
+                file of the codes (memory-mapped while building), None to keep them in memory
+            sample_per_list : int
+                rows used to train the centroids, per list
+            seed : int
+                random seed of the training sample
+        Returns
+        -------
+            IVFIndex
+                the index
+        """
+        num_lists = num_lists or max(1, min(rows, int(2*np.sqrt(rows))))
+        dim = blocks(0, 1).shape[1]
+        # Train the centroids on a sample of the rows
+        rng = np.random.default_rng(seed)
+        size = min(rows, num_lists*sample_per_list)
+        picked = np.sort(rng.choice(rows, size, replace=False))
+        sample = np.empty((size, dim), dtype=np.float32)
+        filled = 0
+        for start in range(0, rows, block_rows):
+            wanted = picked[(picked >= start) & (picked < start+block_rows)]
+            if len(wanted) > 0:
+                sample[filled:filled+len(wanted)] = normalise(blocks(start, start+block_rows)[wanted-start])
+                filled += len(wanted)
+        centroids = train_centroids(sample, num_lists, seed=seed)
+        del sample
+        # Assign every row to its list
+        lists = np.empty(rows, dtype=np.int32)
+        for start in range(0, rows, block_rows):
+            lists[start:start+block_rows] = assign(normalise(blocks(start, start+block_rows)), centroids)
+        order = np.argsort(lists, kind="stable").astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(lists, minlength=num_lists))]).astype(np.int64)
+        positions = np.empty(rows, dtype=np.int64)
+        positions[order] = np.arange(rows)
+        del lists
+        # Write the codes at the position of their rows
+        scales = int8_scales(blocks, rows) if dtype == "int8" else None
+        if path is not None:
+            codes = np.lib.format.open_memmap(path+".tmp", mode="w+", dtype=dtype, shape=(rows, dim))
+        else:
+            codes = np.empty((rows, dim), dtype=dtype)
+        for start in range(0, rows, block_rows):
+            block = encode(blocks(start, start+block_rows), dtype, scales)
+            codes[positions[start:start+len(block)]] = block
+        if path is not None:
+            codes.flush()
+            del codes
+            os.replace(path+".tmp", path)
+            codes = np.load(path, mmap_mode="r")
+        return cls(centroids, offsets, order, codes, scales, nprobe)
+
+    def save(self, dataset_path, dtype, version):
+        """
+        Write the lists and the description of the index (the codes are written by build())
+        """
+        codes_path, lists_path, meta_path = self.paths(dataset_path, dtype)
+        if not isinstance(self.codes, np.memmap):
+            np.save(codes_path, self.codes)
+        arrays = {"centroids": self.centroids, "offsets": self.offsets, "rows": self.rows}
+        if self.scales is not None:
+            arrays["scales"] = self.scales
+        with open(lists_path+".tmp", "wb") as file:
+            np.savez(file, **arrays)
+        os.replace(lists_path+".tmp", lists_path)
+        with open(meta_path+".tmp", "w") as file:
+            json.dump({"version": version, "rows": len(self.rows), "lists": len(self.centroids)}, file)
+        os.replace(meta_path+".tmp", meta_path)
+
+    def candidates(self, embedding, count, nprobe=None):
+        """
+        Rows of the best approximate cosine similarities, among the nprobe closest lists
+
+        Parameters
+        ----------
+            embedding : list
+                query embedding
+            count : int
+                number of candidates
+            nprobe : int
+                number of lists searched, the index setting by default
+        Returns
+        -------
+            tuple
+                (candidate rows, their approximate scores), best first
+        """
+        query = normalise(np.asarray(embedding, dtype=np.float32).reshape(1, -1))[0]
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        probed = np.argpartition(-(self.centroids @ query), nprobe-1)[:nprobe]
+        if self.scales is not None:
+            query = query*self.scales
+        positions = np.concatenate([np.arange(self.offsets[probe], self.offsets[probe+1]) for probe in probed])
+        scores = np.empty(len(positions), dtype=np.float32)
+        # Lists are contiguous : score them slice by slice
+        filled = 0
+        for probe in probed:
+            start, stop = self.offsets[probe], self.offsets[probe+1]
+            scores[filled:filled+stop-start] = self.codes[start:stop].astype(np.float32) @ query
+            filled += stop-start
+        if count < len(scores):
+            best = np.argpartition(-scores, count)[:count]
+        else:
+            best = np.arange(len(scores))
+        best = best[np.argsort(-scores[best])]
+        return self.rows[positions[best]], scores[best]
+
+    def search(self, dataset, embedding, k, overfetch=4):
+        """
+        K Nearest Neighbours search, through the nprobe closest lists
+
+        Parameters
+        ----------
+            dataset : deeplake.core.dataset.Dataset
+                the indexed dataset
+            embedding : list
+                query embedding
+            k : int
+                number of results
+            overfetch : int
+                number of candidates rescored, per result (float16 and int8 codes)
+        Returns
+        -------
+            dict
+                search results in the format of Deeplake, best scores first
+        """
+        if len(self.rows) == 0:
+            return results(dataset, [], [])
+        if self.codes.dtype == np.float32:
+            # Codes are the exact normalised embeddings : no rescoring needed
+            rows, scores = self.candidates(embedding, k)
+            return results(dataset, rows.tolist(), scores)
+        rows, scores = self.candidates(embedding, k*overfetch)
+        return rescore(dataset, embedding, rows.tolist(), k)
+
+# Available ANN indexes (ANN_INDEX in .env), all built with open(dataset_path, dataset, dtype, version, nprobe)
+ann_indexes = {"ivf": IVFIndex}
@@ -17,20 +17,77 @@
 
 """
 
-from flask import Flask, Response, render_template, stream_template,send_from_directory, request, redirect, flash
+from flask import Flask, Response, render_template, stream_template,send_from_directory, request, redirect, flash, jsonify, g, stream_with_context
 from markupsafe import escape
 
+import io
+import re
 import time
 import click
 import warnings
 import os
 
 from toolkit import Toolkit
+from metrics import metrics, start_trace, server_timing
 
+# Slow components (embedding model, vector indexes) are only loaded when needed :
+# flask reindex and flask textchat do not load those of this toolkit
 toolkit = Toolkit(read_only=True)
 
 app = Flask(__name__)
 
+# Every request is timed, from its arrival until its (streamed) response is fully sent
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+    # The first request starts loading slow components in the background
+    if toolkit.warm_up:
+        toolkit.components.warm_up()
+    if toolkit.timing_header:
+        start_trace()
+
+@app.after_request
+def stop_timer(response):
+    start = g.start
+    route = request.url_rule.rule if request.url_rule is not None else "other"
+    if toolkit.timing_header:
+        # Server-Timing header : HTML results are sent at once (not streamed) to time
+        # all their stages, chat answers are timed until their first token
+        if response.is_streamed and response.mimetype == "text/html":
+            response.get_data()
+        response.headers["Server-Timing"] = server_timing(time.perf_counter()-start)
+    def record():
+        metrics.observe("newsrag_request_seconds", time.perf_counter()-start, route=route)
+        metrics.increment("newsrag_requests_total", route=route, status=response.status_code)
+    response.call_on_close(record)
+    return response
+
+# Optional date range of searches and chat retrieval : ?from=YYYY-MM-DD&to=YYYY-MM-DD
+def date_range():
+    dates = []
+    for name in ["from", "to"]:
+        value = request.values.get(name, "")
+        dates.append(value if re.match("^[0-9]{4}-[0-9]{2}-[0-9]{2}$", value) else None)
+    return dates
+
+# Chat session (one conversation history per browser tab) : ?session=<ID>
+def session_id():
+    value = request.values.get("session", "")
+    return value if re.match("^[A-Za-z0-9_-]{1,64}$", value) else "default"
+
+# Articles selected by the user, to restrict chat retrieval to them : ?docs=<ID> <ID>...
+def selected_docs():
+    return [value for value in request.values.get("docs", "").split() if re.match("^[A-Za-z0-9_=-]{1,64}$", value)]
+
+# Text of an uploaded file, read by blocks of 64 KB
+def upload_text(file):
+    text = io.TextIOWrapper(file.stream, encoding="utf-8", errors="replace")
+    while True:
+        block = text.read(65536)
+        if not block:
+            break
+        yield block
+
 # Render the main web page
 @app.route('/')
 def index():
@@ -61,8 +118,11 @@ def upload():
     if file.filename == '':
         flash('No selected file')
         return Response()
-    search_results = toolkit.retrieve(file.content, query_is_file=True)
-    return Response(search_results, mimetype='text/html')
+    # Result rows are streamed as they are rendered
+    date_from, date_to = date_range()
+    # The file is read while rows are streamed, so the request context is kept
+    search_results = toolkit.retrieve_similar(upload_text(file), date_from=date_from, date_to=date_to)
+    return Response(stream_with_context(search_results), mimetype='text/html')
 
 # Search for patents
 @app.route('/search', methods = ['POST', 'GET'])
@@ -71,7 +131,9 @@ def search():
       query = request.form['query']
     else:
       query = request.args.get('query')
-    search_results = toolkit.retrieve(query)
+    date_from, date_to = date_range()
+    # Result rows are streamed as they are rendered
+    search_results = toolkit.retrieve(query, date_from=date_from, date_to=date_to)
     return Response(search_results, mimetype='text/html')
 
 # Search for UMLS concepts
@@ -81,9 +143,32 @@ def extend():
       query = request.form['query']
     else:
       query = request.args.get('query')
+    # Result rows are streamed as they are rendered
     search_results = toolkit.extend(query)
     return Response(search_results, mimetype='text/html')
 
+# Hit rates and memory use of query caches and chat sessions
+@app.route('/stats')
+def stats():
+    return jsonify({**toolkit.cache_stats(), "chat_sessions": toolkit.chat_sessions.stats()})
+
+# Load state of slow components : 200 once all are loaded, 503 before
+@app.route('/ready')
+def ready():
+    is_ready = toolkit.components.ready()
+    return jsonify({"ready": is_ready, "components": toolkit.components.status()}), 200 if is_ready else 503
+
+# Prometheus metrics of the web server, then those of the last reindex
+@app.route('/metrics')
+def prometheus_metrics():
+    text = metrics.render()
+    try:
+        with open(toolkit.metrics_file) as file:
+            text += file.read()
+    except OSError:
+        pass
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
 # Chatbot answering user's input
 @app.route('/answer', methods = ['POST', 'GET'])
 def generate_answer():
@@ -92,9 +177,14 @@ def generate_answer():
         rendered=str(token).replace('\n', '<br/>')
         return rendered
     # Send tokens as they arrive from Llama3
+    start = g.start
     def update(tokens):
         yield 'data: open\n\n'
+        first = True
         for token in tokens:
+            if first:
+                metrics.observe("newsrag_stage_seconds", time.perf_counter()-start, stage="first_token")
+                first = False
             yield f'data: {render(token)}\n\n'
         yield 'data: close\n\n'
     if request.method == 'POST':
@@ -103,7 +193,8 @@ def generate_answer():
       query = request.args.get('query')
     app.logger.info(f"Answering: '{query}'")
     # Start the chatbot engine and get the token stream
-    tokens=toolkit.patchat(query).response_gen
+    date_from, date_to = date_range()
+    tokens=toolkit.patchat(query, date_from, date_to, session_id(), selected_docs()).response_gen
     # The token stream is returned via update() to the Javascript EventSource 
     # object, answer_source, defined in template/index.html
     return Response(update(tokens), mimetype='text/event-stream')
@@ -128,15 +219,38 @@ def textchat():
 # Type flask reindex <name> for (re)indexing data
 # use BOTH for <name> for both UMLS and patent data
 # use UMLS for UMLS concept or EP for patents
+# NEWS articles are indexed incrementally, add --full for a complete rebuild
 @app.cli.command("reindex")
 @click.argument("index_name")
-def reindex(index_name="BOTH"):
+@click.option("--full", is_flag=True, help="Rebuild the NEWS store from scratch.")
+def reindex(index_name="BOTH", full=False):
     """Regenerate the Deeplake store."""
     global toolkit 
     # Need to write the index
     app.logger.info("Reopening indexes in write mode...")
     toolkit=Toolkit(read_only=False, index_name=index_name)
-    toolkit.reindex(index_name)
+    toolkit.reindex(index_name, full=full)
+
+# Type flask prune for deleting the articles published before the retention
+# window (RETENTION_DAYS, or --days), with their vectors and entity descriptions
+@app.cli.command("prune")
+@click.option("--days", type=int, default=None, help="Number of days kept, today included (default : RETENTION_DAYS).")
+def prune(days=None):
+    """Delete expired articles and compact the Deeplake stores."""
+    global toolkit
+    app.logger.info("Reopening indexes in write mode...")
+    toolkit=Toolkit(read_only=False, index_name="BOTH")
+    toolkit.prune(days)
+
+# Type flask export-onnx for exporting the embedding model (MODEL_NAME) to ONNX
+# with int8 weights, in ONNX_MODEL_DIR, then set EMBED_BACKEND to "onnx"
+@app.cli.command("export-onnx")
+@click.option("--output", default=None, help="Output directory (default : ONNX_MODEL_DIR).")
+@click.option("--float32", is_flag=True, help="Keep float32 weights.")
+def export_onnx_model(output=None, float32=False):
+    """Export the embedding model to ONNX."""
+    from onnx_embedding import export_onnx
+    export_onnx(toolkit.model_name, output or toolkit.onnx_model_dir, quantize=not float32)
 
 # Run the Flask application
 if __name__ == '__main__':
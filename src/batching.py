@@ -0,0 +1,121 @@
+""" batching.py : micro-batching of query embeddings shared by Flask threads
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+
+class EmbeddingBatcher:
+    """
+    Collect texts sent by concurrent threads for a few milliseconds,
+    embed them in one batched call and hand each vector back to its caller
+    """
+    def __init__(self, function, max_wait=0.005, max_batch=32):
+        """
+        Initialise an EmbeddingBatcher object
+
+        Parameters
+        ----------
+            function : function
+                function(list of texts) -> list of vectors, one forward pass
+            max_wait : float
+                max time (seconds) a text waits for others before being embedded
+            max_batch : int
+                max number of texts per call, 1 disables batching
+        Returns
+        -------
+            EmbeddingBatcher
+                An EmbeddingBatcher object
+        """
+        self.function = function
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.worker = None
+        self.lock = threading.Lock()
+        self.stats = {"texts": 0, "batches": 0}
+
+    def embed(self, text):
+        """
+        Embed one text, blocking until its batch is done
+
+        Parameters
+        ----------
+            text : str
+                text to embed
+        Returns
+        -------
+            list
+                the embedding vector
+        """
+        if self.max_batch <= 1:
+            return self.function([text])[0]
+        with self.lock:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.loop, daemon=True)
+                self.worker.start()
+        future = Future()
+        self.queue.put((text, future))
+        return future.result()
+
+    def loop(self):
+        """
+        Worker thread : gather pending texts, then embed them in one call
+        """
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic()+self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline-time.monotonic()
+                try:
+                    batch.append(self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                vectors = self.function([text for text, future in batch])
+            except Exception as error:
+                for text, future in batch:
+                    future.set_exception(error)
+                continue
+            self.stats["texts"] += len(batch)
+            self.stats["batches"] += 1
+            for (text, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+
+def query_embeddings(embed_model, queries):
+    """
+    Embed a batch of queries with the query prompt of the model
+
+    Parameters
+    ----------
+        embed_model : BaseEmbedding
+            LlamaIndex embedding model
+        queries : list
+            query texts
+    Returns
+    -------
+        list
+            the embedding vectors
+    """
+    # HuggingFaceEmbedding can encode a list with its "query" prompt in one pass,
+    # LlamaIndex only exposes single query embeddings
+    if hasattr(embed_model, "_embed"):
+        return embed_model._embed(queries, prompt_name="query")
+    return [embed_model.get_query_embedding(query) for query in queries]
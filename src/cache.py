@@ -0,0 +1,491 @@
+""" cache.py : caches used by NewsRAG
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+import os
+import sys
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+
+class FieldCache:
+    """
+    Persistent cache of AI generated fields, keyed by a hash of the input text,
+    the prompt and the LLM name. Its size is bounded, least recently used
+    entries are evicted first.
+    """
+    def __init__(self, path, max_entries=100000):
+        """
+        Initialise a FieldCache object
+
+        Parameters
+        ----------
+            path : str
+                SQLite file holding the cache
+            max_entries : int
+                max number of cached answers (0 disables the cache)
+        Returns
+        -------
+            FieldCache
+                A FieldCache object
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # The connection is shared by the extraction threads, under self.lock
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS fields (key TEXT PRIMARY KEY, value TEXT, last_used REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS fields_last_used ON fields (last_used)")
+        self.db.commit()
+        self.entries = self.db.execute("SELECT COUNT(*) FROM fields").fetchone()[0]
+
+    def key(self, llm, prompt, text):
+        """
+        Cache key of an LLM request
+
+        Parameters
+        ----------
+            llm : str
+                LLM name
+            prompt : str
+                the prompt (see ai_generated_prompts)
+            text : str
+                the text to be processed
+        Returns
+        -------
+            str
+                hexadecimal SHA-256 digest
+        """
+        return hashlib.sha256("\0".join([llm, prompt, text]).encode("utf8")).hexdigest()
+
+    def get(self, key):
+        """
+        Look up a cached answer
+
+        Parameters
+        ----------
+            key : str
+                see FieldCache.key()
+        Returns
+        -------
+            str
+                the cached answer, None on a miss
+        """
+        if self.max_entries <= 0:
+            return None
+        with self.lock:
+            row = self.db.execute("SELECT value FROM fields WHERE key=?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.db.execute("UPDATE fields SET last_used=? WHERE key=?", (time.time(), key))
+            self.db.commit()
+            return row[0]
+
+    def put(self, key, value):
+        """
+        Store an answer, evicting the least recently used ones if the cache is full
+
+        Parameters
+        ----------
+            key : str
+                see FieldCache.key()
+            value : str
+                the LLM answer
+        Returns
+        -------
+            None
+                nothing
+        """
+        if self.max_entries <= 0 or value is None:
+            return
+        with self.lock:
+            inserted = self.db.execute("INSERT OR IGNORE INTO fields VALUES (?, ?, ?)", (key, value, time.time())).rowcount
+            if inserted == 0:
+                self.db.execute("UPDATE fields SET value=?, last_used=? WHERE key=?", (value, time.time(), key))
+            self.entries += inserted
+            excess = self.entries - self.max_entries
+            if excess > 0:
+                self.db.execute("DELETE FROM fields WHERE key IN (SELECT key FROM fields ORDER BY last_used LIMIT ?)", (excess,))
+                self.entries -= excess
+            self.db.commit()
+
+    def stats(self):
+        """
+        Hit and miss counts since the cache was opened
+
+        Returns
+        -------
+            dict
+                "hits", "misses", "entries"
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": self.entries}
+
+def approximate_size(value):
+    """
+    Rough memory footprint of a cached value, in bytes
+
+    Parameters
+    ----------
+        value : object
+            str, list, tuple, dict, numpy array, ...
+    Returns
+    -------
+        int
+            number of bytes
+    """
+    if hasattr(value, "nbytes"):
+        return int(value.nbytes)
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(approximate_size(k)+approximate_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(approximate_size(v) for v in value)
+    return size
+
+class TTLCache:
+    """
+    In-process, thread-safe LRU cache whose entries also expire after a time to live
+    """
+    def __init__(self, max_entries=1024, ttl=600.0):
+        """
+        Initialise a TTLCache object
+
+        Parameters
+        ----------
+            max_entries : int
+                max number of entries (0 disables the cache)
+            ttl : float
+                time to live of an entry, in seconds
+        Returns
+        -------
+            TTLCache
+                A TTLCache object
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Look up a value
+
+        Parameters
+        ----------
+            key : hashable
+                cache key
+        Returns
+        -------
+            object
+                the cached value, None on a miss or if the entry has expired
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self.bytes -= entry[2]
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        """
+        Store a value, evicting the least recently used entries if the cache is full
+
+        Parameters
+        ----------
+            key : hashable
+                cache key
+            value : object
+                value to be cached
+        Returns
+        -------
+            None
+                nothing
+        """
+        if self.max_entries <= 0:
+            return
+        size = approximate_size(value)
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[2]
+            self.entries[key] = (time.monotonic()+self.ttl, value, size)
+            self.bytes += size
+            while len(self.entries) > self.max_entries:
+                self.bytes -= self.entries.popitem(last=False)[1][2]
+
+    def clear(self):
+        """
+        Drop every entry
+        """
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """
+        Hit rate and memory use
+
+        Returns
+        -------
+            dict
+                "hits", "misses", "hit_rate", "entries", "bytes"
+        """
+        with self.lock:
+            total = self.hits+self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits/total if total > 0 else 0.0,
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+            }
+
+class EmbeddingCache:
+    """
+    Persistent cache of chunk embeddings for one embedding model : vectors are
+    appended to a float32 file read through a memory map, a SQLite table maps
+    the hash of each chunk text to its row
+    """
+    def __init__(self, path, model_name):
+        """
+        Initialise an EmbeddingCache object
+
+        Parameters
+        ----------
+            path : str
+                cache directory, one sub-directory per embedding model
+            model_name : str
+                embedding model name (MODEL_NAME)
+        Returns
+        -------
+            EmbeddingCache
+                An EmbeddingCache object
+        """
+        self.model_name = model_name
+        self.directory = os.path.join(path, hashlib.sha256(model_name.encode("utf8")).hexdigest()[:16])
+        os.makedirs(self.directory, exist_ok=True)
+        self.vectors_path = os.path.join(self.directory, "vectors.f32")
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(self.directory, "index.sqlite"), check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS vectors (key TEXT PRIMARY KEY, row INTEGER, last_used REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("INSERT OR IGNORE INTO meta VALUES ('model_name', ?)", (model_name,))
+        self.db.commit()
+        dim = self.db.execute("SELECT value FROM meta WHERE name='dim'").fetchone()
+        self.dim = int(dim[0]) if dim is not None else None
+        self.map = None
+
+    def key(self, text):
+        """
+        Cache key of a chunk text
+
+        Parameters
+        ----------
+            text : str
+                text to embed
+        Returns
+        -------
+            str
+                hexadecimal SHA-256 digest of the model name and the text
+        """
+        return hashlib.sha256("\0".join([self.model_name, text]).encode("utf8")).hexdigest()
+
+    def num_rows(self):
+        """
+        Number of vectors in the vector file
+        """
+        if self.dim is None or not os.path.exists(self.vectors_path):
+            return 0
+        return os.path.getsize(self.vectors_path) // (4*self.dim)
+
+    def vectors(self, rows):
+        """
+        Read vectors through the memory map, remapping the file if it has grown
+        """
+        if self.map is None or max(rows) >= len(self.map):
+            self.map = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(self.num_rows(), self.dim))
+        return self.map[rows]
+
+    def get(self, texts):
+        """
+        Look up the embeddings of a list of texts
+
+        Parameters
+        ----------
+            texts : list
+                texts to embed
+        Returns
+        -------
+            list
+                embedding vectors (lists of floats), None for each miss
+        """
+        keys = [self.key(text) for text in texts]
+        with self.lock:
+            found = dict()
+            # SQLite limits the number of parameters of a query
+            for start in range(0, len(keys), 500):
+                part = keys[start:start+500]
+                found.update(self.db.execute(f"SELECT key, row FROM vectors WHERE key IN ({','.join('?'*len(part))})", part).fetchall())
+            results = [None]*len(keys)
+            if len(found) > 0:
+                positions = [i for i, key in enumerate(keys) if key in found]
+                for i, vector in zip(positions, self.vectors([found[keys[i]] for i in positions])):
+                    results[i] = vector.tolist()
+                now = time.time()
+                self.db.executemany("UPDATE vectors SET last_used=? WHERE key=?", [(now, key) for key in found])
+                self.db.commit()
+            self.hits += len(found)
+            self.misses += len(keys)-len(found)
+            return results
+
+    def put(self, texts, vectors):
+        """
+        Store the embeddings of a list of texts
+
+        Parameters
+        ----------
+            texts : list
+                embedded texts
+            vectors : list
+                their embedding vectors
+        Returns
+        -------
+            None
+                nothing
+        """
+        if len(texts) == 0:
+            return
+        array = np.asarray(vectors, dtype=np.float32)
+        with self.lock:
+            if self.dim is None:
+                self.dim = array.shape[1]
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('dim', ?)", (str(self.dim),))
+            start = self.num_rows()
+            with open(self.vectors_path, "ab") as file:
+                array.tofile(file)
+            now = time.time()
+            self.db.executemany("INSERT OR REPLACE INTO vectors VALUES (?, ?, ?)", [(self.key(text), start+i, now) for i, text in enumerate(texts)])
+            self.db.commit()
+
+    def compact(self, since):
+        """
+        Drop the entries not used since a given time and rewrite the vector file
+        without them (e.g. after a full rebuild, the chunks that no longer exist)
+
+        Parameters
+        ----------
+            since : float
+                time.time() value, older entries are dropped
+        Returns
+        -------
+            dict
+                "entries" kept, "dropped" entries, "bytes" reclaimed
+        """
+        with self.lock:
+            kept = self.db.execute("SELECT key, row FROM vectors WHERE last_used>=? ORDER BY row", (since,)).fetchall()
+            total = self.num_rows()
+            if self.dim is None or len(kept) == total:
+                return {"entries": len(kept), "dropped": 0, "bytes": 0}
+            old = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(total, self.dim))
+            tmp_path = self.vectors_path + ".tmp"
+            with open(tmp_path, "wb") as file:
+                for start in range(0, len(kept), 4096):
+                    old[[row for key, row in kept[start:start+4096]]].tofile(file)
+            del old
+            self.map = None
+            os.replace(tmp_path, self.vectors_path)
+            self.db.execute("DELETE FROM vectors WHERE last_used<?", (since,))
+            self.db.executemany("UPDATE vectors SET row=? WHERE key=?", [(i, key) for i, (key, row) in enumerate(kept)])
+            self.db.commit()
+            self.db.execute("VACUUM")
+            return {"entries": len(kept), "dropped": total-len(kept), "bytes": (total-len(kept))*4*self.dim}
+
+    def stats(self):
+        """
+        Hit rate and size
+
+        Returns
+        -------
+            dict
+                "hits", "misses", "hit_rate", "entries", "bytes"
+        """
+        with self.lock:
+            lookups = self.hits+self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits/lookups if lookups > 0 else 0.0,
+                "entries": self.db.execute("SELECT COUNT(*) FROM vectors").fetchone()[0],
+                "bytes": self.num_rows()*4*(self.dim or 0),
+            }
+
+class CachedEmbedding(BaseEmbedding):
+    """
+    LlamaIndex embedding model whose text embeddings are looked up in an
+    EmbeddingCache first : only the missing chunks go through the model
+    """
+    _model: BaseEmbedding = PrivateAttr()
+    _cache: EmbeddingCache = PrivateAttr()
+
+    def __init__(self, model, cache, **kwargs):
+        super().__init__(model_name=model.model_name, embed_batch_size=model.embed_batch_size, **kwargs)
+        self._model = model
+        self._cache = cache
+
+    @classmethod
+    def class_name(cls):
+        return "CachedEmbedding"
+
+    def _get_query_embedding(self, query):
+        return self._model.get_query_embedding(query)
+
+    async def _aget_query_embedding(self, query):
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text):
+        return self._get_text_embeddings([text])[0]
+
+    def _get_text_embeddings(self, texts):
+        vectors = self._cache.get(texts)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if len(missing) > 0:
+            computed = self._model.get_text_embedding_batch([texts[i] for i in missing])
+            self._cache.put([texts[i] for i in missing], computed)
+            for i, vector in zip(missing, computed):
+                vectors[i] = vector
+        return vectors
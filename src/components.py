@@ -0,0 +1,176 @@
+""" components.py : heavy components loaded on first use or by a background warm-up
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+import sys
+import time
+import threading
+
+class Component:
+    """
+    A value built once by a (slow) function, the first time it is needed
+    """
+    def __init__(self, name, load, warm=True):
+        """
+        Initialise a Component object
+
+        Parameters
+        ----------
+            name : str
+                component name, reported by Components.status()
+            load : function
+                function() -> value
+            warm : bool
+                loaded by Components.warm_up(), False for components only used by reindexes
+        Returns
+        -------
+            Component
+                A Component object
+        """
+        self.name = name
+        self.load = load
+        self.warm = warm
+        self.lock = threading.Lock()
+        self.value = None
+        self.state = "pending"
+        self.seconds = None
+        self.error = None
+
+    def get(self):
+        """
+        Value of the component, loaded by the first caller while the others wait for it
+
+        Returns
+        -------
+            object
+                the value returned by load()
+        """
+        if self.state == "ready":
+            return self.value
+        with self.lock:
+            if self.state != "ready":
+                # A failed load is tried again by the next caller
+                self.state = "loading"
+                start = time.perf_counter()
+                try:
+                    self.value = self.load()
+                except Exception as e:
+                    self.state, self.error = "failed", f"{type(e).__name__}: {e}"
+                    raise
+                self.seconds = time.perf_counter() - start
+                self.state, self.error = "ready", None
+        return self.value
+
+class Components:
+    """
+    Named components of a Toolkit, with their load state, and a thread
+    loading them all in the background
+    """
+    def __init__(self):
+        """
+        Initialise a Components object
+
+        Returns
+        -------
+            Components
+                A Components object
+        """
+        self.components = dict()
+        self.lock = threading.Lock()
+        self.worker = None
+
+    def add(self, name, load, warm=True):
+        """
+        Declare a component, loaded by its first get() or by warm_up()
+
+        Parameters
+        ----------
+            name : str
+                component name
+            load : function
+                function() -> value
+            warm : bool
+                loaded by warm_up() and awaited by ready(), False for components
+                only loaded by their first get() (e.g. reindex state in the web server)
+        Returns
+        -------
+            None
+                nothing
+        """
+        self.components[name] = Component(name, load, warm)
+
+    def get(self, name):
+        """
+        Value of a component, loading it if needed
+
+        Parameters
+        ----------
+            name : str
+                component name
+        Returns
+        -------
+            object
+                the component value
+        """
+        return self.components[name].get()
+
+    def warm_up(self):
+        """
+        Load every warm component in a background thread, in the order they were
+        declared (only the first call starts the thread)
+
+        Returns
+        -------
+            None
+                nothing
+        """
+        with self.lock:
+            if self.worker is not None:
+                return
+            self.worker = threading.Thread(target=self.load_all, name="warm-up", daemon=True)
+        self.worker.start()
+
+    def load_all(self):
+        """
+        Load every warm component, failures being reported by status()
+        """
+        for component in list(self.components.values()):
+            if not component.warm:
+                continue
+            try:
+                component.get()
+            except Exception as e:
+                print(f"Warm-up of {component.name} failed: {type(e).__name__}: {e}", file=sys.stderr)
+
+    def ready(self):
+        """
+        True when every warm component is loaded
+        """
+        return all(component.state == "ready" for component in self.components.values() if component.warm)
+
+    def status(self):
+        """
+        Load state of each warm component, and of the others once used
+
+        Returns
+        -------
+            dict
+                component name -> {"state": "pending", "loading", "ready" or "failed",
+                "seconds": load time, "error": message of the last failure}
+        """
+        return {name: {"state": component.state, "seconds": component.seconds, "error": component.error}
+                for name, component in self.components.items() if component.warm or component.state != "pending"}
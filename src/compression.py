@@ -0,0 +1,302 @@
+""" compression.py : compressed (float16 / int8) copies of Deeplake embeddings, with exact rescoring
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+import os
+import sys
+import json
+
+import numpy as np
+
+# Accepted values of VECTOR_DTYPE ("float32" : plain Deeplake search)
+vector_dtypes = ["float32", "float16", "int8"]
+# Rows read from Deeplake or scored at once, to bound temporary memory
+block_rows = 8192
+
+def normalise(vectors):
+    """
+    Scale vectors to unit length (cosine similarity becomes a dot product)
+    """
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def int8_scales(blocks, rows):
+    """
+    Symmetric int8 quantization steps : the largest value of a dimension is coded as 127
+
+    Parameters
+    ----------
+        blocks : function
+            blocks(start, stop) -> float32 embeddings of rows start to stop
+        rows : int
+            number of rows
+    Returns
+    -------
+        numpy.ndarray
+            value of one quantization step, per dimension
+    """
+    peaks = None
+    for start in range(0, rows, block_rows):
+        block_peaks = np.abs(normalise(blocks(start, start+block_rows))).max(axis=0)
+        peaks = block_peaks if peaks is None else np.maximum(peaks, block_peaks)
+    return np.where(peaks > 0, peaks/127, 1.0).astype(np.float32)
+
+def encode(block, dtype, scales=None):
+    """
+    Normalise and compress embeddings to dtype ("float32", "float16" or "int8" with scales)
+    """
+    block = normalise(block)
+    if scales is not None:
+        block = np.clip(np.rint(block/scales), -127, 127)
+    return block.astype(dtype)
+
+def results(dataset, rows, scores):
+    """
+    Search results in the format of Deeplake ('score', then every tensor but the embeddings)
+
+    Parameters
+    ----------
+        dataset : deeplake.core.dataset.Dataset
+            searched dataset
+        rows : list
+            result rows, best first
+        scores : list
+            their cosine similarities
+    Returns
+    -------
+        dict
+            tensor name -> list of values
+    """
+    tensors = [tensor for tensor in dataset.tensors if tensor != "embedding"]
+    if len(rows) == 0:
+        return {"score": [], **{tensor: [] for tensor in tensors}}
+    view = dataset[list(rows)]
+    return {"score": [float(score) for score in scores], **{tensor: view[tensor].data(aslist=True)["value"] for tensor in tensors}}
+
+def rescore(dataset, embedding, rows, k):
+    """
+    Exact cosine similarities of candidate rows, computed as Deeplake does
+    from their float32 embeddings
+
+    Parameters
+    ----------
+        dataset : deeplake.core.dataset.Dataset
+            searched dataset
+        embedding : list
+            query embedding
+        rows : list
+            candidate rows
+        k : int
+            number of results
+    Returns
+    -------
+        dict
+            search results of the k best candidates (see results())
+    """
+    if len(rows) == 0:
+        return results(dataset, [], [])
+    query = np.asarray(embedding, dtype=np.float32)
+    vectors = dataset["embedding"][list(rows)].numpy()
+    scores = vectors @ query / (np.linalg.norm(query)*np.linalg.norm(vectors, axis=1))
+    best = np.argsort(-scores)[:k]
+    return results(dataset, [rows[offset] for offset in best], scores[best])
+
+def exact_search(dataset, embeddings, k):
+    """
+    K Nearest Neighbours searches of several queries over the float32 embeddings,
+    each block of embeddings being read once for all queries (Deeplake reads
+    every embedding again for each query)
+
+    Parameters
+    ----------
+        dataset : deeplake.core.dataset.Dataset
+            searched dataset
+        embeddings : list
+            query embeddings
+        k : int
+            number of results per query
+    Returns
+    -------
+        list
+            search results of each query (see results()), scored as by Deeplake
+    """
+    queries = np.asarray(embeddings, dtype=np.float32)
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+    best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+    for start in range(0, len(dataset), block_rows):
+        vectors = dataset["embedding"][start:start+block_rows].numpy()
+        scores = queries @ vectors.T / np.linalg.norm(vectors, axis=1)
+        # Running top k : best rows so far and best rows of the block
+        scores = np.concatenate([best_scores, scores], axis=1)
+        rows = np.concatenate([best_rows, np.broadcast_to(np.arange(start, start+len(vectors)), (len(queries), len(vectors)))], axis=1)
+        if scores.shape[1] > k:
+            top = np.argpartition(-scores, k-1, axis=1)[:, :k]
+            scores, rows = np.take_along_axis(scores, top, axis=1), np.take_along_axis(rows, top, axis=1)
+        best_scores, best_rows = scores, rows
+    found = []
+    for rows, scores in zip(best_rows, best_scores):
+        order = np.argsort(-scores)
+        found.append(results(dataset, rows[order].tolist(), scores[order]))
+    return found
+
+class CompressedVectors:
+    """
+    Normalised copy of the embeddings of a Deeplake dataset, stored in float16
+    or scalar-quantized int8 (one scale per dimension) next to the dataset,
+    memory-mapped. A query is scored against the compressed copy, then the
+    float32 embeddings of a few candidates are read from Deeplake to rescore
+    them exactly.
+    """
+    def __init__(self, codes, scales=None):
+        """
+        Initialise a CompressedVectors object
+
+        Parameters
+        ----------
+            codes : numpy.ndarray
+                (rows, dimensions) float16 or int8 array, usually memory-mapped
+            scales : numpy.ndarray
+                int8 only : value of one quantization step, per dimension
+        Returns
+        -------
+            CompressedVectors
+                A CompressedVectors object
+        """
+        self.codes = codes
+        self.scales = scales
+
+    @staticmethod
+    def paths(dataset_path, dtype):
+        """
+        Codes (.npy) and description (.json) files of a dataset
+        """
+        return os.path.join(dataset_path, f"vectors.{dtype}.npy"), os.path.join(dataset_path, f"vectors.{dtype}.json")
+
+    @classmethod
+    def open(cls, dataset_path, dataset, dtype, version):
+        """
+        Open the compressed copy of a dataset, (re)building it if it is missing or stale
+
+        Parameters
+        ----------
+            dataset_path : str
+                Deeplake dataset directory
+            dataset : deeplake.core.dataset.Dataset
+                the dataset, opened read-only
+            dtype : str
+                "float16" or "int8"
+            version : tuple
+                dataset version (see stores.dataset_version())
+        Returns
+        -------
+            CompressedVectors
+                the compressed embeddings of the dataset
+        """
+        codes_path, meta_path = cls.paths(dataset_path, dtype)
+        version = json.loads(json.dumps(version))
+        try:
+            with open(meta_path) as file:
+                meta = json.load(file)
+            if meta["version"] == version and meta["rows"] == len(dataset):
+                scales = np.array(meta["scales"], dtype=np.float32) if meta["scales"] is not None else None
+                return cls(np.load(codes_path, mmap_mode="r"), scales)
+        except (OSError, ValueError, KeyError):
+            pass
+        return cls.build(dataset_path, dataset, dtype, version)
+
+    @classmethod
+    def build(cls, dataset_path, dataset, dtype, version):
+        """
+        Compress the embeddings of a dataset, block by block, and save them next to it
+        """
+        rows = len(dataset)
+        if rows == 0:
+            return cls(np.zeros((0, 0), dtype=dtype))
+        blocks = lambda start, stop: dataset["embedding"][start:stop].numpy()
+        dim = blocks(0, 1).shape[1]
+        scales = int8_scales(blocks, rows) if dtype == "int8" else None
+        codes_path, meta_path = cls.paths(dataset_path, dtype)
+        try:
+            codes = np.lib.format.open_memmap(codes_path+".tmp", mode="w+", dtype=dtype, shape=(rows, dim))
+        except OSError:
+            # Read-only directory : keep the compressed copy in memory
+            print(f"Cannot write {codes_path}, compressed vectors are kept in memory", file=sys.stderr)
+            codes_path = None
+            codes = np.zeros((rows, dim), dtype=dtype)
+        for start in range(0, rows, block_rows):
+            block = encode(blocks(start, start+block_rows), dtype, scales)
+            codes[start:start+len(block)] = block
+        if codes_path is None:
+            return cls(codes, scales)
+        codes.flush()
+        del codes
+        os.replace(codes_path+".tmp", codes_path)
+        with open(meta_path+".tmp", "w") as file:
+            json.dump({"version": version, "rows": rows, "scales": scales.tolist() if scales is not None else None}, file)
+        os.replace(meta_path+".tmp", meta_path)
+        return cls(np.load(codes_path, mmap_mode="r"), scales)
+
+    def candidates(self, embedding, count):
+        """
+        Rows of the best approximate cosine similarities
+
+        Parameters
+        ----------
+            embedding : list
+                query embedding
+            count : int
+                number of candidates
+        Returns
+        -------
+            numpy.ndarray
+                candidate rows, in increasing order
+        """
+        query = normalise(np.asarray(embedding, dtype=np.float32).reshape(1, -1))[0]
+        if self.scales is not None:
+            query = query*self.scales
+        rows = len(self.codes)
+        if count >= rows:
+            return np.arange(rows)
+        scores = np.empty(rows, dtype=np.float32)
+        for start in range(0, rows, block_rows):
+            scores[start:start+block_rows] = self.codes[start:start+block_rows].astype(np.float32) @ query
+        return np.sort(np.argpartition(-scores, count)[:count])
+
+    def search(self, dataset, embedding, k, overfetch=4):
+        """
+        K Nearest Neighbours search over the compressed vectors, the k*overfetch
+        best candidates being rescored with their float32 embeddings
+
+        Parameters
+        ----------
+            dataset : deeplake.core.dataset.Dataset
+                the dataset the vectors were compressed from
+            embedding : list
+                query embedding
+            k : int
+                number of results
+            overfetch : int
+                number of candidates rescored, per result
+        Returns
+        -------
+            dict
+                search results in the format of Deeplake ('score', then every
+                tensor but the embeddings), best scores first
+        """
+        return rescore(dataset, embedding, self.candidates(embedding, k*overfetch).tolist(), k)
@@ -0,0 +1,233 @@
+""" dedup.py : near-duplicate articles, found by SimHash fingerprints and a banded LSH index stored on disk
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+import os
+import re
+import json
+import hashlib
+import threading
+
+import numpy as np
+
+# Bits of a fingerprint
+fingerprint_bits = 64
+# Words of each shingle (feature) of a text
+shingle_words = 3
+# Shorter texts (e.g. a title alone) are not fingerprinted : different stories could match
+min_shingles = 8
+
+def simhash(text):
+    """
+    SimHash of the word shingles of a text : texts sharing most of their
+    shingles have fingerprints differing by a few bits
+
+    Parameters
+    ----------
+        text : str
+            article text
+    Returns
+    -------
+        int
+            64 bits fingerprint, None if the text has fewer than min_shingles shingles
+    """
+    words = re.findall(r"\w+", text.lower())
+    shingles = sorted(set(" ".join(words[i:i+shingle_words]) for i in range(len(words)-shingle_words+1)))
+    if len(shingles) < min_shingles:
+        return None
+    digests = b"".join(hashlib.blake2b(shingle.encode("utf8"), digest_size=fingerprint_bits//8).digest() for shingle in shingles)
+    bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8).reshape(len(shingles), -1), axis=1, bitorder="little")
+    # Each bit of the fingerprint is the majority vote of the shingles
+    votes = 2*bits.sum(axis=0, dtype=np.int64) > len(shingles)
+    return int.from_bytes(np.packbits(votes, bitorder="little").tobytes(), "little")
+
+class DuplicateIndex:
+    """
+    Persistent fingerprints of canonical articles (the first indexed copy of
+    each story) and links of their near-duplicates to them. Fingerprints are
+    cut into distance+1 bands : two fingerprints differing by at most distance
+    bits have an identical band, so only articles sharing a band are compared.
+    A new canonical article is pending until confirm() (once it is stored), the
+    pending ones are forgotten by rollback().
+    """
+    def __init__(self, path, distance=3):
+        """
+        Initialise a DuplicateIndex object, loading it from disk if it exists
+
+        Parameters
+        ----------
+            path : str
+                JSON file holding the fingerprints and links
+            distance : int
+                max number of differing bits between near-duplicates
+        Returns
+        -------
+            DuplicateIndex
+                A DuplicateIndex object
+        """
+        self.path = path
+        self.distance = distance
+        width = fingerprint_bits//(distance+1)
+        # (shift, mask) of each band
+        self.bands = [(band*width, (1 << width)-1) for band in range(distance+1)]
+        self.lock = threading.Lock()
+        self.clear()
+        if os.path.exists(path):
+            with open(path) as file:
+                data = json.load(file)
+            for file_path, fingerprint in data["fingerprints"].items():
+                self.add(file_path, int(fingerprint, 16))
+            self.canonical = data["duplicates"]
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def clear(self):
+        """
+        Forget every article (full rebuild)
+        """
+        self.fingerprints = dict()
+        self.canonical = dict()
+        self.buckets = [dict() for band in self.bands]
+        self.pending = set()
+
+    def add(self, file_path, fingerprint):
+        """
+        Record a canonical article
+        """
+        self.fingerprints[file_path] = fingerprint
+        for buckets, (shift, mask) in zip(self.buckets, self.bands):
+            buckets.setdefault((fingerprint >> shift) & mask, set()).add(file_path)
+
+    def remove(self, file_path):
+        """
+        Forget an article, canonical or duplicate
+
+        Parameters
+        ----------
+            file_path : str
+                XML file
+        Returns
+        -------
+            None
+                nothing
+        """
+        file_path = os.path.normpath(file_path)
+        with self.lock:
+            self.canonical.pop(file_path, None)
+            fingerprint = self.fingerprints.pop(file_path, None)
+            if fingerprint is None:
+                return
+            for buckets, (shift, mask) in zip(self.buckets, self.bands):
+                bucket = buckets[(fingerprint >> shift) & mask]
+                bucket.discard(file_path)
+                if not bucket:
+                    del buckets[(fingerprint >> shift) & mask]
+
+    def nearest(self, fingerprint):
+        """
+        Canonical article closest to a fingerprint, None if none is within distance bits
+        """
+        candidates = set()
+        for buckets, (shift, mask) in zip(self.buckets, self.bands):
+            candidates.update(buckets.get((fingerprint >> shift) & mask, ()))
+        best, best_distance = None, self.distance+1
+        for file_path in sorted(candidates):
+            distance = (self.fingerprints[file_path] ^ fingerprint).bit_count()
+            if distance < best_distance:
+                best, best_distance = file_path, distance
+        return best
+
+    def check(self, file_path, text):
+        """
+        Link an article to the canonical article of its story, or record it as
+        the canonical article of a new story
+
+        Parameters
+        ----------
+            file_path : str
+                XML file
+            text : str
+                indexed text of the article
+        Returns
+        -------
+            str
+                path of the canonical article, None if file_path is a new story
+                (or too short to be compared)
+        """
+        file_path = os.path.normpath(file_path)
+        # A changed article is compared again
+        self.remove(file_path)
+        fingerprint = simhash(text)
+        if fingerprint is None:
+            return None
+        with self.lock:
+            canonical = self.nearest(fingerprint)
+            if canonical is None:
+                # Next copies of the story are linked to it at once, but it is kept only if stored
+                self.add(file_path, fingerprint)
+                self.pending.add(file_path)
+            else:
+                self.canonical[file_path] = canonical
+        return canonical
+
+    def confirm(self, file_path):
+        """
+        Keep the canonical article of a new story, once it has been stored
+
+        Parameters
+        ----------
+            file_path : str
+                XML file
+        Returns
+        -------
+            None
+                nothing
+        """
+        with self.lock:
+            self.pending.discard(os.path.normpath(file_path))
+
+    def rollback(self):
+        """
+        Forget the new canonical articles that have not been stored (e.g. their
+        extraction or embedding failed) and the links of their duplicates, so
+        that the story is compared again by the next reindex
+
+        Returns
+        -------
+            list
+                paths of the duplicates linked to the forgotten articles
+        """
+        with self.lock:
+            pending, self.pending = self.pending, set()
+            duplicates = sorted(path for path, canonical in self.canonical.items() if canonical in pending)
+        for file_path in sorted(pending)+duplicates:
+            self.remove(file_path)
+        return duplicates
+
+    def save(self):
+        """
+        Atomically write the fingerprints and links to disk
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with self.lock:
+            data = {"fingerprints": {file_path: f"{fingerprint:016x}" for file_path, fingerprint in self.fingerprints.items()},
+                    "duplicates": dict(self.canonical)}
+        with open(tmp_path, "w") as file:
+            json.dump(data, file)
+        os.replace(tmp_path, self.path)
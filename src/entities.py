@@ -0,0 +1,307 @@
+""" entities.py : packed store of entities and their descriptions
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+import os
+import mmap
+import uuid
+import struct
+import threading
+
+import lxml.html
+
+# Name of the offset index, the data file is named after its generation
+index_name = "entities.idx"
+# Index rows : (data file generation, number of entities), then (offset, length) per entity
+row = struct.Struct("<QQ")
+
+def concept_id(entity_id):
+    """
+    Concept ID of an entity, as inserted in queries (see concept_pattern in toolkit.py)
+    """
+    return f"c{entity_id}"
+
+def entity_id(concept):
+    """
+    Entity ID of a concept ID ("c123" -> 123)
+    """
+    return int(concept[1:])
+
+def read_legacy_entities(directory):
+    """
+    Entities written as one text file each ("name\\ndescriptions")
+
+    Parameters
+    ----------
+        directory : str
+            root of the tree of entity text files
+    Returns
+    -------
+        dict
+            entity name -> descriptions, in file path order
+    """
+    entities = dict()
+    for root, dirs, files in sorted(os.walk(directory)):
+        dirs.sort()
+        for name in sorted(files):
+            if not name.endswith(".txt"):
+                continue
+            with open(os.path.join(root, name)) as file:
+                text = file.read()
+            ent, _, desc = text.partition("\n")
+            entities[ent] = entities.get(ent, "") + desc
+    return entities
+
+class EntityStore:
+    """
+    Entities and their descriptions packed in one data file ("name\\ndescriptions",
+    UTF-8, one after the other), with an offset index holding one (offset, length)
+    pair of uint64 per entity ID. Both files are memory-mapped read-only, so an
+    entity is read in O(1) from its ID. Written by the NEWS reindex, reloaded
+    only when a reindex has rewritten it.
+    """
+    def __init__(self, path):
+        """
+        Initialise an EntityStore object, opening it if it exists
+
+        Parameters
+        ----------
+            path : str
+                directory holding the data file and its index (ENT_DOC_DIR)
+        Returns
+        -------
+            EntityStore
+                An EntityStore object
+        """
+        self.path = path
+        self.index_path = os.path.join(path, index_name)
+        self.lock = threading.Lock()
+        self.version = None
+        self.data = None
+        self.index = None
+        self.count = 0
+        self.reload()
+
+    def reload(self):
+        """
+        (Re)open the store if a reindex has rewritten it since last load
+
+        Returns
+        -------
+            bool
+                True if a new version has been loaded
+        """
+        try:
+            stat = os.stat(self.index_path)
+        except OSError:
+            return False
+        version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if version == self.version:
+            return False
+        with open(self.index_path, "rb") as file:
+            index = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        generation, count = row.unpack_from(index, 0)
+        data = None
+        if count > 0:
+            try:
+                with open(os.path.join(self.path, f"entities.{generation:016x}.dat"), "rb") as file:
+                    data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except OSError:
+                # Rewritten meanwhile by a reindex : keep the current version until next reload
+                index.close()
+                return False
+        with self.lock:
+            for previous in [self.index, self.data]:
+                if previous is not None:
+                    previous.close()
+            self.index, self.data, self.count, self.version = index, data, count, version
+        return True
+
+    def __len__(self):
+        return self.count
+
+    def get(self, entity_id):
+        """
+        Text of an entity
+
+        Parameters
+        ----------
+            entity_id : int
+                entity ID
+        Returns
+        -------
+            str
+                "name\\ndescriptions", None if the entity is unknown
+        """
+        with self.lock:
+            if entity_id < 0 or entity_id >= self.count:
+                return None
+            offset, length = row.unpack_from(self.index, row.size*(entity_id+1))
+            return self.data[offset:offset+length].decode("utf-8")
+
+    def items(self):
+        """
+        All entities, in ID order, read one at a time
+
+        Returns
+        -------
+            generator
+                (entity ID, text) pairs
+        """
+        for entity_id in range(len(self)):
+            yield entity_id, self.get(entity_id)
+
+    def merge(self, entity_desc):
+        """
+        Append new descriptions to known entities, add new entities, and rewrite the store.
+        Entity IDs are kept, so concept IDs remain valid across reindexes.
+
+        Parameters
+        ----------
+            entity_desc : dict
+                entity name -> new descriptions (one per line)
+        Returns
+        -------
+            int
+                number of new entities
+        """
+        self.reload()
+        known = len(self)
+        pending = dict(entity_desc)
+
+        def texts():
+            for entity_id, text in self.items():
+                yield text + pending.pop(text.partition("\n")[0], "")
+            for name, desc in pending.items():
+                yield name + "\n" + desc
+
+        return self.write(texts())-known
+
+    def remove(self, entity_desc):
+        """
+        Remove descriptions (e.g. those of deleted articles) from their entities,
+        and rewrite the store. Entities keep their IDs, even without descriptions left.
+
+        Parameters
+        ----------
+            entity_desc : dict
+                entity name -> list of descriptions, each removed once
+        Returns
+        -------
+            list
+                IDs of the changed entities
+        """
+        self.reload()
+        changed = []
+
+        def texts():
+            for entity_id, text in self.items():
+                name, separator, desc = text.partition("\n")
+                for description in entity_desc.get(name, []):
+                    desc = desc.replace(description + "\n", "", 1)
+                if name + separator + desc != text:
+                    changed.append(entity_id)
+                yield name + separator + desc
+
+        if len(entity_desc) > 0 and len(self) > 0:
+            self.write(texts())
+        return changed
+
+    def clear(self):
+        """
+        Remove every description (e.g. before a full rebuild extracts them again),
+        and rewrite the store. Entities keep their IDs, so the WIKI store stays valid.
+
+        Returns
+        -------
+            int
+                number of entities
+        """
+        self.reload()
+        if len(self) == 0:
+            return 0
+        return self.write(text.partition("\n")[0] + "\n" for entity_id, text in self.items())
+
+    def write(self, texts):
+        """
+        Write a new data file and its index, then switch readers to them
+
+        Parameters
+        ----------
+            texts : iterable
+                text of each entity ("name\ndescriptions"), in ID order
+        Returns
+        -------
+            int
+                number of entities
+        """
+        os.makedirs(self.path, exist_ok=True)
+        generation = uuid.uuid4().int & 0xFFFFFFFFFFFFFFFF
+        data_path = os.path.join(self.path, f"entities.{generation:016x}.dat")
+        offsets = []
+        position = 0
+        with open(data_path, "wb") as file:
+            for text in texts:
+                encoded = text.encode("utf-8")
+                file.write(encoded)
+                offsets.append((position, len(encoded)))
+                position += len(encoded)
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(row.pack(generation, len(offsets)))
+            for offset, length in offsets:
+                file.write(row.pack(offset, length))
+        # Readers switch to the new data file as soon as the index is replaced
+        os.replace(tmp_path, self.index_path)
+        for name in os.listdir(self.path):
+            if name.startswith("entities.") and name.endswith(".dat") and os.path.join(self.path, name) != data_path:
+                os.remove(os.path.join(self.path, name))
+        self.reload()
+        return len(offsets)
+
+def sidecar_entities(rendered):
+    """
+    Entities of an AI generated field, as written next to its article
+    (the JSON answer of the LLM rendered by json2html)
+
+    Parameters
+    ----------
+        rendered : str
+            HTML of the field
+    Returns
+    -------
+        list
+            (name, description) pairs, for entities with a text description
+    """
+    if "<table" not in rendered:
+        return []
+    entities = []
+    for table in lxml.html.fromstring(rendered).iter("table"):
+        header = table.find("thead")
+        if header is not None:
+            # List of entities with the same keys : one row per entity
+            names = [cell.text_content() for cell in header.iter("th")]
+            rows = [dict(zip(names, [cell.text_content() for cell in line.findall("td")])) for line in table.find("tbody").findall("tr")]
+        else:
+            # One entity : one row per key
+            rows = [{line.find("th").text_content(): line.find("td").text_content()
+                     for line in table.findall("tr") if line.find("th") is not None and line.find("td") is not None}]
+        for entity in rows:
+            # Nested values are rendered as tables, they are not text descriptions
+            if "Nom" in entity and "Description" in entity:
+                entities.append((entity["Nom"], entity["Description"]))
+    return entities
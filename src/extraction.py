@@ -0,0 +1,94 @@
+""" extraction.py : concurrent LLM requests for AI generated fields
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+import sys
+import threading
+
+class FieldExtractor:
+    """
+    Extractor of the AI generated fields of an article, one LLM request per
+    field. Used by the "extract" stage of the NEWS ingest pipeline, whose
+    number of workers bounds the requests in flight. Failed or timed out
+    requests are retried, then skipped.
+    """
+    def __init__(self, generate, retries=1):
+        """
+        Initialise a FieldExtractor object
+
+        Parameters
+        ----------
+            generate : function
+                generate(text, field) -> str, a call to the LLM
+                (e.g. Toolkit.get_ai_generated_field, which reuses one client)
+            retries : int
+                number of new attempts after a failure or a timeout
+        Returns
+        -------
+            FieldExtractor
+                A FieldExtractor object
+        """
+        self.generate = generate
+        self.retries = retries
+        self.stats = {"done": 0, "retried": 0, "skipped": 0}
+        self.lock = threading.Lock()
+
+    def attempt(self, text, field):
+        """
+        Call the LLM, retrying on errors (timeouts included)
+
+        Parameters
+        ----------
+            text : str
+                the text to be processed
+            field : str
+                AI generated field name (see ai_generated_prompts)
+        Returns
+        -------
+            str
+                the generated text, None if every attempt failed
+        """
+        for attempt in range(self.retries+1):
+            try:
+                return self.generate(text, field)
+            except Exception as error:
+                if attempt < self.retries:
+                    with self.lock:
+                        self.stats["retried"] += 1
+                    continue
+                print(f"Warning: skipping a document after {attempt+1} failed LLM requests ({error.__class__.__name__})", file=sys.stderr)
+        return None
+
+    def extract(self, text, field):
+        """
+        Call the LLM (see attempt()) and count the result
+
+        Parameters
+        ----------
+            text : str
+                the text to be processed
+            field : str
+                AI generated field name (see ai_generated_prompts)
+        Returns
+        -------
+            str
+                the generated text, None if every attempt failed
+        """
+        result = self.attempt(text, field)
+        with self.lock:
+            self.stats["done" if result is not None else "skipped"] += 1
+        return result
@@ -0,0 +1,129 @@
+""" fetcher.py : concurrent RSS feed downloads with conditional GET
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+import os
+import sys
+import json
+import threading
+from urllib.parse import urlparse
+
+import requests
+import feedparser
+
+class FeedFetcher:
+    """
+    Download RSS feeds for the "fetch" stage of the NEWS ingest pipeline
+    (whose workers download feeds concurrently), with a limit of simultaneous
+    requests per host, and ETag/Last-Modified validators kept on disk so that
+    unchanged feeds only cost a "304 Not Modified"
+    """
+    def __init__(self, state_path, per_host=2, timeout=30.0):
+        """
+        Initialise a FeedFetcher object
+
+        Parameters
+        ----------
+            state_path : str
+                JSON file holding ETag/Last-Modified values per feed URL
+            per_host : int
+                max number of simultaneous requests to the same host
+            timeout : float
+                timeout of each HTTP request, in seconds
+        Returns
+        -------
+            FeedFetcher
+                A FeedFetcher object
+        """
+        self.state_path = state_path
+        self.per_host = per_host
+        self.timeout = timeout
+        self.state = dict()
+        if os.path.exists(state_path):
+            with open(state_path) as file:
+                self.state = json.load(file)
+        self.lock = threading.Lock()
+        self.host_limits = dict()
+        self.stats = {"fetched": 0, "not_modified": 0, "errors": 0}
+
+    def host_limit(self, url):
+        """
+        Semaphore limiting the simultaneous requests to the host of url
+        """
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.host_limits:
+                self.host_limits[host] = threading.Semaphore(self.per_host)
+            return self.host_limits[host]
+
+    def fetch_one(self, url):
+        """
+        Conditionally download and parse one feed
+
+        Parameters
+        ----------
+            url : str
+                feed URL
+        Returns
+        -------
+            list
+                parsed feed entries, empty if the feed is unchanged or unreachable
+        """
+        headers = dict()
+        validators = self.state.get(url, {})
+        if "etag" in validators:
+            headers["If-None-Match"] = validators["etag"]
+        if "modified" in validators:
+            headers["If-Modified-Since"] = validators["modified"]
+        with self.host_limit(url):
+            try:
+                response = requests.get(url, headers=headers, timeout=self.timeout)
+            except requests.RequestException as error:
+                print(f"Error: cannot fetch {url} ({error})", file=sys.stderr)
+                with self.lock:
+                    self.stats["errors"] += 1
+                return []
+        if response.status_code == 304:
+            with self.lock:
+                self.stats["not_modified"] += 1
+            return []
+        if response.status_code != 200:
+            print(f"Error: {url} returned HTTP {response.status_code}", file=sys.stderr)
+            with self.lock:
+                self.stats["errors"] += 1
+            return []
+        feed = feedparser.parse(response.content, response_headers=dict(response.headers))
+        with self.lock:
+            self.stats["fetched"] += 1
+            validators = dict()
+            if "ETag" in response.headers:
+                validators["etag"] = response.headers["ETag"]
+            if "Last-Modified" in response.headers:
+                validators["modified"] = response.headers["Last-Modified"]
+            self.state[url] = validators
+        return feed.entries
+
+    def save(self):
+        """
+        Atomically write ETag/Last-Modified values to disk
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self.state_path)), exist_ok=True)
+        tmp_path = self.state_path + ".tmp"
+        with self.lock:
+            with open(tmp_path, "w") as file:
+                json.dump(self.state, file)
+        os.replace(tmp_path, self.state_path)
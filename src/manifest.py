@@ -0,0 +1,262 @@
+""" manifest.py : record of the news articles already ingested by NewsRAG
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+import os
+import json
+import hashlib
+
+def file_hash(file_path):
+    """
+    SHA-256 of a file content
+
+    Parameters
+    ----------
+        file_path : str
+            path of the file
+    Returns
+    -------
+        str
+            hexadecimal digest
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def list_articles(document_dir):
+    """
+    List every XML article stored under the document directory
+
+    Parameters
+    ----------
+        document_dir : str
+            root of the <year>/<month>/<day>/<hour> tree
+    Returns
+    -------
+        list
+            sorted list of XML file paths
+    """
+    articles = []
+    for root, dirs, files in os.walk(document_dir):
+        for name in files:
+            if name.endswith(".xml"):
+                articles.append(os.path.normpath(os.path.join(root, name)))
+    return sorted(articles)
+
+def expired_days(document_dir, cutoff):
+    """
+    List the day directories of the document tree older than a date
+
+    Parameters
+    ----------
+        document_dir : str
+            root of the <year>/<month>/<day>/<hour> tree
+        cutoff : str
+            first day kept ("YYYY-MM-DD")
+    Returns
+    -------
+        list
+            (day directory, "YYYY-MM-DD") pairs, oldest first
+    """
+    days = []
+    for year in sorted(os.listdir(document_dir)) if os.path.isdir(document_dir) else []:
+        for month in sorted(os.listdir(os.path.join(document_dir, year))) if os.path.isdir(os.path.join(document_dir, year)) else []:
+            for day in sorted(os.listdir(os.path.join(document_dir, year, month))) if os.path.isdir(os.path.join(document_dir, year, month)) else []:
+                try:
+                    date = f"{int(year):04d}-{int(month):02d}-{int(day):02d}"
+                except ValueError:
+                    continue
+                if date < cutoff:
+                    days.append((os.path.normpath(os.path.join(document_dir, year, month, day)), date))
+    return sorted(days, key=lambda item: item[1])
+
+class IngestManifest:
+    """
+    Persistent map of ingested articles : file path -> content hash,
+    embedding model name, document format, size and modification time
+    """
+    def __init__(self, path, model_name, document_format=None):
+        """
+        Initialise an IngestManifest object, loading it from disk if it exists
+
+        Parameters
+        ----------
+            path : str
+                JSON file holding the manifest
+            model_name : str
+                current embedding model (MODEL_NAME)
+            document_format : str
+                version of the text indexed for each article
+        Returns
+        -------
+            IngestManifest
+                An IngestManifest object
+        """
+        self.path = path
+        self.model_name = model_name
+        self.document_format = document_format
+        self.entries = dict()
+        if os.path.exists(path):
+            with open(path) as file:
+                self.entries = json.load(file)
+
+    def compatible(self):
+        """
+        Check that every recorded vector was built with the current embedding model
+        and document format
+
+        Returns
+        -------
+            bool
+                False if a full rebuild is needed
+        """
+        return all(self.current(entry) for entry in self.entries.values())
+
+    def current(self, entry):
+        """
+        Check that an entry was built with the current embedding model and document format
+        """
+        return entry["model"] == self.model_name and entry.get("format") == self.document_format
+
+    def select(self, file_paths):
+        """
+        Keep only articles that are new or whose content changed since last ingest
+
+        Parameters
+        ----------
+            file_paths : list
+                candidate XML files
+        Returns
+        -------
+            (list, list)
+                new files, changed files (already ingested, to be upserted, or with
+                AI generated fields to be extracted again)
+        """
+        new_files, changed_files = [], []
+        for file_path in file_paths:
+            entry = self.entries.get(file_path)
+            if entry is None:
+                new_files.append(file_path)
+                continue
+            stat = os.stat(file_path)
+            # Only hash files whose size or date differ from the recorded ones
+            if entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns and self.current(entry):
+                if entry.get("retry"):
+                    changed_files.append(file_path)
+                continue
+            if file_hash(file_path) != entry["hash"] or not self.current(entry):
+                # Every AI generated field of a new version is extracted
+                entry.pop("retry", None)
+                changed_files.append(file_path)
+            else:
+                entry["mtime"] = stat.st_mtime_ns
+                if entry.get("retry"):
+                    changed_files.append(file_path)
+        return new_files, changed_files
+
+    def record(self, file_path, retry=None, partition=None):
+        """
+        Mark an article as ingested with the current embedding model and document format
+
+        Parameters
+        ----------
+            file_path : str
+                XML file
+            retry : list
+                AI generated fields the LLM failed to extract, selected again by the next reindex
+            partition : str
+                NEWS partition holding the vectors of the article, None if it has none
+        Returns
+        -------
+            None
+                nothing
+        """
+        stat = os.stat(file_path)
+        entry = {
+            "hash": file_hash(file_path),
+            "model": self.model_name,
+            "format": self.document_format,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+        }
+        if retry:
+            entry["retry"] = sorted(retry)
+        if partition is not None:
+            entry["partition"] = partition
+        self.entries[os.path.normpath(file_path)] = entry
+
+    def partition(self, file_path):
+        """
+        NEWS partition holding the vectors of the recorded version of an article
+
+        Parameters
+        ----------
+            file_path : str
+                XML file
+        Returns
+        -------
+            str
+                partition name, None if unknown (e.g. recorded by former versions)
+        """
+        entry = self.entries.get(os.path.normpath(file_path))
+        return entry.get("partition") if entry is not None else None
+
+    def retry_fields(self, file_path):
+        """
+        AI generated fields of an unchanged article that the LLM failed to extract
+
+        Parameters
+        ----------
+            file_path : str
+                XML file
+        Returns
+        -------
+            list
+                field names, None if every field has to be extracted
+        """
+        entry = self.entries.get(os.path.normpath(file_path))
+        return entry.get("retry") if entry is not None else None
+
+    def pending(self):
+        """
+        Number of articles with AI generated fields to be extracted again
+        """
+        return sum(1 for entry in self.entries.values() if entry.get("retry"))
+
+    def forget(self, file_path):
+        """
+        Remove an article from the manifest
+        """
+        self.entries.pop(os.path.normpath(file_path), None)
+
+    def clear(self):
+        """
+        Forget every article (full rebuild)
+        """
+        self.entries = dict()
+
+    def save(self):
+        """
+        Atomically write the manifest to disk
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self.entries, file)
+        os.replace(tmp_path, self.path)
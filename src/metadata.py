@@ -0,0 +1,164 @@
+""" metadata.py : precomputed article metadata for rendering search results
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+import os
+import json
+import threading
+
+class MetadataStore:
+    """
+    Columnar table of article metadata (XML fields and rendered AI generated
+    fields), keyed by file path. Written at ingest time, loaded once by the
+    server and reloaded only when a reindex has rewritten it.
+    """
+    def __init__(self, path, columns):
+        """
+        Initialise a MetadataStore object, loading it from disk if it exists
+
+        Parameters
+        ----------
+            path : str
+                JSON file holding the table
+            columns : list
+                column names (XML field names, then AI generated field names)
+        Returns
+        -------
+            MetadataStore
+                A MetadataStore object
+        """
+        self.path = path
+        self.columns = list(columns)
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.clear()
+        self.reload()
+
+    def clear(self):
+        """
+        Empty the table
+        """
+        self.keys = []
+        self.rows = dict()
+        self.values = {column: [] for column in self.columns}
+
+    def reload(self):
+        """
+        (Re)load the table if the file on disk has changed since last load
+
+        Returns
+        -------
+            None
+                nothing
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self.mtime:
+            return
+        with self.lock:
+            with open(self.path) as file:
+                table = json.load(file)
+            self.clear()
+            self.keys = table["file_path"]
+            self.rows = {key: row for row, key in enumerate(self.keys)}
+            for column in self.columns:
+                self.values[column] = table.get(column, [None]*len(self.keys))
+            self.mtime = mtime
+
+    def get(self, file_path):
+        """
+        Metadata of an article
+
+        Parameters
+        ----------
+            file_path : str
+                article path, as stored in the vector store metadata
+        Returns
+        -------
+            dict
+                column name -> value, None if the article is unknown
+        """
+        with self.lock:
+            row = self.rows.get(file_path)
+            if row is None:
+                return None
+            return {column: self.values[column][row] for column in self.columns}
+
+    def put(self, file_path, values):
+        """
+        Add or update (some columns of) an article
+
+        Parameters
+        ----------
+            file_path : str
+                article path
+            values : dict
+                column name -> value
+        Returns
+        -------
+            None
+                nothing
+        """
+        with self.lock:
+            row = self.rows.get(file_path)
+            if row is None:
+                row = len(self.keys)
+                self.rows[file_path] = row
+                self.keys.append(file_path)
+                for column in self.columns:
+                    self.values[column].append(None)
+            for column, value in values.items():
+                if column in self.values:
+                    self.values[column][row] = value
+
+    def remove(self, file_paths):
+        """
+        Delete articles from the table
+
+        Parameters
+        ----------
+            file_paths : iterable
+                article paths
+        Returns
+        -------
+            int
+                number of deleted rows
+        """
+        file_paths = set(file_paths)
+        with self.lock:
+            kept = [row for row, key in enumerate(self.keys) if key not in file_paths]
+            removed = len(self.keys)-len(kept)
+            if removed > 0:
+                self.keys = [self.keys[row] for row in kept]
+                self.rows = {key: row for row, key in enumerate(self.keys)}
+                for column in self.columns:
+                    self.values[column] = [self.values[column][row] for row in kept]
+        return removed
+
+    def save(self):
+        """
+        Atomically write the table to disk
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with self.lock:
+            with open(tmp_path, "w") as file:
+                json.dump({"file_path": self.keys, **self.values}, file)
+        os.replace(tmp_path, self.path)
+        self.mtime = os.stat(self.path).st_mtime_ns
@@ -0,0 +1,261 @@
+""" metrics.py : latency histograms and counters, exposed in the Prometheus text format
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+import os
+import time
+import bisect
+import threading
+import contextlib
+import contextvars
+
+# Upper bounds (seconds) of histogram buckets, from a cache hit to an LLM answer
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Description of each metric, in the HELP lines
+descriptions = {
+    "newsrag_stage_seconds": "Duration of request processing stages",
+    "newsrag_request_seconds": "Duration of HTTP requests, until their response is fully sent",
+    "newsrag_requests_total": "Number of HTTP requests",
+    "newsrag_ingest_stage_seconds": "Duration of ingest pipeline stage calls",
+    "newsrag_ingest_items_total": "Number of items processed by ingest pipeline stages",
+    "newsrag_ingest_errors_total": "Number of items that failed in ingest pipeline stages",
+    "newsrag_ingest_duplicates_total": "Number of near-duplicate articles neither extracted nor embedded",
+}
+# Stage durations of the current request, when a trace is started (see start_trace())
+current_trace = contextvars.ContextVar("current_trace", default=None)
+# Timer used while metrics are disabled
+disabled_timer = contextlib.nullcontext()
+
+class Histogram:
+    """
+    Cumulative histogram of durations
+    """
+    def __init__(self):
+        self.counts = [0]*(len(latency_buckets)+1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(latency_buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Timer:
+    """
+    Context manager recording its duration as a stage of request processing
+    """
+    __slots__ = ("metrics", "stage", "start")
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.observe("newsrag_stage_seconds", time.perf_counter()-self.start, stage=self.stage)
+
+class Metrics:
+    """
+    Thread-safe registry of histograms and counters, identified by a metric
+    name and label values, and rendered in the Prometheus text format
+    """
+    def __init__(self, enabled=True):
+        """
+        Initialise a Metrics object
+
+        Parameters
+        ----------
+            enabled : bool
+                False to record nothing
+        Returns
+        -------
+            Metrics
+                A Metrics object
+        """
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.histograms = dict()
+        self.counters = dict()
+
+    def observe(self, name, seconds, **labels):
+        """
+        Add a duration to a histogram, and to the trace of the current request
+
+        Parameters
+        ----------
+            name : str
+                metric name
+            seconds : float
+                duration
+            labels : dict
+                label name -> value
+        Returns
+        -------
+            None
+                nothing
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+        trace = current_trace.get()
+        if trace is not None and "stage" in labels:
+            trace[labels["stage"]] = trace.get(labels["stage"], 0.0)+seconds
+
+    def increment(self, name, value=1, **labels):
+        """
+        Add value to a counter
+
+        Parameters
+        ----------
+            name : str
+                metric name
+            value : int
+                increment
+            labels : dict
+                label name -> value
+        Returns
+        -------
+            None
+                nothing
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0)+value
+
+    def timer(self, stage):
+        """
+        Context manager timing a stage of request processing (newsrag_stage_seconds)
+
+        Parameters
+        ----------
+            stage : str
+                stage name
+        Returns
+        -------
+            Timer
+                the context manager (one that does nothing when metrics are disabled)
+        """
+        if not self.enabled:
+            return disabled_timer
+        return Timer(self, stage)
+
+    def render(self, prefix=""):
+        """
+        Metrics in the Prometheus text exposition format
+
+        Parameters
+        ----------
+            prefix : str
+                only metrics whose name starts with prefix are rendered
+        Returns
+        -------
+            str
+                HELP, TYPE and sample lines of each metric
+        """
+        with self.lock:
+            histograms = {key: (list(histogram.counts), histogram.sum, histogram.count) for key, histogram in self.histograms.items() if key[0].startswith(prefix)}
+            counters = {key: value for key, value in self.counters.items() if key[0].startswith(prefix)}
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {descriptions.get(name, name)}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), (counts, total, count) in sorted(histograms.items()):
+            header(name, "histogram")
+            cumulated = 0
+            for bound, bucket_count in zip(latency_buckets+("+Inf",), counts):
+                cumulated += bucket_count
+                lines.append(f"{name}_bucket{label_text(labels+(('le', str(bound)),))} {cumulated}")
+            lines.append(f"{name}_sum{label_text(labels)} {total}")
+            lines.append(f"{name}_count{label_text(labels)} {count}")
+        for (name, labels), value in sorted(counters.items()):
+            header(name, "counter")
+            lines.append(f"{name}{label_text(labels)} {value}")
+        return "\n".join(lines)+"\n" if lines else ""
+
+    def save(self, path):
+        """
+        Write the ingest metrics (newsrag_ingest_*) to a file at the end of a
+        reindex, for the web server to expose them
+
+        Parameters
+        ----------
+            path : str
+                destination file
+        Returns
+        -------
+            None
+                nothing
+        """
+        if not self.enabled:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path+".tmp", "w") as file:
+            file.write(self.render("newsrag_ingest_"))
+        os.replace(path+".tmp", path)
+
+def label_text(labels):
+    """
+    Label set of a sample, e.g. {stage="knn"}
+    """
+    if not labels:
+        return ""
+    values = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        values.append(f'{name}="{value}"')
+    return "{"+",".join(values)+"}"
+
+def start_trace():
+    """
+    Collect the stage durations of the current request (see server_timing())
+    """
+    current_trace.set(dict())
+
+def server_timing(total):
+    """
+    Server-Timing header value of the current request
+
+    Parameters
+    ----------
+        total : float
+            seconds spent on the request so far
+    Returns
+    -------
+        str
+            one "stage;dur=<milliseconds>" entry per stage, then the total
+    """
+    trace = current_trace.get() or dict()
+    entries = [f"{stage};dur={1000*seconds:.2f}" for stage, seconds in trace.items()]
+    return ", ".join(entries+[f"total;dur={1000*total:.2f}"])
+
+# Metrics of this process, shared by the web server, the toolkit and the ingest pipelines
+metrics = Metrics()
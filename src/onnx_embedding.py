@@ -0,0 +1,255 @@
+""" onnx_embedding.py : embedding model exported to ONNX, quantized to int8 and run by ONNX Runtime on CPU
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+import os
+import sys
+import json
+import shutil
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding, DEFAULT_EMBED_BATCH_SIZE
+from llama_index.core.bridge.pydantic import PrivateAttr
+
+# Files of an exported model directory (ONNX_MODEL_DIR), the model being named after its weights
+model_files = {True: "model.int8.onnx", False: "model.onnx"}
+tokenizer_file = "tokenizer.json"
+config_file = "embedding.json"
+# Pooling modes of sentence-transformers that can be exported
+pooling_modes = ["mean", "cls", "max", "lasttoken"]
+# Optional dependencies of the ONNX backend (see requirements_onnx.txt)
+missing_onnx = "The ONNX embedding backend needs onnxruntime and onnx : pip install -r requirements_onnx.txt"
+
+def pool(hidden, mask, mode):
+    """
+    Sentence vectors from the token vectors of a batch
+
+    Parameters
+    ----------
+        hidden : numpy.ndarray
+            token vectors, (batch, tokens, dim)
+        mask : numpy.ndarray
+            attention mask, (batch, tokens), 0 for padding
+        mode : str
+            one of pooling_modes
+    Returns
+    -------
+        numpy.ndarray
+            sentence vectors, (batch, dim)
+    """
+    mask = mask.astype(np.float32)[:, :, None]
+    match mode:
+        case "mean":
+            return (hidden*mask).sum(axis=1)/np.clip(mask.sum(axis=1), 1e-9, None)
+        case "cls":
+            return hidden[:, 0]
+        case "max":
+            return np.where(mask > 0, hidden, -1e9).max(axis=1)
+        case "lasttoken":
+            last = mask[:, :, 0].sum(axis=1).astype(np.int64)-1
+            return hidden[np.arange(len(hidden)), last]
+
+class OnnxEmbedding(BaseEmbedding):
+    """
+    Embedding model exported by export_onnx(), giving the vectors of the
+    HuggingFaceEmbedding it was exported from (same prompts, truncation,
+    pooling and normalisation), up to the int8 quantization error
+    """
+    _session: object = PrivateAttr()
+    _tokenizer: object = PrivateAttr()
+    _config: dict = PrivateAttr()
+    _input_names: list = PrivateAttr()
+
+    def __init__(self, model_dir, model_name=None, threads=0, embed_batch_size=DEFAULT_EMBED_BATCH_SIZE, **kwargs):
+        """
+        Initialise an OnnxEmbedding object
+
+        Parameters
+        ----------
+            model_dir : str
+                directory written by export_onnx() (ONNX_MODEL_DIR)
+            model_name : str
+                expected HF model name (MODEL_NAME), None to accept any exported model
+            threads : int
+                ONNX Runtime intra-op threads, 0 for one per core
+            embed_batch_size : int
+                max number of texts per forward pass (as HuggingFaceEmbedding)
+        Returns
+        -------
+            OnnxEmbedding
+                An OnnxEmbedding object
+        """
+        # Imported here : only this backend needs them
+        try:
+            import onnxruntime
+        except ImportError as e:
+            raise ImportError(missing_onnx) from e
+        from tokenizers import Tokenizer
+        with open(os.path.join(model_dir, config_file)) as file:
+            config = json.load(file)
+        if model_name is not None and config["model_name"] != model_name:
+            raise ValueError(f"{model_dir} holds {config['model_name']}, not {model_name} : run flask export-onnx")
+        super().__init__(model_name=config["model_name"], embed_batch_size=embed_batch_size, **kwargs)
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        # int8 or float32 weights, as exported (exports of former versions are quantized)
+        model_path = os.path.join(model_dir, model_files[config.get("quantized", True)])
+        self._session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self._input_names = [model_input.name for model_input in self._session.get_inputs()]
+        self._tokenizer = Tokenizer.from_file(os.path.join(model_dir, tokenizer_file))
+        self._tokenizer.enable_truncation(config["max_length"])
+        self._tokenizer.enable_padding(pad_id=config["pad_token_id"], pad_token=config["pad_token"])
+        self._config = config
+
+    @classmethod
+    def class_name(cls):
+        return "OnnxEmbedding"
+
+    def _embed(self, texts, prompt_name=None):
+        """
+        Vectors of texts, as HuggingFaceEmbedding._embed()
+
+        Parameters
+        ----------
+            texts : list
+                texts to embed
+            prompt_name : str
+                "query" or "text" : the prompt of the model prepended to each text
+        Returns
+        -------
+            list
+                one vector (list of floats) per text
+        """
+        prompt = self._config["prompts"].get(prompt_name) or ""
+        texts = [prompt+text for text in texts]
+        # Texts of similar lengths are embedded together, for less padding
+        order = sorted(range(len(texts)), key=lambda i: -len(texts[i]))
+        vectors = [None]*len(texts)
+        for start in range(0, len(order), self.embed_batch_size):
+            batch = order[start:start+self.embed_batch_size]
+            encodings = self._tokenizer.encode_batch([texts[i] for i in batch])
+            ids = np.array([encoding.ids for encoding in encodings], dtype=np.int64)
+            mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+            inputs = {"input_ids": ids, "attention_mask": mask, "token_type_ids": np.zeros_like(ids)}
+            hidden = self._session.run(None, {name: inputs[name] for name in self._input_names})[0]
+            pooled = pool(hidden, mask, self._config["pooling"])
+            if self._config["normalize"]:
+                pooled = pooled/np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            for i, vector in zip(batch, pooled.astype(np.float32)):
+                vectors[i] = vector.tolist()
+        return vectors
+
+    def _get_query_embedding(self, query):
+        return self._embed([query], prompt_name="query")[0]
+
+    async def _aget_query_embedding(self, query):
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text):
+        return self._embed([text], prompt_name="text")[0]
+
+    def _get_text_embeddings(self, texts):
+        return self._embed(texts, prompt_name="text")
+
+def export_onnx(model_name, model_dir, quantize=True):
+    """
+    Export a HF embedding model to ONNX (model.onnx), then quantize its weights
+    to int8 (model.int8.onnx)
+
+    Parameters
+    ----------
+        model_name : str
+            HF model name or local path (MODEL_NAME)
+        model_dir : str
+            output directory (ONNX_MODEL_DIR)
+        quantize : bool
+            False to keep float32 weights (e.g. to measure the quantization error)
+    Returns
+    -------
+        dict
+            the model configuration written to embedding.json
+    """
+    # Imported here : only the export needs torch and the ONNX tools
+    import torch
+    try:
+        from onnx import TensorProto
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        from onnxruntime.transformers.optimizer import optimize_model
+    except ImportError as e:
+        raise ImportError(missing_onnx) from e
+    from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+    embed_model = HuggingFaceEmbedding(model_name=model_name, trust_remote_code=True, device="cpu")
+    model = embed_model._model
+    names = [type(module).__name__ for module in model]
+    if names[:2] != ["Transformer", "Pooling"] or any(name != "Normalize" for name in names[2:]):
+        raise ValueError(f"Cannot export {model_name} : modules {names}")
+    pooling = model[1].get_pooling_mode_str()
+    if pooling not in pooling_modes or not model[1].include_prompt:
+        raise ValueError(f"Cannot export {model_name} : pooling {pooling}")
+    transformer = model[0].auto_model.eval()
+    tokenizer = model.tokenizer
+    sample = tokenizer(["Exemple de texte à exporter."], return_tensors="pt")
+    input_names = [name for name in ["input_ids", "attention_mask", "token_type_ids"] if name in sample]
+
+    class TokenVectors(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.transformer = transformer
+
+        def forward(self, *inputs):
+            return self.transformer(**dict(zip(input_names, inputs)), return_dict=True).last_hidden_state
+
+    print(f"Exporting {model_name} to {model_dir}...", file=sys.stderr)
+    # Models over 2 GB are written with their weights in separate files : the
+    # float32 model is exported in a directory of its own, removed once quantized
+    float_dir = os.path.join(model_dir, "float32") if quantize else model_dir
+    os.makedirs(float_dir, exist_ok=True)
+    float_path = os.path.join(float_dir, model_files[False])
+    axes = {name: {0: "batch", 1: "tokens"} for name in input_names+["last_hidden_state"]}
+    with torch.no_grad():
+        torch.onnx.export(TokenVectors(), tuple(sample[name] for name in input_names), float_path,
+                          input_names=input_names, output_names=["last_hidden_state"], dynamic_axes=axes, opset_version=17)
+    # Attention, layer normalisation and GELU subgraphs fused into single ONNX Runtime operators
+    optimized = optimize_model(float_path, model_type="bert")
+    optimized.save_model_to_file(float_path, use_external_data_format=optimized.model.ByteSize() > 2**31-1)
+    if quantize:
+        print("Quantizing weights to int8...", file=sys.stderr)
+        # Outputs of fused operators have no inferred type : they are float32
+        quantize_dynamic(float_path, os.path.join(model_dir, model_files[True]), weight_type=QuantType.QInt8,
+                         extra_options={"DefaultTensorType": TensorProto.FLOAT})
+        shutil.rmtree(float_dir)
+    # The model of a former export with the other weights is not loaded any more
+    other_path = os.path.join(model_dir, model_files[not quantize])
+    if os.path.exists(other_path):
+        os.remove(other_path)
+    tokenizer.backend_tokenizer.save(os.path.join(model_dir, tokenizer_file))
+    config = {
+        "model_name": model_name,
+        "max_length": model.max_seq_length,
+        "pooling": pooling,
+        "normalize": embed_model.normalize,
+        "prompts": {name: prompt for name, prompt in model.prompts.items() if prompt},
+        "pad_token_id": tokenizer.pad_token_id,
+        "pad_token": tokenizer.pad_token,
+        "dim": model.get_sentence_embedding_dimension(),
+        "quantized": quantize,
+    }
+    with open(os.path.join(model_dir, config_file), "w") as file:
+        json.dump(config, file, indent=1)
+    print("Export completed...", file=sys.stderr)
+    return config
@@ -0,0 +1,343 @@
+""" partitions.py : time-partitioned NEWS vector stores and date-range search
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+import os
+import shutil
+
+import deeplake
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import NodeWithScore
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+
+# Number of characters of an ISO date ("YYYY-MM-DD") kept in partition names
+granularities = {"year": 4, "month": 7, "day": 10}
+# Partition of articles without a valid publication date
+undated = "undated"
+
+def article_date(metadata):
+    """
+    Publication date of an article
+
+    Parameters
+    ----------
+        metadata : dict
+            article metadata, with "year", "month" and "day" fields
+    Returns
+    -------
+        str
+            ISO date ("YYYY-MM-DD"), None if the date is missing or invalid
+    """
+    try:
+        return f"{int(metadata['year']):04d}-{int(metadata['month']):02d}-{int(metadata['day']):02d}"
+    except (KeyError, ValueError, TypeError):
+        return None
+
+def partition_name(metadata, granularity="month"):
+    """
+    Partition of an article
+
+    Parameters
+    ----------
+        metadata : dict
+            article metadata, with "year", "month" and "day" fields
+        granularity : str
+            "year", "month" or "day"
+    Returns
+    -------
+        str
+            e.g. "2024-11" for monthly partitions
+    """
+    date = article_date(metadata)
+    return date[:granularities[granularity]] if date is not None else undated
+
+def list_partitions(vector_dir):
+    """
+    Partitions found on disk
+
+    Parameters
+    ----------
+        vector_dir : str
+            VEC_DIR, holding one Deeplake dataset per partition
+    Returns
+    -------
+        list
+            sorted partition names
+    """
+    try:
+        return sorted(entry.name for entry in os.scandir(vector_dir) if entry.is_dir() and os.path.exists(os.path.join(entry.path, "dataset_meta.json")))
+    except OSError:
+        return []
+
+def directory_bytes(path):
+    """
+    Size of the files under a directory
+    """
+    return sum(os.path.getsize(os.path.join(root, name)) for root, dirs, files in os.walk(path) for name in files)
+
+def prune_partition(path, file_paths, block_rows=65536):
+    """
+    Delete the vectors of some articles from a partition, and compact it (see delete_rows())
+
+    Parameters
+    ----------
+        path : str
+            Deeplake dataset directory of the partition
+        file_paths : set
+            normalized paths of the articles to delete
+        block_rows : int
+            rows whose metadata are read at once
+    Returns
+    -------
+        (int, int)
+            number of vectors deleted, number of bytes reclaimed
+    """
+    return delete_rows(path, lambda metadata: os.path.normpath(metadata.get("file_path", "")) in file_paths, block_rows)
+
+def delete_rows(path, match, block_rows=65536):
+    """
+    Delete the rows of a Deeplake dataset whose metadata match, and compact it :
+    the kept rows are copied to a new dataset, which then replaces it (rows
+    popped from a Deeplake dataset would still take their space on disk)
+
+    Parameters
+    ----------
+        path : str
+            Deeplake dataset directory
+        match : function
+            match(metadata) -> True for the rows to delete
+        block_rows : int
+            rows whose metadata are read at once
+    Returns
+    -------
+        (int, int)
+            number of rows deleted, number of bytes reclaimed
+    """
+    dataset = deeplake.load(path, read_only=True, verbose=False)
+    kept = []
+    for start in range(0, len(dataset), block_rows):
+        for row, metadata in enumerate(dataset["metadata"][start:start+block_rows].data()["value"], start):
+            if not match(metadata):
+                kept.append(row)
+    deleted = len(dataset)-len(kept)
+    if deleted == 0:
+        return 0, 0
+    size = directory_bytes(path)
+    if len(kept) == 0:
+        shutil.rmtree(path)
+        return deleted, size
+    dataset[kept].copy(path+".tmp", overwrite=True, progressbar=False)
+    # Swapped in by renames, running servers reopen the dataset once it is marked updated
+    os.replace(path, path+".pruned")
+    os.replace(path+".tmp", path)
+    shutil.rmtree(path+".pruned")
+    return deleted, size-directory_bytes(path)
+
+def select_partitions(partitions, date_from=None, date_to=None):
+    """
+    Partitions overlapping a date range
+
+    Parameters
+    ----------
+        partitions : list
+            partition names
+        date_from : str
+            first day ("YYYY-MM-DD"), None for no lower bound
+        date_to : str
+            last day ("YYYY-MM-DD"), None for no upper bound
+    Returns
+    -------
+        list
+            (partition name, whether its articles must be filtered by date) pairs
+    """
+    if date_from is None and date_to is None:
+        return [(name, False) for name in partitions]
+    selected = []
+    for name in partitions:
+        if name == undated:
+            continue
+        # Names are prefixes of ISO dates, so they compare with the bounds' prefixes
+        if date_from is not None and name < date_from[:len(name)]:
+            continue
+        if date_to is not None and name > date_to[:len(name)]:
+            continue
+        boundary = (date_from is not None and name == date_from[:len(name)]) or (date_to is not None and name == date_to[:len(name)])
+        selected.append((name, boundary))
+    return selected
+
+def in_range(metadata, date_from=None, date_to=None):
+    """
+    Check that an article was published within a date range
+    """
+    date = article_date(metadata)
+    if date is None:
+        return False
+    return (date_from is None or date >= date_from) and (date_to is None or date <= date_to)
+
+def partition_hits(stores, handle, embedding, k, boundary, date_from=None, date_to=None, overfetch=4, result=None):
+    """
+    Results of a query in one partition, within a date range
+
+    Parameters
+    ----------
+        stores : StoreManager
+            shared read-only handles
+        handle : str
+            partition index name ("<index_name>/<partition>")
+        embedding : list
+            query embedding
+        k : int
+            number of results
+        boundary : bool
+            whether the partition is only partly covered by the date range
+        date_from : str
+            first day ("YYYY-MM-DD"), None for no lower bound
+        date_to : str
+            last day ("YYYY-MM-DD"), None for no upper bound
+        overfetch : int
+            in boundary partitions, k*overfetch results are searched before
+            filtering them by date (more if needed)
+        result : dict
+            results of a k*overfetch search (k if not boundary) already run, None to run it
+    Returns
+    -------
+        list
+            hits ({'text', 'metadata', 'score', 'id'} dicts), best scores first
+    """
+    fetch = k*overfetch if boundary else k
+    while True:
+        if result is None:
+            result = stores.search(handle, embedding=embedding, k=fetch)
+        kept = [offset for offset in range(len(result["score"])) if not boundary or in_range(result["metadata"][offset], date_from, date_to)]
+        # Search further in the partition if too many results were out of the range
+        if len(kept) >= k or len(result["score"]) < fetch:
+            break
+        fetch *= overfetch
+        result = None
+    return [{key: result[key][offset] for key in ["text", "metadata", "score", "id"] if key in result} for offset in kept]
+
+def merge_hits(hits, k):
+    """
+    k best hits of several partitions, as Deeplake search results
+    """
+    # Deeplake scores are cosine similarities : the higher, the better
+    hits = sorted(hits, key=lambda hit: hit["score"], reverse=True)[:k]
+    return {key: [hit[key] for hit in hits] for key in ["text", "metadata", "score", "id"]}
+
+def search_partitions(stores, index_name, vector_dir, embedding, k, date_from=None, date_to=None, overfetch=4):
+    """
+    K Nearest Neighbours search restricted to the partitions overlapping a date range,
+    results of every partition being merged by score
+
+    Parameters
+    ----------
+        stores : StoreManager
+            shared read-only handles, partitions are registered as "<index_name>/<partition>"
+        index_name : str
+            e.g. "NEWS"
+        vector_dir : str
+            VEC_DIR
+        embedding : list
+            query embedding
+        k : int
+            number of results
+        date_from : str
+            first day ("YYYY-MM-DD"), None for no lower bound
+        date_to : str
+            last day ("YYYY-MM-DD"), None for no upper bound
+        overfetch : int
+            in partitions only partly covered by the range, k*overfetch results
+            are searched before filtering them by date (more if needed)
+    Returns
+    -------
+        dict
+            Deeplake search results ('text', 'metadata', 'score', 'id'), best scores first
+    """
+    hits = []
+    for name, boundary in select_partitions(list_partitions(vector_dir), date_from, date_to):
+        handle = stores.register(f"{index_name}/{name}", os.path.join(vector_dir, name))
+        hits.extend(partition_hits(stores, handle, embedding, k, boundary, date_from, date_to, overfetch))
+    return merge_hits(hits, k)
+
+def search_partitions_batch(stores, index_name, vector_dir, embeddings, k, date_from=None, date_to=None, overfetch=4):
+    """
+    K Nearest Neighbours searches of several queries, run together in each
+    partition overlapping a date range (see search_partitions())
+
+    Parameters
+    ----------
+        stores : StoreManager
+            shared read-only handles, partitions are registered as "<index_name>/<partition>"
+        index_name : str
+            e.g. "NEWS"
+        vector_dir : str
+            VEC_DIR
+        embeddings : list
+            query embeddings
+        k : int
+            number of results per query
+        date_from : str
+            first day ("YYYY-MM-DD"), None for no lower bound
+        date_to : str
+            last day ("YYYY-MM-DD"), None for no upper bound
+        overfetch : int
+            see search_partitions()
+    Returns
+    -------
+        list
+            Deeplake search results ('text', 'metadata', 'score', 'id') of each query
+    """
+    hits = [[] for embedding in embeddings]
+    for name, boundary in select_partitions(list_partitions(vector_dir), date_from, date_to):
+        handle = stores.register(f"{index_name}/{name}", os.path.join(vector_dir, name))
+        results = stores.search_batch(handle, embeddings, k*overfetch if boundary else k)
+        for query, result in enumerate(results):
+            hits[query].extend(partition_hits(stores, handle, embeddings[query], k, boundary, date_from, date_to, overfetch, result))
+    return [merge_hits(query_hits, k) for query_hits in hits]
+
+class PartitionRetriever(BaseRetriever):
+    """
+    LlamaIndex retriever over time partitions, for the chat engine
+    """
+    def __init__(self, search, top_k=2):
+        """
+        Initialise a PartitionRetriever object
+
+        Parameters
+        ----------
+            search : function
+                search(query, k) -> Deeplake search results (see search_partitions())
+            top_k : int
+                number of retrieved chunks
+        Returns
+        -------
+            PartitionRetriever
+                A PartitionRetriever object
+        """
+        super().__init__()
+        self.search = search
+        self.top_k = top_k
+
+    def _retrieve(self, query_bundle):
+        result = self.search(query_bundle.query_str, self.top_k)
+        nodes = []
+        for offset in range(len(result["score"])):
+            # LlamaIndex keeps the whole node in the Deeplake metadata
+            node = metadata_dict_to_node(result["metadata"][offset])
+            node.set_content(result["text"][offset])
+            nodes.append(NodeWithScore(node=node, score=result["score"][offset]))
+        return nodes
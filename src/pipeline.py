@@ -0,0 +1,237 @@
+""" pipeline.py : streaming ingest pipeline with bounded queues between stages
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+import sys
+import time
+import queue
+import threading
+
+from metrics import metrics
+
+# End of stream marker, sent by each producer of a queue
+end_of_stream = object()
+# Marker telling one worker to exit, once every producer has ended
+stop_worker = object()
+
+class Stage:
+    """
+    One step of a Pipeline : a function applied by a pool of worker threads
+    to the items of a bounded input queue
+    """
+    def __init__(self, name, function, workers=1, queue_size=64, batch_size=1):
+        """
+        Initialise a Stage object
+
+        Parameters
+        ----------
+            name : str
+                stage name, used in reports
+            function : function
+                function(item) -> iterable of output items (or None),
+                or function(list of items) if batch_size > 1
+            workers : int
+                number of worker threads
+            queue_size : int
+                max number of items waiting in the input queue
+            batch_size : int
+                max number of items given at once to function
+        Returns
+        -------
+            Stage
+                A Stage object
+        """
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.producers = 0
+        self.ended = 0
+        self.running = workers
+        self.stats = {"in": 0, "out": 0, "errors": 0, "busy": 0.0, "max_depth": 0}
+
+    def next_items(self):
+        """
+        Wait for the next item (or batch of items), None at end of stream
+        """
+        items = []
+        while len(items) < self.batch_size:
+            try:
+                item = self.queue.get() if len(items) == 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is stop_worker:
+                if len(items) > 0:
+                    # process the current batch first
+                    self.queue.put(stop_worker)
+                    break
+                return None
+            if item is end_of_stream:
+                with self.lock:
+                    self.ended += 1
+                    finished = self.ended >= self.producers
+                if finished:
+                    # Every worker of this stage (this one included) exits
+                    for worker in range(self.workers):
+                        self.queue.put(stop_worker)
+                continue
+            items.append(item)
+        return items if len(items) > 0 else None
+
+class Pipeline:
+    """
+    Chain of stages running concurrently : memory stays bounded by the queue
+    sizes, and a slow stage (e.g. LLM) overlaps with the others
+    """
+    def __init__(self, stages, report_every=30.0, name="pipeline"):
+        """
+        Initialise a Pipeline object
+
+        Parameters
+        ----------
+            stages : list
+                Stage objects, in processing order
+            report_every : float
+                period (seconds) of progress reports on stderr, 0 for none
+            name : str
+                pipeline name, labelling its metrics
+        Returns
+        -------
+            Pipeline
+                A Pipeline object
+        """
+        self.stages = stages
+        self.report_every = report_every
+        self.name = name
+        self.start = None
+
+    def emit(self, index, outputs):
+        """
+        Send the outputs of stage index to the next stage
+        """
+        stage = self.stages[index]
+        for output in outputs or []:
+            with stage.lock:
+                stage.stats["out"] += 1
+            if index+1 < len(self.stages):
+                following = self.stages[index+1]
+                following.queue.put(output)
+                with following.lock:
+                    following.stats["max_depth"] = max(following.stats["max_depth"], following.queue.qsize())
+
+    def work(self, index):
+        """
+        Worker thread of stage index
+        """
+        stage = self.stages[index]
+        while True:
+            items = stage.next_items()
+            if items is None:
+                break
+            start = time.perf_counter()
+            try:
+                outputs = stage.function(items if stage.batch_size > 1 else items[0])
+                self.emit(index, outputs)
+            except Exception as error:
+                print(f"Error in stage {stage.name}: {error.__class__.__name__}: {error}", file=sys.stderr)
+                with stage.lock:
+                    stage.stats["errors"] += len(items)
+                metrics.increment("newsrag_ingest_errors_total", len(items), pipeline=self.name, stage=stage.name)
+            elapsed = time.perf_counter()-start
+            with stage.lock:
+                stage.stats["in"] += len(items)
+                stage.stats["busy"] += elapsed
+            metrics.observe("newsrag_ingest_stage_seconds", elapsed, pipeline=self.name, stage=stage.name)
+            metrics.increment("newsrag_ingest_items_total", len(items), pipeline=self.name, stage=stage.name)
+        with stage.lock:
+            stage.running -= 1
+            last = stage.running == 0
+        # The last worker of a stage closes the input of the next one
+        if last and index+1 < len(self.stages):
+            self.stages[index+1].queue.put(end_of_stream)
+
+    def feed(self, index, items):
+        """
+        Feeder thread : push external items to the input of stage index
+        """
+        stage = self.stages[index]
+        for item in items:
+            stage.queue.put(item)
+            with stage.lock:
+                stage.stats["max_depth"] = max(stage.stats["max_depth"], stage.queue.qsize())
+        stage.queue.put(end_of_stream)
+
+    def report(self):
+        """
+        Per-stage throughput and queue depth
+
+        Returns
+        -------
+            str
+                one line per stage
+        """
+        elapsed = time.perf_counter()-self.start
+        lines = []
+        for stage in self.stages:
+            with stage.lock:
+                stats = dict(stage.stats)
+            lines.append(
+                f"  {stage.name:<10} {stats['in']:>7} in {stats['out']:>7} out {stats['errors']:>4} errors"
+                f" {stats['in']/elapsed:8.2f} items/s {stats['busy']:8.1f}s busy"
+                f" queue {stage.queue.qsize():>4} (max {stats['max_depth']})"
+            )
+        return f"Pipeline after {elapsed:.1f}s :\n"+"\n".join(lines)
+
+    def run(self, inputs):
+        """
+        Run all stages until every input has gone through the pipeline
+
+        Parameters
+        ----------
+            inputs : dict
+                stage name -> iterable of items fed to that stage
+                (besides the outputs of the previous stage)
+        Returns
+        -------
+            dict
+                stage name -> statistics ("in", "out", "errors", "busy", "max_depth")
+        """
+        self.start = time.perf_counter()
+        for index, stage in enumerate(self.stages):
+            stage.producers = (1 if index > 0 else 0)+(1 if stage.name in inputs else 0)
+            if stage.producers == 0:
+                stage.queue.put(end_of_stream)
+                stage.producers = 1
+        threads = []
+        for index, stage in enumerate(self.stages):
+            if stage.name in inputs:
+                threads.append(threading.Thread(target=self.feed, args=(index, inputs[stage.name]), daemon=True))
+            for worker in range(stage.workers):
+                threads.append(threading.Thread(target=self.work, args=(index,), daemon=True))
+        for thread in threads:
+            thread.start()
+        last_report = self.start
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1.0)
+                if self.report_every > 0 and time.perf_counter()-last_report >= self.report_every:
+                    print(self.report(), file=sys.stderr)
+                    last_report = time.perf_counter()
+        print(self.report(), file=sys.stderr)
+        return {stage.name: dict(stage.stats) for stage in self.stages}
@@ -0,0 +1,176 @@
+""" sessions.py : bounded pool of chat sessions (one conversation memory per user)
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+import time
+import threading
+from collections import OrderedDict
+
+from llama_index.core.retrievers import BaseRetriever
+
+from cache import approximate_size
+
+def memory_size(memory):
+    """
+    Rough memory footprint of a conversation, in bytes
+
+    Parameters
+    ----------
+        memory : BaseMemory
+            LlamaIndex chat memory
+    Returns
+    -------
+        int
+            number of bytes of its messages
+    """
+    return sum(approximate_size(message.content or "") for message in memory.get_all())
+
+class ChatSession:
+    """
+    Conversation of one user : its memory, and the chat engine built on it
+    for the last date range and selection of articles
+    """
+    def __init__(self, memory):
+        self.memory = memory
+        self.engine = None
+        self.date_range = None
+        self.scope = ()
+        self.last_used = time.monotonic()
+        self.bytes = 0
+
+class SessionPool:
+    """
+    Thread-safe pool of chat sessions, keyed by session ID. Sessions idle for
+    longer than a timeout are dropped, and the least recently used ones are
+    evicted when there are too many sessions or when their memories use too
+    many bytes. Requests of different sessions never wait for each other.
+    """
+    def __init__(self, new_memory, max_sessions=256, idle_timeout=1800.0, max_bytes=64*1024*1024):
+        """
+        Initialise a SessionPool object
+
+        Parameters
+        ----------
+            new_memory : function
+                new_memory() -> empty LlamaIndex chat memory of a new session
+            max_sessions : int
+                max number of sessions kept
+            idle_timeout : float
+                sessions unused for that many seconds are dropped
+            max_bytes : int
+                max total size of the conversations kept (see memory_size())
+        Returns
+        -------
+            SessionPool
+                A SessionPool object
+        """
+        self.new_memory = new_memory
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict()
+        self.bytes = 0
+        self.created = 0
+        self.evicted = 0
+
+    def get(self, session_id):
+        """
+        Session of a user, created if it does not exist (or was evicted)
+
+        Parameters
+        ----------
+            session_id : str
+                session ID sent by the client
+        Returns
+        -------
+            ChatSession
+                the session
+        """
+        now = time.monotonic()
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = ChatSession(self.new_memory())
+                self.sessions[session_id] = session
+                self.created += 1
+            else:
+                self.sessions.move_to_end(session_id)
+                # Its previous answers are over : account for them
+                size = memory_size(session.memory)
+                self.bytes += size-session.bytes
+                session.bytes = size
+            session.last_used = now
+            self.evict(now, keep=session_id)
+            return session
+
+    def evict(self, now, keep=None):
+        """
+        Drop idle sessions, then least recently used ones while the pool is over
+        its limits (the caller holds the lock)
+        """
+        for session_id, session in list(self.sessions.items()):
+            if session_id == keep:
+                continue
+            idle = now-session.last_used > self.idle_timeout
+            over = len(self.sessions) > self.max_sessions or self.bytes > self.max_bytes
+            if not idle and not over:
+                break
+            self.bytes -= session.bytes
+            del self.sessions[session_id]
+            self.evicted += 1
+
+    def stats(self):
+        """
+        Number and memory use of sessions
+
+        Returns
+        -------
+            dict
+                "sessions", "bytes", "created", "evicted"
+        """
+        with self.lock:
+            return {"sessions": len(self.sessions), "bytes": self.bytes, "created": self.created, "evicted": self.evicted}
+
+class CachedContextRetriever(BaseRetriever):
+    """
+    LlamaIndex retriever computing the context of a chat session once, at its
+    first question : follow-up questions reuse it without any search
+    """
+    def __init__(self, context):
+        """
+        Initialise a CachedContextRetriever object
+
+        Parameters
+        ----------
+            context : function
+                context(query) -> list of NodeWithScore, called for the first question only
+        Returns
+        -------
+            CachedContextRetriever
+                A CachedContextRetriever object
+        """
+        super().__init__()
+        self.context = context
+        self.lock = threading.Lock()
+        self.nodes = None
+
+    def _retrieve(self, query_bundle):
+        with self.lock:
+            if self.nodes is None:
+                self.nodes = self.context(query_bundle.query_str)
+            return self.nodes
@@ -0,0 +1,104 @@
+""" similarity.py : document similarity search, an uploaded document being searched chunk by chunk
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+from llama_index.core import Document
+from llama_index.core.ingestion import run_transformations
+
+# Ways of combining the scores of the spans of an article (UPLOAD_AGGREGATION)
+aggregations = ["max", "mean", "rrf"]
+# Characters of text accumulated before running the chunker
+split_chars = 16384
+# Constant of reciprocal rank fusion : 1/(rrf_k+rank)
+rrf_k = 60
+
+def text_chunks(blocks, transformations, max_chunks=0):
+    """
+    Chunks of a text read block by block, split as the documents of an index
+    without holding the whole text in memory
+
+    Parameters
+    ----------
+        blocks : iterable
+            successive parts (str) of the text
+        transformations : list
+            LlamaIndex transformations splitting documents (Settings.transformations)
+        max_chunks : int
+            reading stops after this number of chunks, 0 for no limit
+    Returns
+    -------
+        generator
+            chunk texts, in document order
+    """
+    count = 0
+    buffer = ""
+    for block in blocks:
+        buffer += block
+        if len(buffer) < split_chars:
+            continue
+        chunks = [node.get_content() for node in run_transformations([Document(text=buffer)], transformations)]
+        # The last chunk may continue in the next block : it is split again with it
+        for chunk in chunks[:-1]:
+            yield chunk
+            count += 1
+            if count == max_chunks:
+                return
+        buffer = chunks[-1] if chunks else ""
+    if buffer.strip():
+        for node in run_transformations([Document(text=buffer)], transformations):
+            yield node.get_content()
+            count += 1
+            if count == max_chunks:
+                return
+
+def aggregate(results, method="rrf", k=None):
+    """
+    Rank articles from the search results of every chunk of a document
+
+    Parameters
+    ----------
+        results : list
+            Deeplake search results of each chunk ('metadata', 'score', ...), best first
+        method : str
+            "max" : best span score of the article,
+            "mean" : best span score of the article for each chunk, averaged over
+            all chunks (0 for chunks that did not retrieve it),
+            "rrf" : reciprocal rank fusion of the article rankings of every chunk
+        k : int
+            number of articles, None for all of them
+    Returns
+    -------
+        list
+            (file_path, score) pairs, best first
+    """
+    scores = dict()
+    for result in results:
+        # Best span of each article for this chunk, in rank order
+        best = dict()
+        for metadata, score in zip(result["metadata"], result["score"]):
+            best.setdefault(metadata["file_path"], score)
+        for rank, (file_path, score) in enumerate(best.items()):
+            match method:
+                case "max":
+                    scores[file_path] = max(scores.get(file_path, score), score)
+                case "mean":
+                    scores[file_path] = scores.get(file_path, 0.0)+score/len(results)
+                case "rrf":
+                    scores[file_path] = scores.get(file_path, 0.0)+1.0/(rrf_k+rank+1)
+                case _:
+                    raise ValueError(f"Unknown aggregation {method}, not in {aggregations}")
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
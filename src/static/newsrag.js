@@ -6,6 +6,34 @@ let eventSource;
             target_output.value=target_output.value.replace(/ c[0-9]+/g,"");
         }
 
+        function date_range() {
+            // Optional publication date range, as URL parameters
+            var range = "";
+            var date_from = document.getElementById("date_from").value;
+            var date_to = document.getElementById("date_to").value;
+            if (date_from != "") {
+                range += "&from=" + date_from;
+            }
+            if (date_to != "") {
+                range += "&to=" + date_to;
+            }
+            return range;
+        }
+
+        function chat_session() {
+            // Conversation ID of this tab, as URL parameter (the server keeps one history per ID)
+            var id = sessionStorage.getItem("chat_session");
+            if (id == null) {
+                if (window.crypto && crypto.randomUUID) {
+                    id = crypto.randomUUID();
+                } else {
+                    id = Math.random().toString(36).slice(2) + Date.now().toString(36);
+                }
+                sessionStorage.setItem("chat_session", id);
+            }
+            return "&session=" + id;
+        }
+
         function chat(){
             // Make the "Please wait" container visible
             document.getElementById("waiter").style.display = "block";
@@ -29,7 +57,7 @@ let eventSource;
             }
             // Remove concept ID's from query (not useful during chat)
             remove_concepts();
-            query = query_input.value + " " + document.getElementById("docs").value
+            query = query_input.value
             if (query == ""){
                 target_output.innerHTML="<h1>Pardon ? Merci de poser une question !</h1>";
                 // Hide "Please Wait"
@@ -37,7 +65,8 @@ let eventSource;
                 return;
             }
             // Call Patchat and get an EventSource (stream) object in response
-            var answer_source = new EventSource("/answer?query="+ encodeURIComponent(query));
+            var answer_source = new EventSource("/answer?query="+ encodeURIComponent(query) + date_range() + chat_session()
+                + "&docs=" + encodeURIComponent(document.getElementById("docs").value));
             answer_source.onmessage = function (e) {
                 if (e.data == "open"){
                     // copy current output block to history block
@@ -76,7 +105,11 @@ let eventSource;
             // Show "Please Wait"
             waiter.style.display = "block";
             // Get search results
-            xhr.open("GET", "/search?query="+encodeURIComponent(query), true);
+            xhr.open("GET", "/search?query="+encodeURIComponent(query) + date_range(), true);
+            xhr.onprogress = (e) => {
+                // Display result rows as they are streamed
+                target_output.innerHTML=xhr.responseText;
+            };
             xhr.onload = (e) => {
             if (xhr.readyState === 4) {
                 if (xhr.status === 200) {
@@ -113,6 +146,10 @@ let eventSource;
             waiter.style.display = "block";
             // Get search results
             xhr.open("GET", "/extend?query="+encodeURIComponent(query), true);
+            xhr.onprogress = (e) => {
+                // Display result rows as they are streamed
+                target_output.innerHTML=xhr.responseText;
+            };
             xhr.onload = (e) => {
             if (xhr.readyState === 4) {
                 if (xhr.status === 200) {
@@ -0,0 +1,308 @@
+""" stores.py : long-lived Deeplake vector store handles for NewsRAG
+
+    Copyright (C) 2024 Pierre Jourlin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+import os
+import sys
+import time
+import threading
+
+import deeplake
+
+from compression import CompressedVectors, exact_search
+from ann import ann_indexes
+
+# File written in a dataset directory each time a reindex modifies it
+version_stamp = ".newsrag_version"
+# Deeplake files that change whenever a dataset is rewritten
+deeplake_meta_files = ["dataset_meta.json", "version_control_info.json"]
+
+def dataset_version(path):
+    """
+    Compute a cheap signature of a dataset as stored on disk
+
+    Parameters
+    ----------
+        path : str
+            Deeplake dataset directory
+    Returns
+    -------
+        tuple
+            (file name, modification time, size) for the stamp and metadata files,
+            which changes as soon as a reindex has rewritten the dataset
+    """
+    signature = []
+    for name in [version_stamp] + deeplake_meta_files:
+        try:
+            stat = os.stat(os.path.join(path, name))
+            signature.append((name, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            signature.append((name, None, None))
+    return tuple(signature)
+
+def mark_updated(path):
+    """
+    Tell every running StoreManager that a dataset has been modified
+
+    Parameters
+    ----------
+        path : str
+            Deeplake dataset directory
+    Returns
+    -------
+        None
+            nothing
+    """
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, version_stamp), "w") as file:
+        file.write(str(time.time_ns()))
+
+class StoreManager:
+    """
+    Keep one read-only Deeplake handle per index, shared by all Flask threads.
+    A handle is reopened only when the dataset version on disk has changed.
+    """
+    def __init__(self, paths, vector_dtype="float32", overfetch=4, ann_index="none", nprobe=16, ann_min_rows=20000):
+        """
+        Initialise a StoreManager object
+
+        Parameters
+        ----------
+            paths : dict
+                index name (e.g. "NEWS", "WIKI") -> Deeplake dataset directory
+            vector_dtype : str
+                "float32" to search the Deeplake embeddings, "float16" or "int8"
+                to search compressed copies and rescore the best candidates
+            overfetch : int
+                compressed search only : number of candidates rescored, per result
+            ann_index : str
+                approximate nearest neighbour index (see ann.ann_indexes), "none" for exact search
+            nprobe : int
+                number of lists searched per query by the ANN index
+            ann_min_rows : int
+                smaller datasets are searched exactly
+        Returns
+        -------
+            StoreManager
+                A StoreManager object
+        """
+        self.paths = dict(paths)
+        self.handles = dict()
+        self.versions = dict()
+        self.vector_dtype = vector_dtype
+        self.overfetch = overfetch
+        self.ann_index = ann_index
+        self.nprobe = nprobe
+        self.ann_min_rows = ann_min_rows
+        # ANN index or compressed vectors of each open dataset, None for plain Deeplake search
+        self.indexes = dict()
+        # one lock for opening handles, one lock per index for searching,
+        # as Deeplake datasets are not safe for concurrent reads
+        self.open_lock = threading.Lock()
+        self.search_locks = {name: threading.Lock() for name in self.paths}
+        # functions called with the index name when a changed dataset is reopened
+        self.listeners = []
+        # versions of directories holding several datasets (e.g. NEWS partitions)
+        self.roots = dict()
+
+    def open(self, name):
+        """
+        Open a fresh read-only handle (the "cold" path)
+
+        Parameters
+        ----------
+            name : str
+                index name
+        Returns
+        -------
+            deeplake.core.vectorstore.deeplake_vectorstore.DeepLakeVectorStore
+                a read-only vector store
+        """
+        return deeplake.core.vectorstore.deeplake_vectorstore.DeepLakeVectorStore(
+            path=self.paths[name], read_only=True, verbose=False
+        )
+
+    def get(self, name):
+        """
+        Return the shared handle of an index, reopening it if a reindex changed it
+
+        Parameters
+        ----------
+            name : str
+                index name
+        Returns
+        -------
+            deeplake.core.vectorstore.deeplake_vectorstore.DeepLakeVectorStore
+                a read-only vector store
+        """
+        version = dataset_version(self.paths[name])
+        with self.open_lock:
+            if name not in self.handles or self.versions[name] != version:
+                changed = name in self.handles
+                if changed:
+                    print(f"Dataset {name} has changed on disk, reopening it...", file=sys.stderr)
+                self.handles[name] = self.open(name)
+                self.versions[name] = version
+                self.indexes[name] = self.open_index(name, self.handles[name].dataset, version)
+                if changed:
+                    for listener in self.listeners:
+                        listener(name)
+            return self.handles[name]
+
+    def open_index(self, name, dataset, version):
+        """
+        Load (or build) the structure searched instead of the Deeplake embeddings
+
+        Parameters
+        ----------
+            name : str
+                index name
+            dataset : deeplake.core.dataset.Dataset
+                the dataset, opened read-only
+            version : tuple
+                dataset version (see dataset_version())
+        Returns
+        -------
+            object
+                an ANN index, compressed vectors, or None for plain Deeplake search
+        """
+        if self.ann_index != "none" and len(dataset) >= self.ann_min_rows:
+            return ann_indexes[self.ann_index].open(self.paths[name], dataset, self.vector_dtype, version, self.nprobe)
+        if self.vector_dtype != "float32":
+            return CompressedVectors.open(self.paths[name], dataset, self.vector_dtype, version)
+        return None
+
+    def register(self, name, path):
+        """
+        Declare a dataset that is only known at search time (e.g. a NEWS partition)
+
+        Parameters
+        ----------
+            name : str
+                index name, "<index>/<partition>" for partitions
+            path : str
+                Deeplake dataset directory
+        Returns
+        -------
+            str
+                the index name
+        """
+        with self.open_lock:
+            if name not in self.paths:
+                self.paths[name] = path
+                self.search_locks[name] = threading.Lock()
+        return name
+
+    def check(self, name, path):
+        """
+        Drop the handles of the datasets of a directory (e.g. "NEWS/<partition>")
+        if a reindex has marked it as updated
+
+        Parameters
+        ----------
+            name : str
+                index name
+            path : str
+                directory holding the datasets
+        Returns
+        -------
+            None
+                nothing
+        """
+        version = dataset_version(path)
+        with self.open_lock:
+            previous = self.roots.get(name)
+            self.roots[name] = version
+        if previous is not None and previous != version:
+            print(f"Dataset {name} has changed on disk, reopening it...", file=sys.stderr)
+            self.invalidate(name)
+
+    def search(self, name, **kwargs):
+        """
+        Run a k-NN search on the shared handle of an index, through its ANN index
+        or its compressed vectors (see open_index()) for an embedding search
+
+        Parameters
+        ----------
+            name : str
+                index name
+            **kwargs
+                passed to DeepLakeVectorStore.search()
+        Returns
+        -------
+            dict
+                Deeplake search results ('text', 'metadata', 'score', ...)
+        """
+        store = self.get(name)
+        with self.search_locks[name]:
+            index = self.indexes.get(name)
+            if index is not None and "embedding" in kwargs and set(kwargs) <= {"embedding", "k"}:
+                return index.search(store.dataset, kwargs["embedding"], kwargs.get("k", 4), self.overfetch)
+            return store.search(**kwargs)
+
+    def search_batch(self, name, embeddings, k):
+        """
+        Run the k-NN searches of several query embeddings together on the shared
+        handle of an index, reading its embeddings once for all of them
+
+        Parameters
+        ----------
+            name : str
+                index name
+            embeddings : list
+                query embeddings
+            k : int
+                number of results per query
+        Returns
+        -------
+            list
+                Deeplake search results ('text', 'metadata', 'score', ...) of each query
+        """
+        if len(embeddings) == 0:
+            return []
+        if len(embeddings) == 1:
+            return [self.search(name, embedding=embeddings[0], k=k)]
+        store = self.get(name)
+        with self.search_locks[name]:
+            index = self.indexes.get(name)
+            if index is not None:
+                return [index.search(store.dataset, embedding, k, self.overfetch) for embedding in embeddings]
+            return exact_search(store.dataset, embeddings, k)
+
+    def invalidate(self, name=None):
+        """
+        Drop one (or every) handle, so that the next search reopens it, and tell
+        the listeners, even if no handle was open (their caches may hold results
+        of a former version)
+
+        Parameters
+        ----------
+            name : str
+                index name (its partitions included), None for all indexes
+        Returns
+        -------
+            None
+                nothing
+        """
+        with self.open_lock:
+            for key in list(self.handles):
+                if name is None or key == name or key.startswith(name+"/"):
+                    del self.handles[key]
+                    del self.versions[key]
+                    self.indexes.pop(key, None)
+        for listener in self.listeners:
+            listener(name)
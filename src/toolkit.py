@@ -19,24 +19,46 @@
 import os 
 import sys
 import re
-from tqdm import tqdm
+import html
+import shutil
+import time
+import threading
 from markdown import markdown
-import feedparser
 import xmltodict
 import base64 
 from urllib.parse import urlparse
 import json
 from json2html import json2html
 
-import deeplake
+import numpy as np
 import lxml.etree as ET
 from html2text import html2text
-from llama_index.core import Settings, SimpleDirectoryReader, VectorStoreIndex, StorageContext
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+from llama_index.core import Settings, Document
 from llama_index.llms.ollama import Ollama
 from llama_index.core.llms import ChatMessage
 from llama_index.vector_stores.deeplake import DeepLakeVectorStore
 from llama_index.core.memory import ChatMemoryBuffer
+from llama_index.core.chat_engine import ContextChatEngine
+from llama_index.core.ingestion import run_transformations
+from llama_index.core.schema import MetadataMode, NodeWithScore
+
+from stores import StoreManager, mark_updated
+from manifest import IngestManifest, list_articles, expired_days
+from fetcher import FeedFetcher
+from extraction import FieldExtractor
+from cache import FieldCache, TTLCache, EmbeddingCache, CachedEmbedding
+from metadata import MetadataStore
+from batching import EmbeddingBatcher, query_embeddings
+from pipeline import Pipeline, Stage
+from partitions import partition_name, list_partitions, search_partitions, search_partitions_batch, prune_partition, delete_rows, directory_bytes, PartitionRetriever
+from entities import EntityStore, concept_id, entity_id, read_legacy_entities, sidecar_entities
+from compression import vector_dtypes
+from ann import ann_indexes
+from sessions import SessionPool, CachedContextRetriever
+from metrics import metrics
+from components import Components
+from similarity import text_chunks, aggregate, aggregations
+from dedup import DuplicateIndex
 
 # pattern for matching ENT IDs
 concept_pattern = re.compile("^c[0-9]+$")
@@ -53,6 +75,7 @@ xml_extraction_data = [
         "display": "Titre",
         "path": "/article/title/text()",
         "position": 0,
+        "indexed": True,
     },
     {
         "name": "day",                          # day
@@ -74,6 +97,7 @@ xml_extraction_data = [
         "display": "Résumé",
         "path": "/article/summary/text()",
         "position": 0,
+        "indexed": True,
     },
     {
         "name": "link",                          # link
@@ -85,8 +109,314 @@ xml_extraction_data = [
         "display": "Illustration",
         "path": "/article/content/value/text()",
         "position": 0,
+        "indexed": True,
     }
 ]
+# Version of the text indexed for each article (see article_document),
+# changing it triggers a full rebuild of the NEWS index
+document_format = "fields-1"
+# Embedding backends (EMBED_BACKEND) : the HF model run by PyTorch, or its int8 ONNX export
+embed_backends = ["torch", "onnx"]
+
+def xml_fields(root):
+    """
+    Extract the values of XML fields described in xml_extraction_data
+
+    Parameters
+    ----------
+        root : lxml.etree._Element
+            root of an article
+    Returns
+    -------
+        dict
+            field name -> value ("..." if missing)
+    """
+    values=dict()
+    for field in xml_extraction_data:
+        # Value is a parameter value within the Nth result of a xpath query
+        if "position" in field and "parameter" in field:
+            values[field["name"]]=str(root.xpath(field["path"])[field["position"]].get(field["parameter"]))
+        # Value is the Nth result of a xpath query
+        elif "position" in field:
+            tag=root.xpath(field["path"])
+            if len(tag)>field["position"]:
+                values[field["name"]]=str(tag[field["position"]])
+            else:
+                values[field["name"]]="..."
+    return values
+
+def plain_text(value):
+    """
+    Remove the HTML markup that feeds often put in summaries
+
+    Parameters
+    ----------
+        value : str
+            field value
+    Returns
+    -------
+        str
+            text without tags, entities and repeated whitespaces
+    """
+    return " ".join(html.unescape(re.sub("<[^>]*>", " ", value)).split())
+
+def article_document(file_path, root):
+    """
+    Build the document indexed for an article : a compact text made of its
+    "indexed" fields (see xml_extraction_data), the other fields are kept as
+    metadata and are not embedded
+
+    Parameters
+    ----------
+        file_path : str
+            path of the XML article
+        root : lxml.etree._Element
+            root of the article
+    Returns
+    -------
+        llama_index.core.Document
+            the document, whose id is file_path
+    """
+    values=xml_fields(root)
+    text=[]
+    metadata={"file_path": file_path}
+    for field in xml_extraction_data:
+        if field.get("indexed"):
+            if values[field["name"]]!="...":
+                text.append(plain_text(values[field["name"]]))
+        else:
+            metadata[field["name"]]=values[field["name"]]
+    # The title is in the text, and shown by the chat engine
+    metadata["title"]=values["title"]
+    return Document(
+        text="\n".join(line for line in text if line!=""),
+        id_=file_path,
+        metadata=metadata,
+        excluded_embed_metadata_keys=list(metadata.keys()),
+        excluded_llm_metadata_keys=["file_path"],
+    )
+
+def entity_document(ent_id, text):
+    """
+    LlamaIndex document of an entity, for the WIKI index
+
+    Parameters
+    ----------
+        ent_id : int
+            entity ID in the entity store
+        text : str
+            entity name, then its descriptions
+    Returns
+    -------
+        Document
+            the entity text, its ID in metadata (not embedded)
+    """
+    return Document(
+        text=text,
+        id_=concept_id(ent_id),
+        metadata={"entity_id": ent_id},
+        excluded_embed_metadata_keys=["entity_id"],
+        excluded_llm_metadata_keys=["entity_id"],
+    )
+
+def article_metadata(doc):
+    """
+    Read the metadata of an article from its XML file and AI generated sidecar files
+
+    Parameters
+    ----------
+        doc : str
+            path of the XML article
+    Returns
+    -------
+        dict
+            field name -> value, None if the article cannot be parsed
+    """
+    try:
+        root=ET.parse(doc).getroot()
+    except:
+        return None
+    values=xml_fields(root)
+    for field in ai_generated_prompts.keys():
+        with open(field_path(doc, field), "r") as file:
+            values[field]=file.read()
+    return values
+
+def load_embedding_model(model_name, backend="torch", onnx_dir=None, threads=0):
+    """
+    Embedding model of queries and document spans
+
+    Parameters
+    ----------
+        model_name : str
+            HF model name (MODEL_NAME)
+        backend : str
+            "torch" for the HF model (downloaded if needed), "onnx" for its int8
+            ONNX export (see flask export-onnx)
+        onnx_dir : str
+            directory of the ONNX export
+        threads : int
+            ONNX Runtime intra-op threads, 0 for one per core
+    Returns
+    -------
+        BaseEmbedding
+            the embedding model
+    """
+    if backend == "onnx":
+        from onnx_embedding import OnnxEmbedding
+        embed_model = OnnxEmbedding(onnx_dir, model_name, threads)
+    else:
+        # Imported here : sentence-transformers and torch take seconds to import
+        from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+        embed_model = HuggingFaceEmbedding(model_name=model_name, trust_remote_code=True)
+    Settings.embed_model = embed_model
+    return embed_model
+
+def field_path(file_path, field):
+    """
+    Path of the sidecar file of an AI generated field of an article
+
+    Parameters
+    ----------
+        file_path : str
+            path of the XML article
+        field : str
+            AI generated field name
+    Returns
+    -------
+        str
+            <article path without .xml>.<field>.html
+    """
+    path = os.path.splitext(file_path)[0]+"."+field+".html"
+    # Former versions stripped every leading or trailing ".", "x", "m" and "l" of the path
+    legacy = file_path.strip(".xml")+"."+field+".html"
+    if not os.path.exists(path) and os.path.exists(legacy):
+        return legacy
+    return path
+
+def sidecar_descriptions(file_paths, fields=None):
+    """
+    Entity descriptions written next to articles, as merged into the entity store
+
+    Parameters
+    ----------
+        file_paths : iterable
+            paths of the XML articles
+        fields : function
+            fields(file_path) -> AI generated field names to read, None for every field
+    Returns
+    -------
+        dict
+            entity name -> list of descriptions (names longer than 46 characters are not stored)
+    """
+    entity_desc = dict()
+    for file_path in file_paths:
+        for field in (fields(file_path) if fields is not None else None) or ai_generated_prompts.keys():
+            sidecar = field_path(file_path, field)
+            if not os.path.exists(sidecar):
+                continue
+            with open(sidecar, errors="ignore") as file:
+                rendered = file.read()
+            for name, description in sidecar_entities(rendered):
+                if len(name) <= 46:
+                    entity_desc.setdefault(name, []).append(description)
+    return entity_desc
+
+def retention_cutoff(days):
+    """
+    First publication day kept by a retention window
+
+    Parameters
+    ----------
+        days : int
+            number of days kept, today (UTC) included
+    Returns
+    -------
+        str
+            ISO date ("YYYY-MM-DD")
+    """
+    return time.strftime("%Y-%m-%d", time.gmtime(time.time()-(days-1)*86400))
+
+def article_id(file_path):
+    """
+    ID of an article in the web page (checkbox of its search result)
+
+    Parameters
+    ----------
+        file_path : str
+            path of the XML article
+    Returns
+    -------
+        str
+            the ID
+    """
+    return os.path.basename(file_path).strip(".xml")
+
+def result_table_header():
+    """
+    HTML table header of search results
+
+    Returns
+    -------
+        str
+            table opening and column names
+    """
+    output="<table><tr><th>Sélection</th>"
+    # Column names for XML fields
+    for field in xml_extraction_data:
+        if "display" in field:
+            output+=f"<th>{field['display']}</th>"
+            if field['name']=="title":
+                output+=f"<th>Date</th>"
+            if field['name']=="summary":
+                output+=f"<th>Source</th>"
+    # Column names for AI generated fields    
+    for field in ai_generated_prompts.keys():
+        output+=f"<th>✨{ai_generated_prompts[field][0]} (généré par IA)</th>"
+    output+="</tr>\n"
+    return output
+
+def result_table_row(doc, values):
+    """
+    HTML table row of a retrieved article
+
+    Parameters
+    ----------
+        doc : str
+            path of the XML article
+        values : dict
+            field name -> value (see xml_fields() and article_metadata())
+    Returns
+    -------
+        str
+            the row
+    """
+    id=article_id(doc)
+    output='<tr>'
+    output+="<td>"+'<input type="checkbox" id="'+id+'" onchange="append_docs(this)" ></td>'
+    # output of XML fields
+    for field in xml_extraction_data:
+        value=values.get(field["name"])
+        if "display" in field:
+            output+=f"<td>{value if value is not None else ''}</td>"
+        else:
+            match field["name"]:
+                case "day":
+                    date = value
+                case "month":
+                    date += "/"+value
+                case "year":
+                    date += "/"+value
+                    output+=f"<td>{date}</td>"
+                case "link":
+                    domain=urlparse(value).netloc
+                    output+=f'<td><a href="{value}">{domain}</a></td>'
+    # output of AI generated fields
+    for field in ai_generated_prompts.keys():
+        # Empty until the LLM has generated the field
+        output+=f"<td>{values.get(field) or ''}</td>"
+    output+="</tr>\n"
+    return output
 
 class Toolkit:
     """
@@ -112,9 +442,23 @@ class Toolkit:
         # import all configuration values from .env file
         self.query=os.getenv('SEARCH_TERM')
         self.model_name=os.getenv('MODEL_NAME')
+        self.embed_backend=os.getenv('EMBED_BACKEND', 'torch')
+        self.onnx_model_dir=os.getenv('ONNX_MODEL_DIR', '../resources/onnx_model')
+        self.onnx_threads=int(os.getenv('ONNX_THREADS', 0))
         self.doc_limit=int(os.getenv('DOC_LIMIT'))
         self.llm=os.getenv('LLM')
+        self.llm_url=os.getenv('LLM_URL', 'http://localhost:11434')
         self.llm_req_timeout=float(os.getenv('LLM_REQ_TIMEOUT'))
+        self.llm_extract_timeout=float(os.getenv('LLM_EXTRACT_TIMEOUT', self.llm_req_timeout))
+        self.llm_inflight=int(os.getenv('LLM_INFLIGHT', 4))
+        self.llm_retries=int(os.getenv('LLM_RETRIES', 1))
+        self.ai_cache_path=os.getenv('AI_CACHE_PATH', '../resources/ai_fields_cache.sqlite')
+        self.ai_cache_size=int(os.getenv('AI_CACHE_SIZE', 100000))
+        self.metadata_path=os.getenv('METADATA_PATH', '../resources/metadata.json')
+        self.cache_size=int(os.getenv('CACHE_SIZE', 1024))
+        self.cache_ttl=float(os.getenv('CACHE_TTL', 600.0))
+        self.embed_batch_wait=float(os.getenv('EMBED_BATCH_WAIT_MS', 5))/1000
+        self.embed_batch_size=int(os.getenv('EMBED_BATCH_SIZE', 32))
         self.token_limit=int(os.getenv('TOKEN_LIMIT'))
         self.url_list=os.getenv('URL_LIST')
         self.document_dir=os.getenv('DOC_DIR')
@@ -123,50 +467,173 @@ class Toolkit:
         self.ent_vector_dir=os.getenv('ENT_VEC_DIR')
         self.table_cells_maxchars=int(os.getenv('TABLE_CELLS_MAXCHARS'))
         self.span_top_k = int(os.getenv('SPAN_TOPK'))
+        self.manifest_path=os.getenv('MANIFEST_PATH', '../resources/ingest_manifest.json')
+        self.dedup=int(os.getenv('DEDUP', 1))==1
+        self.dedup_path=os.getenv('DEDUP_PATH', '../resources/duplicates.json')
+        self.dedup_distance=int(os.getenv('DEDUP_DISTANCE', 3))
+        self.retention_days=int(os.getenv('RETENTION_DAYS', 0))
+        self.feed_state_path=os.getenv('FEED_STATE_PATH', '../resources/feed_state.json')
+        self.feed_workers=int(os.getenv('FEED_WORKERS', 16))
+        self.feed_per_host=int(os.getenv('FEED_PER_HOST', 2))
+        self.feed_timeout=float(os.getenv('FEED_TIMEOUT', 30.0))
+        self.num_workers=int(os.getenv('NUM_WORKERS'))
+        self.pipeline_queue_size=int(os.getenv('PIPELINE_QUEUE_SIZE', 64))
+        self.ingest_batch_size=int(os.getenv('INGEST_BATCH_SIZE', 32))
+        self.pipeline_report_every=float(os.getenv('PIPELINE_REPORT_EVERY', 30.0))
+        self.embed_cache_dir=os.getenv('EMBED_CACHE_DIR', '../resources/embedding_cache')
+        self.partition_by=os.getenv('PARTITION_BY', 'month')
+        self.chat_top_k=int(os.getenv('CHAT_TOPK', 2))
+        self.chat_scope_top_k=int(os.getenv('CHAT_SCOPE_TOPK', 4))
+        self.upload_max_chunks=int(os.getenv('UPLOAD_MAX_CHUNKS', 64))
+        self.upload_aggregation=os.getenv('UPLOAD_AGGREGATION', 'rrf')
+        self.metrics_file=os.getenv('METRICS_FILE', '../resources/ingest_metrics.prom')
+        metrics.enabled=int(os.getenv('METRICS', 1))==1
+        self.timing_header=metrics.enabled and int(os.getenv('TIMING_HEADER', 0))==1
+        self.vector_dtype=os.getenv('VECTOR_DTYPE', 'float32')
+        self.rescore_overfetch=int(os.getenv('RESCORE_OVERFETCH', 4))
+        self.ann_index=os.getenv('ANN_INDEX', 'none')
+        self.ann_nprobe=int(os.getenv('ANN_NPROBE', 16))
+        self.ann_min_rows=int(os.getenv('ANN_MIN_ROWS', 20000))
+        self.chat_sessions_max=int(os.getenv('CHAT_SESSIONS_MAX', 256))
+        self.chat_session_idle=float(os.getenv('CHAT_SESSION_IDLE', 1800.0))
+        self.chat_sessions_max_bytes=int(os.getenv('CHAT_SESSIONS_MAX_BYTES', 64*1024*1024))
+        self.warm_up=int(os.getenv('WARM_UP', 1))==1
         self.accepted_names = ["NEWS", "WIKI", "BOTH"]
 
         print("Initializing toolkit...",file=sys.stderr)
-        # Get embedding model (used to build vectors from queries and document spans) from HF
-        self.embed_model = HuggingFaceEmbedding(
-            model_name=self.model_name, trust_remote_code=True
-        )
-        Settings.embed_model = self.embed_model
+        # Slow components are loaded by their first use, or in the background by
+        # components.warm_up() (see the embed_model property)
+        self.components = Components()
+        # Embedding model (used to build vectors from queries and document spans), from HF
+        self.components.add("embed_model", lambda: load_embedding_model(self.model_name, self.embed_backend, self.onnx_model_dir, self.onnx_threads))
+        # Queries sent by concurrent requests are embedded together : searches with
+        # the text prompt of the model (as spans), chat retrieval with its query prompt
+        self.text_batcher = EmbeddingBatcher(lambda texts: self.embed_model.get_text_embedding_batch(texts), self.embed_batch_wait, self.embed_batch_size)
+        self.query_batcher = EmbeddingBatcher(lambda queries: query_embeddings(self.embed_model, queries), self.embed_batch_wait, self.embed_batch_size)
         # Tell LlamaIndex to call Ollama for interacting with LLM (e.g. Llama3)
-        self.llm_settings = Ollama(model=self.llm, request_timeout=self.llm_req_timeout)
+        self.llm_settings = Ollama(model=self.llm, base_url=self.llm_url, request_timeout=self.llm_req_timeout)
         Settings.llm = self.llm_settings
+        # One client, shared by all threads, for AI generated fields
+        self.extract_llm = Ollama(model=self.llm, base_url=self.llm_url, request_timeout=self.llm_extract_timeout)
+        # Answers already generated for the same text, prompt and LLM
+        self.components.add("ai_cache", lambda: FieldCache(self.ai_cache_path, self.ai_cache_size), warm=False)
+        # Entity descriptions are collected by concurrent extraction workers
+        self.entity_lock = threading.Lock()
         # Select one of the available index
         # Check index name validity
         if index_name not in self.accepted_names:
             print(f"Error: '{index_name}' is not a valid index name. Accepted values : {self.accepted_names}", file=sys.stderr)
             sys.exit(-1)
-        # Select entities
-        if index_name=="WIKI" or index_name=="BOTH":
-            # Configure deeplake for entities
-            self.ent_vector_store = DeepLakeVectorStore(dataset_path=self.ent_vector_dir)
-            self.ent_index = VectorStoreIndex.from_vector_store(vector_store=self.ent_vector_store, streaming=True, read_only=read_only)
-            self.ent_storage_context = StorageContext.from_defaults(vector_store=self.ent_vector_store)
+        if self.embed_backend not in embed_backends:
+            print(f"Error: '{self.embed_backend}' is not a valid EMBED_BACKEND. Accepted values : {embed_backends}", file=sys.stderr)
+            sys.exit(-1)
+        if self.vector_dtype not in vector_dtypes:
+            print(f"Error: '{self.vector_dtype}' is not a valid VECTOR_DTYPE. Accepted values : {vector_dtypes}", file=sys.stderr)
+            sys.exit(-1)
+        if self.upload_aggregation not in aggregations:
+            print(f"Error: '{self.upload_aggregation}' is not a valid UPLOAD_AGGREGATION. Accepted values : {aggregations}", file=sys.stderr)
+            sys.exit(-1)
+        if self.ann_index != "none" and self.ann_index not in ann_indexes:
+            print(f"Error: '{self.ann_index}' is not a valid ANN_INDEX. Accepted values : {['none']+list(ann_indexes)}", file=sys.stderr)
+            sys.exit(-1)
+        # The WIKI store is searched through self.stores, and rewritten by reindex()
         if index_name=="NEWS" or index_name=="BOTH": 
-            # Configure deeplake for documents
-            self.vector_store = DeepLakeVectorStore(dataset_path=self.vector_dir)
-            self.index = VectorStoreIndex.from_vector_store(vector_store=self.vector_store, streaming=True, read_only=read_only)
-            self.storage_context = StorageContext.from_defaults(vector_store=self.vector_store)
-            self.memory = ChatMemoryBuffer.from_defaults(token_limit=self.token_limit)
-            # Here is the prompt :
-            self.chat_engine = self.index.as_chat_engine(
-            chat_mode="context",
-            memory=self.memory,
-            system_prompt=(
-                "Tu est un chatbot, capable d'avoir des interactions normales et de discuter"
-                " d'actualités. Répond en français."
-            ),
-        )
+            # Documents are stored in one Deeplake dataset per time partition (VEC_DIR/<partition>),
+            # writable stores are opened by reindex() when needed
+            self.vector_stores = dict()
+            # One conversation memory (and chat engine) per chat session, in a bounded pool
+            self.chat_sessions = SessionPool(lambda: ChatMemoryBuffer.from_defaults(token_limit=self.token_limit),
+                                             self.chat_sessions_max, self.chat_session_idle, self.chat_sessions_max_bytes)
         # If needed, makes data directories
-        os.system("mkdir -p "+self.document_dir)
-        os.system("mkdir -p "+self.vector_dir)
-        os.system("mkdir -p "+self.ent_document_dir)
-        os.system("mkdir -p "+self.ent_vector_dir)
+        for directory in [self.document_dir, self.vector_dir, self.ent_document_dir, self.ent_vector_dir]:
+            os.makedirs(directory, exist_ok=True)
+        # Long-lived read-only handles used by retrieve() and extend()
+        self.stores = StoreManager({"NEWS": self.vector_dir, "WIKI": self.ent_vector_dir}, self.vector_dtype, self.rescore_overfetch, self.ann_index, self.ann_nprobe, self.ann_min_rows)
+        # Query embeddings, k-NN hit lists and expanded concepts of recent queries,
+        # cleared as soon as a reindex has changed a dataset
+        self.caches = {
+            "embeddings": TTLCache(self.cache_size, self.cache_ttl),
+            "hits": TTLCache(self.cache_size, self.cache_ttl),
+            "concepts": TTLCache(self.cache_size, self.cache_ttl),
+        }
+        self.stores.listeners.append(lambda name: self.clear_caches())
+        # Version of the NEWS store the caches are filled from, whether or not a handle is open
+        self.stores.check("NEWS", self.vector_dir)
+        # Reindex state, only loaded by reindex() and prune() (never by the web server) :
+        # articles already embedded in the NEWS store, for incremental reindexing
+        self.components.add("manifest", lambda: IngestManifest(self.manifest_path, self.model_name, document_format+"/"+self.partition_by), warm=False)
+        # Fingerprints of indexed stories, and articles linked to them as near-duplicates
+        self.components.add("duplicates", lambda: DuplicateIndex(self.dedup_path, self.dedup_distance), warm=False)
+        # Concurrent RSS downloads, with ETag/Last-Modified kept between runs
+        self.components.add("fetcher", lambda: FeedFetcher(self.feed_state_path, self.feed_per_host, self.feed_timeout), warm=False)
+        # Metadata of indexed articles, so that search results need no XML parsing
+        self.components.add("metadata", lambda: MetadataStore(self.metadata_path, [field["name"] for field in xml_extraction_data]+list(ai_generated_prompts.keys())))
+        # Entities and their descriptions, read by ID for query expansion
+        self.entities = EntityStore(self.ent_document_dir)
+        if read_only:
+            # Shared handles, ANN indexes and compressed vectors of the stores
+            self.components.add("indexes", self.load_indexes)
         print("Initialization completed...",file=sys.stderr)
 
+    @property
+    def embed_model(self):
+        """
+        Embedding model, loaded by its first use
+        """
+        return self.components.get("embed_model")
+
+    @property
+    def ai_cache(self):
+        """
+        Cache of AI generated fields, loaded by its first use
+        """
+        return self.components.get("ai_cache")
+
+    @property
+    def manifest(self):
+        """
+        Ingest manifest of the NEWS store, loaded by its first use
+        """
+        return self.components.get("manifest")
+
+    @property
+    def duplicates(self):
+        """
+        Near-duplicate index of the NEWS store, loaded by its first use
+        """
+        return self.components.get("duplicates")
+
+    @property
+    def fetcher(self):
+        """
+        RSS feed fetcher, loaded by its first use
+        """
+        return self.components.get("fetcher")
+
+    @property
+    def metadata(self):
+        """
+        Metadata of indexed articles, loaded by its first use
+        """
+        return self.components.get("metadata")
+
+    def load_indexes(self):
+        """
+        Open the shared handles of the WIKI store and of the NEWS partitions, with
+        their ANN indexes or compressed vectors, so that first searches are not slowed down
+
+        Returns
+        -------
+            None
+                nothing
+        """
+        print("Loading vector indexes...", file=sys.stderr)
+        if os.path.exists(os.path.join(self.ent_vector_dir, "dataset_meta.json")):
+            self.stores.get("WIKI")
+        self.stores.check("NEWS", self.vector_dir)
+        for name in list_partitions(self.vector_dir):
+            self.stores.get(self.stores.register(f"NEWS/{name}", os.path.join(self.vector_dir, name)))
+
     def get_ai_generated_field(self,text, field):
         """
         Extract a brief description of major strengths of the invention
@@ -182,23 +649,111 @@ class Toolkit:
             str
                 the generated text
         """
-        llm = Ollama(model=self.llm, request_timeout=self.llm_req_timeout)
+        # Do not ask the LLM again for a text it has already processed
+        key = self.ai_cache.key(self.llm, ai_generated_prompts[field][1], text)
+        content = self.ai_cache.get(key)
+        if content is not None:
+            return content
         messages=[
             ChatMessage(role="assistant", content="Tu es un assistant. Réponds correctement aux questions de l'utilisateur."),
             ChatMessage(role="user", content=ai_generated_prompts[field][1]+text)
         ]
         # start llm inference
-        resp = llm.chat(messages)
+        resp = self.extract_llm.chat(messages)
         content = None
         # parse the LLM output
         for item in resp:
             if isinstance(item, tuple) and item[0] == 'message':
                 content = item[1].content
                 break
+        self.ai_cache.put(key, content)
         # return LLM output
         return content
     
-    def retrieve(self, query, query_is_file=False):
+    def embed_query(self, query, prompt="text"):
+        """
+        Embedding of a query text, from cache when possible
+
+        Parameters
+        ----------
+            query : str
+                query text
+            prompt : str
+                prompt of the embedding model : "text" (searches) or "query" (chat retrieval)
+        Returns
+        -------
+            list
+                the embedding vector
+        """
+        key = (prompt, query)
+        embedding = self.caches["embeddings"].get(key)
+        if embedding is None:
+            with metrics.timer("embed_query"):
+                embedding = (self.query_batcher if prompt == "query" else self.text_batcher).embed(query)
+            self.caches["embeddings"].put(key, embedding)
+        return embedding
+
+    def search_store(self, index_name, query, date_from=None, date_to=None, k=None, prompt="text"):
+        """
+        K Nearest Neighbours search of a query in an index, from cache when possible
+
+        Parameters
+        ----------
+            index_name : str
+                "NEWS" or "WIKI"
+            query : str
+                query text
+            date_from : str
+                "NEWS" only : first publication day ("YYYY-MM-DD"), None for no lower bound
+            date_to : str
+                "NEWS" only : last publication day ("YYYY-MM-DD"), None for no upper bound
+            k : int
+                number of results, SPAN_TOPK by default
+            prompt : str
+                prompt of the embedding model for the query (see embed_query())
+        Returns
+        -------
+            dict
+                Deeplake search results ('text', 'metadata', 'score', ...)
+        """
+        k = k or self.span_top_k
+        # Reopens the handle (and clears caches) if a reindex changed the dataset
+        if index_name == "NEWS":
+            self.stores.check(index_name, self.vector_dir)
+        else:
+            self.stores.get(index_name)
+        key = (index_name, query, k, date_from, date_to, prompt)
+        result = self.caches["hits"].get(key)
+        if result is None:
+            embedding = self.embed_query(query, prompt)
+            with metrics.timer("knn_"+index_name.lower()):
+                if index_name == "NEWS":
+                    # Only the partitions overlapping the date range are searched
+                    result = search_partitions(self.stores, index_name, self.vector_dir, embedding, k, date_from, date_to)
+                else:
+                    result = self.stores.search(index_name, embedding=embedding, k=k)
+            self.caches["hits"].put(key, result)
+        return result
+
+    def clear_caches(self):
+        """
+        Empty query caches (called when a dataset has changed)
+        """
+        for cache in self.caches.values():
+            cache.clear()
+
+    def cache_stats(self):
+        """
+        Hit rates and memory use of query caches
+
+        Returns
+        -------
+            dict
+                cache name -> statistics (see TTLCache.stats())
+        """
+        return {name: cache.stats() for name, cache in self.caches.items()}
+
+    def retrieve(self, query, query_is_file=False, date_from=None, date_to=None):
         """
         Retrieve patents by performing a K Nearest Neighbours,
         based on query and patents embeddings 
@@ -208,81 +763,97 @@ class Toolkit:
             query : str
                 input text for query search or document similarity search
             query_is_file : bool
-                Toggle between query search / similarity search
+                Toggle between query search / similarity search (see retrieve_similar())
+            date_from : str
+                first publication day ("YYYY-MM-DD"), None for no lower bound
+            date_to : str
+                last publication day ("YYYY-MM-DD"), None for no upper bound
         Returns
         -------
-            str
-                a string containing the ranked list 
-                of retrieved documents as a HTML table 
+            generator
+                the ranked list of retrieved documents as a HTML table,
+                yielded as the table header, then one row per document
         """
-        if not query_is_file:
-            # First expand all ENT concepts contained in the query
+        if query_is_file:
+            yield from self.retrieve_similar([query], date_from, date_to)
+            return
+        # Render results as a HTML table, send the header right away
+        yield result_table_header()
+        # First expand all ENT concepts contained in the query
+        with metrics.timer("expand_query"):
             query = self.expand_query(query)
         # LLama Index does not provide the search() method for its embedded Deeplake stores, so : 
-        store = deeplake.core.vectorstore.deeplake_vectorstore.DeepLakeVectorStore(path=self.vector_dir)
-        result = store.search(embedding_data=query, embedding_function=self.embed_model.get_text_embedding, k=self.span_top_k)
-        # Get retrieved filenames from Deeplake results
-        docname_list ={result['metadata'][offset]['file_path'] for offset in range(0, len(result['metadata']))}
-        print(docname_list)
-        # Render results as a HTML table
-        output="<table><tr><th>Sélection</th>"
-        # Column names for XML fields
-        for field in xml_extraction_data:
-            if "display" in field:
-                output+=f"<th>{field['display']}</th>"
-                if field['name']=="title":
-                    output+=f"<th>Date</th>"
-                if field['name']=="summary":
-                    output+=f"<th>Source</th>"
-        # Column names for AI generated fields    
-        for field in ai_generated_prompts.keys():
-            output+=f"<th>✨{ai_generated_prompts[field][0]} (généré par IA)</th>"
-        output+="</tr>\n"
-        # Parse all retrieved XML document to extract relevant information
+        result = self.search_store("NEWS", query, date_from, date_to)
+        # Get retrieved filenames from Deeplake results, in rank order
+        docname_list = dict.fromkeys(result['metadata'][offset]['file_path'] for offset in range(0, len(result['metadata'])))
+        yield from self.result_rows(docname_list)
+        yield "</table>\n"
+
+    def retrieve_similar(self, blocks, date_from=None, date_to=None):
+        """
+        Retrieve the articles most similar to a document : the document is split
+        as indexed articles are, the chunks are embedded and searched in batches,
+        and the scores of the retrieved spans are combined per article (UPLOAD_AGGREGATION)
+
+        Parameters
+        ----------
+            blocks : iterable
+                successive parts (str) of the document, e.g. read from an upload
+            date_from : str
+                first publication day ("YYYY-MM-DD"), None for no lower bound
+            date_to : str
+                last publication day ("YYYY-MM-DD"), None for no upper bound
+        Returns
+        -------
+            generator
+                the ranked list of retrieved documents as a HTML table,
+                yielded as the table header, then one row per document
+        """
+        yield result_table_header()
+        self.stores.check("NEWS", self.vector_dir)
+        # Only the first UPLOAD_MAX_CHUNKS chunks are searched
+        chunks = text_chunks(blocks, Settings.transformations, self.upload_max_chunks)
+        results = []
+        while True:
+            with metrics.timer("upload_chunk"):
+                batch = [chunk for _, chunk in zip(range(self.embed_batch_size), chunks)]
+            if not batch:
+                break
+            with metrics.timer("upload_embed"):
+                embeddings = self.embed_model.get_text_embedding_batch(batch)
+            with metrics.timer("knn_news"):
+                results.extend(search_partitions_batch(self.stores, "NEWS", self.vector_dir, embeddings, self.span_top_k, date_from, date_to))
+        with metrics.timer("upload_aggregate"):
+            ranking = aggregate(results, self.upload_aggregation)
+        yield from self.result_rows([file_path for file_path, _ in ranking])
+        yield "</table>\n"
+
+    def result_rows(self, docname_list):
+        """
+        HTML table rows of retrieved articles
+
+        Parameters
+        ----------
+            docname_list : iterable
+                paths of the XML articles, in rank order
+        Returns
+        -------
+            generator
+                one row per article
+        """
+        # Get relevant information from the metadata table, or parse the XML document
+        # for articles indexed before the table existed
+        self.metadata.reload()
         for doc in docname_list:
-            try:
-                root=ET.parse(doc).getroot()
-            except:
+            with metrics.timer("metadata"):
+                values = self.metadata.get(doc)
+                if values is None:
+                    values = article_metadata(doc)
+            if values is None:
                 continue
-            # extract XML fields values
-            for field in xml_extraction_data:
-                # Value is a parameter value within the Nth result of a xpath query
-                if "position" in field and "parameter" in field:
-                    field["value"]=root.xpath(field["path"])[field["position"]].get(field["parameter"])
-                # Value is the Nth result of a xpath query
-                elif "position" in field:
-                    tag=root.xpath(field["path"])
-                    if len(tag)>field["position"]:
-                        field["value"]=root.xpath(field["path"])[field["position"]]
-                    else:
-                        field["value"]="..."
-            id=os.path.basename(doc).strip(".xml")          
-            output+='<tr>'
-            output+="<td>"+'<input type="checkbox" id="'+id+'" onchange="append_docs(this)" ></td>'
-            # output of XML fields
-            for field in xml_extraction_data:
-                if "display" in field:
-                    output+=f"<td>{field["value"]}</td>"
-                else:
-                    match field["name"]:
-                        case "day":
-                            date = field["value"]
-                        case "month":
-                            date += "/"+field["value"]
-                        case "year":
-                            date += "/"+field["value"]
-                            output+=f"<td>{date}</td>"
-                        case "link":
-                            domain=urlparse(field["value"]).netloc
-                            output+=f'<td><a href="{field["value"]}">{domain}</a></td>'
-            # output of AI generated fields
-            for field in ai_generated_prompts.keys():
-                with open(doc.strip(".xml")+"."+field+'.html', "r") as file:
-                    content = file.read()
-                    output+=f"<td>{content}</td>"
-            output+="</tr>\n"
-        output+="</table>\n"
-        return output
+            with metrics.timer("render"):
+                row = result_table_row(doc, values)
+            yield row
 
     def extend(self, query):
         """
@@ -295,17 +866,16 @@ class Toolkit:
                 query text to be expanded
         Returns
         -------
-            str
-                a string that contains an ordered list of 
-                retrieved entities as a HTML table
+            generator
+                an ordered list of retrieved entities as a HTML table,
+                yielded as the table header, then one row per entity
         """
-        store = deeplake.core.vectorstore.deeplake_vectorstore.DeepLakeVectorStore(path=self.ent_vector_dir)
-        result = store.search(embedding_data=query, embedding_function=self.embed_model.get_text_embedding, k=self.span_top_k)
+        yield "<table><tr><th>sélection</th><th>entité</th><th>description</th></tr>\n"
+        result = self.search_store("WIKI", query)
         # Get retrieved concept IDs and their contents
-        concept_list = [result['metadata'][offset]['file_name'] for offset in range(0, len(result['metadata']))]
+        concept_list = [result['metadata'][offset].get('entity_id') for offset in range(0, len(result['metadata']))]
         # print(result['text'])
         content_list = [result['text'][offset] for offset in range(0, len(result['text']))]
-        output="<table><tr><th>sélection</th><th>entité</th><th>description</th></tr>\n"
         num_lines=0
         for offset in range(0, len(result['text'])):
             num_lines+=1
@@ -319,14 +889,16 @@ class Toolkit:
             #forms = sorted(list(filter(lambda f: len(f)>3, forms)))
             if len(forms)<=0: # skip if concept has no form
                 continue
+            # skip concepts indexed before the entity store (run "flask reindex WIKI")
+            if concept_list[offset] is None:
+                continue
             # HTML for the row of selectable concept
-            concept_id = concept_list[offset].strip(".txt")
-            output+="<tr>"
-            output+="<td>"+'<input type="checkbox" id="'+concept_id+'" onchange="append_query(this)" ></td>'
+            output="<tr>"
+            output+="<td>"+'<input type="checkbox" id="'+concept_id(concept_list[offset])+'" onchange="append_query(this)" ></td>'
             output+='<td><b>'+forms[0]+"</b></td><td>"+" ; ".join(forms)+"</td>"
             output+="</tr>"
-        output+="</table>\n"
-        return output
+            yield output
+        yield "</table>\n"
     
     def filter_query(self, query):
         """
@@ -364,11 +936,20 @@ class Toolkit:
         # remove entities from query
         filtered = list(filter(lambda t: not concept_pattern.match(t), terms))
         query = " ".join(filtered)
-        # do query expansion
+        # do query expansion, with cached expansions dropped if a reindex has run
+        self.stores.check("NEWS", self.vector_dir)
+        if self.entities.reload():
+            self.caches["concepts"].clear()
         for concept in concepts:
-            with open(self.ent_document_dir+"/"+concept[:4]+"/"+concept+".txt") as f:
-                content = f.readlines()
-            query+=" "+html2text(" ".join(content)).replace('\n', ' ')
+            expansion = self.caches["concepts"].get(concept)
+            if expansion is None:
+                content = self.entities.get(entity_id(concept))
+                if content is None:
+                    # unknown concept : nothing to expand
+                    continue
+                expansion = html2text(" ".join(content.splitlines(keepends=True))).replace('\n', ' ')
+                self.caches["concepts"].put(concept, expansion)
+            query+=" "+expansion
         return query
 
     def get_json(self, input_text):
@@ -391,7 +972,338 @@ class Toolkit:
         except:
             return {"entités": []}
             
-    def reindex(self, index_name):
+    def write_article(self, post):
+        """
+        Store a feed entry as an XML file in the <year>/<month>/<day>/<hour> tree
+
+        Parameters
+        ----------
+            post : feedparser.FeedParserDict
+                a feed entry
+        Returns
+        -------
+            str
+                path of the new article, None if it already existed
+        """
+        # make a directory structure from published date and hour
+        # e.g. "/2024/11/09/17"
+        path=["/"]
+        path.append(str(post.published_parsed.tm_year))
+        path.append(str(post.published_parsed.tm_mon))
+        path.append(str(post.published_parsed.tm_mday))
+        path.append(str(post.published_parsed.tm_hour))
+        path=self.document_dir+'/'.join(path)
+        article = {
+            "article": post 
+        }
+        # make filename from url
+        content=xmltodict.unparse(article, pretty=True)
+        url = post.id.encode('UTF-8')
+        filename=base64.urlsafe_b64encode(url).decode('UTF-8')[-30:]+".xml"
+        try:
+            os.makedirs(path, exist_ok=True)
+            with open(path+filename, "x") as file:
+                file.write(content)
+                return os.path.normpath(path+filename)
+        except:
+            return None
+
+    def select_news_articles(self, full=False):
+        """
+        List the news articles already on disk that have to be (re)indexed
+
+        Parameters
+        ----------
+            full : bool
+                Select every article (full rebuild) instead of new or changed ones only
+        Returns
+        -------
+            (list, dict)
+                paths of the articles to be indexed, and for already indexed articles that
+                changed, path -> NEWS partition of their previous version (None if unknown)
+        """
+        if full:
+            self.manifest.clear()
+            self.metadata.clear()
+            self.duplicates.clear()
+            # Every description is extracted again
+            self.entities.clear()
+            return list_articles(self.document_dir), dict()
+        new_files, changed_files = self.manifest.select(list_articles(self.document_dir))
+        print(f"{len(new_files)} new and {len(changed_files)} changed articles to index...")
+        # Descriptions of the fields extracted again are replaced by the new ones
+        self.entities.remove(sidecar_descriptions(changed_files, self.manifest.retry_fields))
+        return new_files+changed_files, {file_path: self.manifest.partition(file_path) for file_path in changed_files}
+
+    def save_ai_generated_field(self, file_path, field, generated_text, entity_desc):
+        """
+        Write an AI generated field next to its article and collect its entities
+
+        Parameters
+        ----------
+            file_path : str
+                article path
+            field : str
+                AI generated field name (see ai_generated_prompts)
+            generated_text : str
+                LLM answer (fields the LLM failed to extract are not saved)
+            entity_desc : dict
+                entity name -> descriptions, updated in place
+        Returns
+        -------
+            None
+                nothing
+        """
+        filename = field_path(file_path, field)
+        generated_entities = self.get_json(generated_text)
+        with self.entity_lock:
+            for entity in generated_entities['entités']:
+                if "Description" in entity and type(entity["Description"]) is str:
+                    if entity["Nom"] in entity_desc:
+                        entity_desc[entity["Nom"]]+=entity["Description"]+'\n'
+                    else:
+                        entity_desc[entity["Nom"]]=entity["Description"]+'\n'
+        rendered = json2html.convert(json = generated_entities)
+        with open(filename, "w") as file:
+            file.write(rendered)
+        self.metadata.put(file_path, {field: rendered})
+
+    def embedding_cache(self, index_name):
+        """
+        Embedding model used to index chunks, backed by the persistent cache of an index
+
+        Parameters
+        ----------
+            index_name : str
+                "NEWS" or "WIKI"
+        Returns
+        -------
+            (CachedEmbedding, EmbeddingCache)
+                the embedding model and its cache
+        """
+        cache = EmbeddingCache(os.path.join(self.embed_cache_dir, index_name), self.model_name)
+        return CachedEmbedding(self.embed_model, cache), cache
+
+    def report_embedding_cache(self, cache, compact_since=None):
+        """
+        Print the hit rate of an embedding cache, compacting it first if requested
+
+        Parameters
+        ----------
+            cache : EmbeddingCache
+                cache used by a reindex
+            compact_since : float
+                start time of a full rebuild : entries not used since are dropped
+        Returns
+        -------
+            None
+                nothing
+        """
+        stats = cache.stats()
+        print(f"Embedding cache : {stats['hits']} hits, {stats['misses']} misses ({100*stats['hit_rate']:.1f}% hit rate)")
+        if compact_since is not None:
+            compacted = cache.compact(compact_since)
+            print(f"Embedding cache compacted : {compacted['entries']} entries kept, {compacted['dropped']} dropped, {compacted['bytes']} bytes reclaimed")
+
+    def partition_store(self, name):
+        """
+        Writable vector store of a NEWS partition, created if needed
+
+        Parameters
+        ----------
+            name : str
+                partition name (see partitions.partition_name())
+        Returns
+        -------
+            DeepLakeVectorStore
+                the LlamaIndex vector store of the partition
+        """
+        if name not in self.vector_stores:
+            self.vector_stores[name] = DeepLakeVectorStore(dataset_path=os.path.join(self.vector_dir, name), verbose=False)
+        return self.vector_stores[name]
+
+    def delete_vectors(self, doc_id, partition=None):
+        """
+        Delete the vectors of an indexed article from the NEWS store
+
+        Parameters
+        ----------
+            doc_id : str
+                article ID (ref_doc_id of its nodes)
+            partition : str
+                partition holding its vectors, None if unknown : every partition is searched
+        Returns
+        -------
+            None
+                nothing
+        """
+        names = set(list_partitions(self.vector_dir)) | set(self.vector_stores)
+        if partition is not None:
+            names &= {partition}
+        for name in sorted(names):
+            self.partition_store(name).delete(ref_doc_id=doc_id)
+
+    def news_pipeline(self, changed, entity_desc, extractor, embed_model, skipped):
+        """
+        Build the NEWS ingest pipeline : fetch -> write -> load -> dedup -> extract -> chunk -> embed -> store.
+        Stages run concurrently with bounded queues in between, so that memory stays flat
+        and the LLM, the embedding model and Deeplake work at the same time.
+
+        Parameters
+        ----------
+            changed : dict
+                already indexed articles whose vectors must be replaced : path -> partition
+                of their previous vectors, None if unknown
+            entity_desc : dict
+                entity name -> descriptions, filled by the extract stage
+            extractor : FieldExtractor
+                LLM calls with retries, for AI generated fields
+            embed_model : BaseEmbedding
+                embedding model for chunks (e.g. a CachedEmbedding)
+            skipped : list
+                filled by the dedup stage with the documents of near-duplicate articles
+        Returns
+        -------
+            Pipeline
+                feed URLs to the "fetch" stage, article paths to the "load" stage
+        """
+        doc_limit=int(os.getenv("DOC_LIMIT"))
+        # file path -> AI generated fields the LLM failed to extract
+        failed=dict()
+        loaded=[0]
+        load_lock=threading.Lock()
+
+        def fetch(url):
+            return self.fetcher.fetch_one(url)
+
+        def write(post):
+            # Articles already out of the retention window are not written again
+            if self.retention_days > 0 and time.strftime("%Y-%m-%d", post.published_parsed) < retention_cutoff(self.retention_days):
+                return []
+            file_path=self.write_article(post)
+            return [file_path] if file_path is not None else []
+
+        def load(file_path):
+            with load_lock:
+                if doc_limit>0 and loaded[0]>=doc_limit:
+                    return []
+                loaded[0]+=1
+            # parse xml file
+            try:
+                root=ET.parse(file_path).getroot()
+            except:
+                # index the raw content of articles that are not valid XML
+                with open(file_path, errors="ignore") as file:
+                    return [(Document(text=file.read(), id_=file_path, metadata={"file_path": file_path}), None)]
+            return [(article_document(file_path, root), root)]
+
+        def dedup(item):
+            doc, root = item
+            if not self.dedup or root is None:
+                return [item]
+            canonical=self.duplicates.check(doc.metadata["file_path"], doc.text)
+            if canonical is None:
+                return [item]
+            # Same story as an indexed article : neither extracted nor embedded
+            self.manifest.record(doc.metadata["file_path"])
+            skipped.append(doc)
+            return []
+
+        def extract(item):
+            doc, root = item
+            if root is None:
+                return [doc]
+            file_path=doc.metadata["file_path"]
+            self.metadata.put(file_path, xml_fields(root))
+            text="\n".join(root.xpath('//text()'))[:self.token_limit]
+            # An unchanged article is only sent again for the fields that failed last time
+            for field in self.manifest.retry_fields(file_path) or ai_generated_prompts.keys():
+                generated_text=extractor.extract(text, field)
+                if generated_text is None:
+                    # Extracted again by the next reindex, shown empty until then
+                    failed.setdefault(os.path.normpath(file_path), []).append(field)
+                    self.metadata.put(file_path, {field: ""})
+                    continue
+                self.save_ai_generated_field(file_path, field, generated_text, entity_desc)
+            return [doc]
+
+        def chunk(doc):
+            return [(doc, run_transformations([doc], Settings.transformations))]
+
+        def embed(batch):
+            nodes=[node for doc, doc_nodes in batch for node in doc_nodes]
+            if len(nodes) > 0:
+                embeddings=embed_model.get_text_embedding_batch([node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes])
+                for node, embedding in zip(nodes, embeddings):
+                    node.embedding=embedding
+            return batch
+
+        def store(batch):
+            # Articles go to the partition of their publication date
+            partitions=dict()
+            for doc, doc_nodes in batch:
+                file_path=os.path.normpath(doc.metadata["file_path"])
+                # Upsert : remove the previous vectors of changed articles, whose date may have changed
+                if file_path in changed:
+                    self.delete_vectors(doc.doc_id, changed[file_path])
+                partitions.setdefault(partition_name(doc.metadata, self.partition_by), []).extend(doc_nodes)
+            for name, nodes in partitions.items():
+                if len(nodes) > 0:
+                    self.partition_store(name).add(nodes)
+            for doc, doc_nodes in batch:
+                file_path=os.path.normpath(doc.metadata["file_path"])
+                self.manifest.record(file_path, failed.pop(file_path, None), partition_name(doc.metadata, self.partition_by))
+                self.duplicates.confirm(file_path)
+            return [doc.doc_id for doc, doc_nodes in batch]
+
+        return Pipeline([
+            Stage("fetch", fetch, self.feed_workers, self.pipeline_queue_size),
+            Stage("write", write, 1, self.pipeline_queue_size),
+            Stage("load", load, self.num_workers, self.pipeline_queue_size),
+            Stage("dedup", dedup, 1, self.pipeline_queue_size),
+            Stage("extract", extract, self.llm_inflight, self.pipeline_queue_size),
+            Stage("chunk", chunk, self.num_workers, self.pipeline_queue_size),
+            Stage("embed", embed, 1, self.pipeline_queue_size, self.ingest_batch_size),
+            Stage("store", store, 1, self.pipeline_queue_size, self.ingest_batch_size),
+        ], self.pipeline_report_every, "news")
+
+    def wiki_pipeline(self, embed_model):
+        """
+        Pipeline chunking, embedding and storing entity documents in the WIKI store
+
+        Parameters
+        ----------
+            embed_model : BaseEmbedding
+                embedding model (usually wrapped in a CachedEmbedding)
+        Returns
+        -------
+            Pipeline
+                a pipeline fed with entity documents at its "chunk" stage
+        """
+        def chunk(doc):
+            return [run_transformations([doc], Settings.transformations)]
+
+        def embed(batch):
+            nodes=[node for doc_nodes in batch for node in doc_nodes]
+            if len(nodes) > 0:
+                embeddings=embed_model.get_text_embedding_batch([node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes])
+                for node, embedding in zip(nodes, embeddings):
+                    node.embedding=embedding
+            return batch
+
+        def store(batch):
+            nodes=[node for doc_nodes in batch for node in doc_nodes]
+            if len(nodes) > 0:
+                self.ent_vector_store.add(nodes)
+            return [len(doc_nodes) for doc_nodes in batch]
+
+        return Pipeline([
+            Stage("chunk", chunk, self.num_workers, self.pipeline_queue_size),
+            Stage("embed", embed, 1, self.pipeline_queue_size, self.ingest_batch_size),
+            Stage("store", store, 1, self.pipeline_queue_size, self.ingest_batch_size),
+        ], self.pipeline_report_every, "wiki")
+
+    def reindex(self, index_name, full=False):
         """
         Load, store, index data as vectors of text spans embedding
 
@@ -399,6 +1311,8 @@ class Toolkit:
         ----------
             index_name : str
                 "NEWS" stands for news feeds, "WIKI" stands for Wikipedia entities, "BOTH" stands for both indexes
+            full : bool
+                Rebuild the NEWS index from scratch instead of appending new or changed articles
         Returns
         -------
             None
@@ -409,110 +1323,305 @@ class Toolkit:
             print(f"Reindexing News feeds...")
             # Find all news feed URLs
             with open(self.url_list) as file:
-                urls = [line.rstrip() for line in file]
-                nb_docs=0
-            for url in urls:
-                f=feedparser.parse(url)
-                for post in f.entries:
-                    # make a directory structure from published date and hour
-                    # e.g. "/2024/11/09/17"
-                    path=["/"]
-                    path.append(str(post.published_parsed.tm_year))
-                    path.append(str(post.published_parsed.tm_mon))
-                    path.append(str(post.published_parsed.tm_mday))
-                    path.append(str(post.published_parsed.tm_hour))
-                    path=self.document_dir+'/'.join(path)
-                    article = {
-                        "article": post 
-                    }
-                    # make filename from url
-                    content=xmltodict.unparse(article, pretty=True)
-                    url = post.id.encode('UTF-8')
-                    filename=base64.urlsafe_b64encode(url).decode('UTF-8')[-30:]+".xml"
-                    try:
-                        os.system("mkdir -p "+path)
-                        with open(path+filename, "x") as file:
-                            # Make directory
-                            file.write(content)
-                            nb_docs+=1
-                    except:
-                        pass
-            print(f"Storing {nb_docs} news embeddings to disk...")
-            # Load documents and build index
-            print("loading data...")
-            documents = SimpleDirectoryReader(self.document_dir, recursive=True).load_data(num_workers=int(os.getenv('NUM_WORKERS')))
-            print("Extract AI generated fields...")
-            entity_desc=dict()
-            doc_limit=int(os.getenv("DOC_LIMIT"))
-            if doc_limit>0:
-                documents=documents[:doc_limit]
-            for doc in tqdm(documents):
-                if len(doc.text) == 0:
-                    continue
-                # parse xml file
-                try:
-                    root=ET.fromstring(bytes(doc.text, encoding='utf8'))
-                except:
-                    continue
-                # Add title to deeplake index
-                title=root.xpath("/article/title/text()")
-                doc.metadata["title"]=str(title)
-                # Extract AI generated files
-                for field in ai_generated_prompts.keys():
-                    filename = doc.metadata["file_path"].strip(".xml")+'.'+field+'.html'
-                    with open(filename, "w") as file:
-                        generated_text=self.get_ai_generated_field("\n".join(root.xpath('//text()'))[:self.token_limit], field)
-                        generated_entities = self.get_json(generated_text)
-                        #print(generated_entities)
-                        entity_list = generated_entities['entités']
-                        for entity in entity_list:
-                            if "Description" in entity and type(entity["Description"]) is str:
-                                if entity["Nom"] in entity_desc:
-                                    entity_desc[entity["Nom"]]+=entity["Description"]+'\n'
-                                else:
-                                    entity_desc[entity["Nom"]]=entity["Description"]+'\n'
-                        file.write(json2html.convert(json = generated_entities))
-                        #file.write("# None")
-            # Write entities and their descriptions to files
-            ent_id=0
-            for ent in tqdm(entity_desc):
-                filename=ent.replace(" ", "_").replace("/", " ")+".txt"
-                if len(filename)>50:
-                    continue
-                path = self.ent_document_dir + str(ent_id)[:6].replace("",'/')
-                os.makedirs(path, exist_ok=True)
-                with open(path+filename, "a+") as file:
-                    file.write(ent+'\n'+entity_desc[ent])
-                ent_id+=1
+                urls = [line.rstrip() for line in file if line.strip() != ""]
+            if not full and not self.manifest.compatible():
+                print("Embedding model or document format has changed, switching to a full rebuild...")
+                full = True
+            # Articles already on disk but not indexed yet, new articles come from the feeds
+            file_paths, changed = self.select_news_articles(full)
             # embedding model
             Settings.embed_model = self.embed_model
             # ollama
             Settings.llm = self.llm_settings
-            print("Indexing articles can take some time...")
-            os.system("mkdir -p"+self.vector_dir)
-            self.index = VectorStoreIndex.from_documents(
-                documents, show_progress=True, storage_context=self.storage_context
-            )
-            print("Indexing articles completed...")
+            if full:
+                # Start from empty partitions
+                shutil.rmtree(self.vector_dir, ignore_errors=True)
+                os.makedirs(self.vector_dir, exist_ok=True)
+                self.vector_stores = dict()
+            print("Fetching, extracting AI generated fields and indexing articles can take some time...")
+            entity_desc=dict()
+            extractor = FieldExtractor(self.get_ai_generated_field, self.llm_retries)
+            # Chunks embedded by a previous build are read from the cache
+            embed_model, embed_cache = self.embedding_cache("NEWS")
+            start = time.time()
+            skipped = []
+            stats = self.news_pipeline(changed, entity_desc, extractor, embed_model, skipped).run({"fetch": urls, "load": file_paths})
+            self.fetcher.save()
+            # Stories whose canonical article was not stored are compared again by the next reindex
+            for file_path in self.duplicates.rollback():
+                self.manifest.forget(file_path)
+            for doc in skipped:
+                # Changed articles that became duplicates of another one
+                if os.path.normpath(doc.metadata["file_path"]) in changed:
+                    self.delete_vectors(doc.doc_id, changed[os.path.normpath(doc.metadata["file_path"])])
+            metrics.increment("newsrag_ingest_duplicates_total", len(skipped), pipeline="news")
+            print(f"Near-duplicates : {len(skipped)} articles skipped, saving {len(skipped)*len(ai_generated_prompts)} LLM requests"
+                  f" and the embedding of {sum(len(doc.text) for doc in skipped)} characters ({len(self.duplicates)} stories fingerprinted)")
+            print(f"Feeds : {self.fetcher.stats['fetched']} downloaded, {self.fetcher.stats['not_modified']} unchanged, {self.fetcher.stats['errors']} errors")
+            print(f"AI generated fields : {extractor.stats['done']} done, {extractor.stats['retried']} retries, {extractor.stats['skipped']} skipped"
+                  f" ({self.manifest.pending()} articles to be extracted again by the next reindex)")
+            cache_stats = self.ai_cache.stats()
+            print(f"AI generated fields cache : {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['entries']} entries")
+            # After a full rebuild, cached chunks that were not used no longer exist
+            self.report_embedding_cache(embed_cache, start if full else None)
+            # Add entities and their descriptions to the entity store,
+            # longer names are mostly extraction noise
+            if len(self.entities) == 0:
+                # Entities written as text files by former versions are imported once
+                entity_desc = {**read_legacy_entities(self.ent_document_dir), **entity_desc}
+            new_entities = self.entities.merge({ent: desc for ent, desc in entity_desc.items() if len(ent) <= 46})
+            print(f"Entities : {new_entities} new, {len(self.entities)} in store")
+            self.manifest.save()
+            self.metadata.save()
+            self.duplicates.save()
+            # Running servers will reopen their NEWS handles
+            for name in self.vector_stores:
+                mark_updated(os.path.join(self.vector_dir, name))
+            mark_updated(self.vector_dir)
+            self.stores.invalidate("NEWS")
+            if self.vector_dtype != "float32" or self.ann_index != "none":
+                # Build the ANN indexes (or compressed vectors) of updated partitions now rather than at the first search
+                for name in self.vector_stores:
+                    self.stores.get(self.stores.register(f"NEWS/{name}", os.path.join(self.vector_dir, name)))
+            print(f"Indexing articles completed ({stats['write']['out']} new articles, {stats['store']['in']} articles embedded)...")
         # Indexing Wikipedia concepts and their forms
         if index_name in ["WIKI", "BOTH"]:
             print(f"Reindexing WIKI...")
-            os.system("mkdir -p "+self.ent_vector_dir)
-            # Load documents and build index
-            concepts = SimpleDirectoryReader(self.ent_document_dir, recursive=True).load_data(num_workers=int(os.getenv('NUM_WORKERS')))
+            os.makedirs(self.ent_vector_dir, exist_ok=True)
             # embedding model
             Settings.embed_model = self.embed_model
             # ollama
             Settings.llm = self.llm_settings
             print("Indexing concepts can take some time...")
-            self.ent_index = VectorStoreIndex.from_documents(
-                concepts, show_progress=True, storage_context=self.ent_storage_context
-            )
+            embed_model, embed_cache = self.embedding_cache("WIKI")
+            start = time.time()
+            # Every concept is indexed again, streamed from the entity store
+            self.entities.reload()
+            self.ent_vector_store = DeepLakeVectorStore(dataset_path=self.ent_vector_dir, overwrite=True)
+            stats = self.wiki_pipeline(embed_model).run({"chunk": (entity_document(ent_id, text) for ent_id, text in self.entities.items())})
+            print(f"{stats['store']['in']} concepts indexed")
+            # Every concept is embedded again, the other cached chunks are obsolete
+            self.report_embedding_cache(embed_cache, start)
+            mark_updated(self.ent_vector_dir)
+            self.stores.invalidate("WIKI")
+            if self.vector_dtype != "float32" or self.ann_index != "none":
+                self.stores.get("WIKI")
             print("Indexing concepts completed...")
         if index_name not in ["WIKI", "NEWS", "BOTH"]:
             print("Error : Invalid index name. Choose 'NEWS' for patents or 'ENT' for entities", file=sys.stderr)
+            return
+        # Stage timings of this reindex, exposed by the web server (/metrics)
+        metrics.save(self.metrics_file)
+
+    def update_concepts(self, entity_ids):
+        """
+        Index again the concepts of some entities (e.g. whose descriptions have
+        been removed), the other concepts of the WIKI store being kept
+
+        Parameters
+        ----------
+            entity_ids : list
+                IDs of the entities in the entity store
+        Returns
+        -------
+            int
+                number of bytes reclaimed in the WIKI store
+        """
+        os.makedirs(self.ent_vector_dir, exist_ok=True)
+        Settings.embed_model = self.embed_model
+        Settings.llm = self.llm_settings
+        wiki_bytes = directory_bytes(self.ent_vector_dir)
+        # Vectors of the previous descriptions, the WIKI store is compacted
+        entity_ids = set(entity_ids)
+        if os.path.exists(os.path.join(self.ent_vector_dir, "dataset_meta.json")):
+            delete_rows(self.ent_vector_dir, lambda metadata: metadata.get("entity_id") in entity_ids)
+        embed_model, embed_cache = self.embedding_cache("WIKI")
+        self.entities.reload()
+        self.ent_vector_store = DeepLakeVectorStore(dataset_path=self.ent_vector_dir, overwrite=False)
+        stats = self.wiki_pipeline(embed_model).run({"chunk": (entity_document(ent_id, self.entities.get(ent_id)) for ent_id in sorted(entity_ids))})
+        print(f"{stats['store']['in']} concepts indexed again")
+        self.report_embedding_cache(embed_cache)
+        mark_updated(self.ent_vector_dir)
+        self.stores.invalidate("WIKI")
+        if self.vector_dtype != "float32" or self.ann_index != "none":
+            self.stores.get("WIKI")
+        return wiki_bytes-directory_bytes(self.ent_vector_dir)
+
+    def prune(self, days=None):
+        """
+        Delete the articles published before a retention window, with their AI
+        generated fields, their vectors and their entity descriptions, then compact
+        the NEWS partitions they were stored in and the WIKI store.
+        No full reindex is needed : other articles keep their vectors.
+
+        Parameters
+        ----------
+            days : int
+                number of days kept, today included (default : RETENTION_DAYS), 0 keeps everything
+        Returns
+        -------
+            dict
+                articles, document bytes, vectors and vector bytes deleted,
+                entities updated, descriptions removed and copies to reindex
+        """
+        days = self.retention_days if days is None else days
+        if days <= 0:
+            print("No retention window (RETENTION_DAYS is 0) : every article is kept")
+            return None
+        cutoff = retention_cutoff(days)
+        print(f"Pruning articles published before {cutoff}...")
+        days_expired = expired_days(self.document_dir, cutoff)
+        expired = set()
+        document_bytes = 0
+        for day_dir, date in days_expired:
+            expired.update(list_articles(day_dir))
+            document_bytes += directory_bytes(day_dir)
+        # Descriptions added to the entity store by the expired articles
+        entity_desc = sidecar_descriptions(sorted(expired))
+        # Vectors of the expired articles, partitions are compacted
+        vectors, vector_bytes, pruned = 0, 0, []
+        for name in list_partitions(self.vector_dir):
+            deleted, reclaimed = prune_partition(os.path.join(self.vector_dir, name), expired)
+            if deleted > 0:
+                vectors += deleted
+                vector_bytes += reclaimed
+                pruned.append(name)
+                print(f"Partition {name} : {deleted} vectors deleted, {reclaimed} bytes reclaimed")
+        self.vector_stores = dict()
+        # Copies of an expired story are indexed by the next reindex
+        orphans = sorted(path for path, canonical in self.duplicates.canonical.items() if canonical in expired and path not in expired)
+        for file_path in sorted(expired)+orphans:
+            self.manifest.forget(file_path)
+            self.duplicates.remove(file_path)
+        self.metadata.remove(expired)
+        for day_dir, date in days_expired:
+            shutil.rmtree(day_dir, ignore_errors=True)
+            # Month and year directories left empty
+            for parent in [os.path.dirname(day_dir), os.path.dirname(os.path.dirname(day_dir))]:
+                if os.path.isdir(parent) and not os.listdir(parent):
+                    os.rmdir(parent)
+        self.manifest.save()
+        self.metadata.save()
+        self.duplicates.save()
+        # Running servers will reopen their NEWS handles
+        for name in pruned:
+            if os.path.isdir(os.path.join(self.vector_dir, name)):
+                mark_updated(os.path.join(self.vector_dir, name))
+        mark_updated(self.vector_dir)
+        self.stores.invalidate("NEWS")
+        if self.vector_dtype != "float32" or self.ann_index != "none":
+            for name in pruned:
+                if os.path.isdir(os.path.join(self.vector_dir, name)):
+                    self.stores.get(self.stores.register(f"NEWS/{name}", os.path.join(self.vector_dir, name)))
+        entity_ids = self.entities.remove(entity_desc)
+        stats = {
+            "articles": len(expired),
+            "document_bytes": document_bytes,
+            "vectors": vectors,
+            "vector_bytes": vector_bytes,
+            "entities": len(entity_ids),
+            "descriptions": sum(len(descriptions) for descriptions in entity_desc.values()),
+            "copies_to_reindex": len(orphans),
+        }
+        print(f"Articles : {stats['articles']} deleted, {stats['document_bytes']} bytes reclaimed")
+        print(f"NEWS store : {stats['vectors']} vectors deleted, {stats['vector_bytes']} bytes reclaimed")
+        print(f"Entities : {stats['entities']} updated, {stats['descriptions']} descriptions removed")
+        if orphans:
+            print(f"Near-duplicates : {len(orphans)} copies of expired stories will be indexed by the next 'flask reindex NEWS'")
+        if entity_ids:
+            # Only the updated concepts are embedded again
+            stats["wiki_bytes"] = self.update_concepts(entity_ids)
+            print(f"WIKI store : {stats['wiki_bytes']} bytes reclaimed")
+        return stats
+
+    def article_paths(self, doc_ids):
+        """
+        Indexed articles selected in the web page
+
+        Parameters
+        ----------
+            doc_ids : list
+                article IDs (see article_id())
+        Returns
+        -------
+            list
+                paths of the XML articles, unknown IDs are ignored
+        """
+        self.metadata.reload()
+        doc_ids = set(doc_ids)
+        return sorted(file_path for file_path in self.metadata.keys if article_id(file_path) in doc_ids)
+
+    def article_context(self, paths, query):
+        """
+        Chat context made of the spans of selected articles, chunked as they were
+        indexed : all of them if there are at most CHAT_SCOPE_TOPK spans, else the
+        ones closest to the query
+
+        Parameters
+        ----------
+            paths : list
+                paths of the XML articles
+            query : str
+                question the context is retrieved for
+        Returns
+        -------
+            list
+                LlamaIndex NodeWithScore objects
+        """
+        nodes = []
+        for file_path in paths:
+            try:
+                root=ET.parse(file_path).getroot()
+            except:
+                continue
+            nodes.extend(run_transformations([article_document(file_path, root)], Settings.transformations))
+        if len(nodes) <= self.chat_scope_top_k:
+            return [NodeWithScore(node=node, score=1.0) for node in nodes]
+        # A mini-index of the selected spans, searched by cosine similarity
+        vectors = np.array(self.embed_model.get_text_embedding_batch([node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]), dtype=np.float32)
+        embedding = np.array(self.embed_query(query, "query"), dtype=np.float32)
+        scores = vectors @ embedding / (np.linalg.norm(vectors, axis=1)*np.linalg.norm(embedding))
+        best = np.argsort(-scores)[:self.chat_scope_top_k]
+        return [NodeWithScore(node=nodes[offset], score=float(scores[offset])) for offset in best]
+
+    def chat_engine(self, memory, date_from=None, date_to=None, doc_ids=()):
+        """
+        Chat engine retrieving context from the articles selected by the user, or
+        else from the NEWS partitions of a date range
+
+        Parameters
+        ----------
+            memory : BaseMemory
+                conversation memory of the chat session
+            date_from : str
+                first publication day ("YYYY-MM-DD"), None for no lower bound
+            date_to : str
+                last publication day ("YYYY-MM-DD"), None for no upper bound
+            doc_ids : tuple
+                IDs of the selected articles (see article_id()), the date range is then ignored
+        Returns
+        -------
+            ContextChatEngine
+                a LlamaIndex chat engine, writing to the conversation memory
+        """
+        paths = self.article_paths(doc_ids) if doc_ids else []
+        if paths:
+            # Context of the selected articles, computed once for the whole conversation
+            retriever = CachedContextRetriever(lambda query: self.article_context(paths, query))
+        else:
+            retriever = PartitionRetriever(lambda query, k: self.search_store("NEWS", query, date_from, date_to, k, "query"), self.chat_top_k)
+        # Here is the prompt :
+        return ContextChatEngine.from_defaults(
+            retriever=retriever,
+            llm=self.llm_settings,
+            memory=memory,
+            system_prompt=(
+                "Tu est un chatbot, capable d'avoir des interactions normales et de discuter"
+                " d'actualités. Répond en français."
+            ),
+        )
 
-    def patchat(self, question):
+    def patchat(self, question, date_from=None, date_to=None, session_id="default", doc_ids=()):
         """
         Start the chatbot in streaming mode
 
@@ -520,6 +1629,14 @@ class Toolkit:
         -----------
             question : str
                 current prompt
+            date_from : str
+                first publication day of retrieved articles ("YYYY-MM-DD"), None for no lower bound
+            date_to : str
+                last publication day of retrieved articles ("YYYY-MM-DD"), None for no upper bound
+            session_id : str
+                chat session (conversation history) the question belongs to
+            doc_ids : list
+                IDs of the articles selected by the user (see article_id()), to restrict retrieval to them
         Returns
         -------
             StreamingAgentChatResponse
@@ -529,8 +1646,17 @@ class Toolkit:
         # remove concept IDs as their are not helpfull here
         question = self.filter_query(question)
         print(f"Answering '{question}'", file=sys.stderr)
-        streaming_response = self.chat_engine.stream_chat(question)
-        print(streaming_response.__class__.__name__)
+        session = self.chat_sessions.get(session_id)
+        # The engine of a session (and its retrieved context) is kept while its
+        # date range and selected articles do not change
+        scope = tuple(sorted(set(doc_ids)))
+        if session.engine is None or session.date_range != (date_from, date_to) or session.scope != scope:
+            session.engine = self.chat_engine(session.memory, date_from, date_to, scope)
+            session.date_range = (date_from, date_to)
+            session.scope = scope
+        # Retrieval, then the LLM request (its tokens are streamed afterwards)
+        with metrics.timer("chat_context"):
+            streaming_response = session.engine.stream_chat(question)
         return streaming_response
 
 if __name__ == "main":